@@ -1,6 +1,10 @@
 # run.py
-import eventlet
-eventlet.monkey_patch()
+# Process pool workers (spawn start method) re-import this module as '__mp_main__'.
+# They must not monkey-patch or create a second app - they only run data tasks.
+IS_POOL_WORKER = __name__ == '__mp_main__'
+if not IS_POOL_WORKER:
+    import eventlet
+    eventlet.monkey_patch()
 import logging
 import traceback
 import os
@@ -39,14 +43,15 @@ except Exception as e_other:
     logging.critical(f"!!! An unexpected error occurred during initial imports: {e_other}", exc_info=True)
     exit(1)
 
-# Create the Flask App Instance
-logging.debug("Attempting to create Flask app instance via create_app()...")
-try:
-    app = create_app()
-    logging.info("Flask app instance created successfully.")
-except Exception as e_create:
-    logging.critical(f"!!! Failed during Flask app creation process: {e_create}", exc_info=True)
-    exit(1)
+# Create the Flask App Instance (skipped in process pool workers)
+if not IS_POOL_WORKER:
+    logging.debug("Attempting to create Flask app instance via create_app()...")
+    try:
+        app = create_app()
+        logging.info("Flask app instance created successfully.")
+    except Exception as e_create:
+        logging.critical(f"!!! Failed during Flask app creation process: {e_create}", exc_info=True)
+        exit(1)
 
 # Main Execution Block
 if __name__ == '__main__':
@@ -39,7 +39,7 @@ try:
                          voice_routes)
 
     # Import socket handler registration modules
-    from .sockets import chat_handlers, pdf_chat_handlers, voice_handlers
+    from .sockets import chat_handlers, pdf_chat_handlers, voice_handlers, data_job_handlers
     logging.debug("Successfully imported local modules in src/__init__.py.")
 except ImportError as e:
     # Log critical import errors during package initialization
@@ -146,6 +146,7 @@ def create_app(config_class=Config):
         chat_handlers.register_chat_handlers(extensions.socketio)
         pdf_chat_handlers.register_pdf_chat_handlers(extensions.socketio)
         voice_handlers.register_voice_handlers(extensions.socketio)
+        data_job_handlers.register_data_job_handlers(extensions.socketio)
         logging.info("SocketIO event handlers registered successfully.")
     except Exception as sock_err:
         logging.error(f"Error occurred during SocketIO handler registration: {sock_err}", exc_info=True)
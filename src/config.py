@@ -58,6 +58,57 @@ class Config:
     # --- End File Uploads ---
 
 
+    # --- Data Analyzer Settings ---
+    # Byte budget for the shared in-process cache of loaded DataFrames (LRU eviction).
+    DATAFRAME_CACHE_MAX_MB = int(os.environ.get('DATAFRAME_CACHE_MAX_MB', 1024))
+    # Uploads at or above this size are profiled in chunks instead of loaded whole.
+    STREAMING_PROFILE_THRESHOLD_MB = int(os.environ.get('STREAMING_PROFILE_THRESHOLD_MB', 50))
+    STREAMING_PROFILE_CHUNK_ROWS = int(os.environ.get('STREAMING_PROFILE_CHUNK_ROWS', 100000))
+    # Column statistics mode: 'exact', 'approximate' (sketches with error bounds) or
+    # 'auto' (approximate once a dataset has at least APPROXIMATE_STATS_MIN_ROWS rows).
+    PROFILE_STATS_MODE = os.environ.get('PROFILE_STATS_MODE', 'exact').lower()
+    APPROXIMATE_STATS_MIN_ROWS = int(os.environ.get('APPROXIMATE_STATS_MIN_ROWS', 1000000))
+    # Uploads are parsed/profiled by background jobs; at most this many run at once.
+    ANALYSIS_JOB_CONCURRENCY = int(os.environ.get('ANALYSIS_JOB_CONCURRENCY', 2))
+    # Worker processes for CPU-bound pandas work (parsing, profiling, file writing).
+    # 0 runs that work inline in the web process.
+    ANALYSIS_PROCESS_POOL_SIZE = int(os.environ.get('ANALYSIS_PROCESS_POOL_SIZE', 2))
+    # Cleaning steps are replayed from Feather checkpoints written every N steps.
+    CLEANING_CHECKPOINT_INTERVAL = int(os.environ.get('CLEANING_CHECKPOINT_INTERVAL', 5))
+    # CSV downloads are streamed (and optionally gzip/zstd compressed) in batches of this many rows.
+    DOWNLOAD_CSV_CHUNK_ROWS = int(os.environ.get('DOWNLOAD_CSV_CHUNK_ROWS', 50000))
+    # Gzip-compressed plot figures cached on disk per dataset version and plot config (LRU eviction).
+    PLOT_CACHE_FOLDER = os.path.join(ANALYSIS_UPLOAD_FOLDER, 'plot_cache')
+    PLOT_CACHE_MAX_MB = int(os.environ.get('PLOT_CACHE_MAX_MB', 256))
+    # Aggregation cube built in the background per dataset version: text columns with at most
+    # this many distinct values (up to AGGREGATE_CUBE_MAX_DIMENSIONS of them, 0 disables) are
+    # pre-grouped so bar/pie plots and group summaries over them skip the groupby.
+    AGGREGATE_CUBE_MAX_CARDINALITY = int(os.environ.get('AGGREGATE_CUBE_MAX_CARDINALITY', 50))
+    AGGREGATE_CUBE_MAX_DIMENSIONS = int(os.environ.get('AGGREGATE_CUBE_MAX_DIMENSIONS', 6))
+    # Approximate token budget (~4 chars/token) for Gemini insight prompts, whatever the dataset width.
+    INSIGHT_PROMPT_TOKEN_BUDGET = int(os.environ.get('INSIGHT_PROMPT_TOKEN_BUDGET', 6000))
+    # --- End Data Analyzer ---
+
+    # --- PDF Analyzer Settings ---
+    # Pages per text-extraction task; ranges are extracted in parallel in the process pool.
+    PDF_EXTRACT_PAGE_RANGE = int(os.environ.get('PDF_EXTRACT_PAGE_RANGE', 50))
+    # Target size of the page-aligned text chunks a PDF's full text is stored as.
+    PDF_CHUNK_TARGET_CHARS = int(os.environ.get('PDF_CHUNK_TARGET_CHARS', 4000))
+    # PDF chat context: the best BM25 chunks for each question, at most this many, within this token budget (~4 chars/token).
+    PDF_CHAT_TOP_K = int(os.environ.get('PDF_CHAT_TOP_K', 8))
+    PDF_CHAT_CONTEXT_TOKENS = int(os.environ.get('PDF_CHAT_CONTEXT_TOKENS', 3000))
+    # PDF chat retrieval mode: 'bm25' (keyword index) or 'embedding' (chunk vectors, built at upload in this mode).
+    PDF_CHAT_RETRIEVAL = os.environ.get('PDF_CHAT_RETRIEVAL', 'bm25')
+    # Embedder for 'embedding' mode: 'hashing' (deterministic, local) or 'gemini' (uses GEMINI_API_KEY).
+    PDF_EMBEDDER = os.environ.get('PDF_EMBEDDER', 'hashing')
+    PDF_EMBEDDING_DIM = int(os.environ.get('PDF_EMBEDDING_DIM', 512)) # Hashing embedder only
+    PDF_EMBEDDING_MODEL = os.environ.get('PDF_EMBEDDING_MODEL', 'models/text-embedding-004') # Gemini embedder only
+    # Documents with at least this many chunks get an IVF (k-means list) index; 0 = always search exhaustively.
+    PDF_EMBEDDING_IVF_MIN_ROWS = int(os.environ.get('PDF_EMBEDDING_IVF_MIN_ROWS', 4096))
+    PDF_EMBEDDING_IVF_NPROBE = int(os.environ.get('PDF_EMBEDDING_IVF_NPROBE', 8)) # IVF lists scored per question
+    # --- End PDF Analyzer ---
+
+
     # --- MongoDB Settings ---
     # CRITICAL: Ensure these match your .env file and MongoDB setup.
     MONGODB_URI = os.getenv("MONGODB_URI")
@@ -6,6 +6,7 @@ from pymongo.errors import ConnectionFailure, ConfigurationError, OperationFailu
 from flask_socketio import SocketIO
 from flask_dance.contrib.google import make_google_blueprint
 import time # Import time for potential retry delay (optional)
+import threading
 
 # --- Relative Import for DB Utilities ---
 try:
@@ -16,23 +17,29 @@ except ImportError as e:
     # Define dummy functions if import fails to prevent later crashes, but log critically
     def ensure_indexes(db): logging.error("ensure_indexes function unavailable."); pass # type: ignore # noqa F811
     def log_db_update_result(update_result, username="N/A", identifier="N/A"): logging.error("log_db_update_result unavailable."); pass # type: ignore # noqa F811
+from .utils.cache_utils import DataFrameCache, DiskLRUCache
+from .utils.executor_utils import create_process_pool
 # ---------------------------------------
 
 # --- Initialize Extension Placeholders ---
 # ... (keep all placeholder initializations as before: socketio, db_client=None, db=None, collections=None, etc.) ...
 socketio = SocketIO(); logging.debug("SocketIO placeholder created.")
 db_client = None; db = None; logging.debug("MongoDB placeholders set to None.")
-registrations_collection = None; input_prompts_collection = None; documentation_collection = None; chats_collection = None; general_chats_collection = None; education_chats_collection = None; healthcare_chats_collection = None; construction_agent_interactions_collection = None; pdf_analysis_collection = None; pdf_chats_collection = None; voice_conversations_collection = None; analysis_uploads_collection = None; news_articles_collection = None; logging.debug("Collection placeholders set to None.")
+registrations_collection = None; input_prompts_collection = None; documentation_collection = None; chats_collection = None; general_chats_collection = None; education_chats_collection = None; healthcare_chats_collection = None; construction_agent_interactions_collection = None; pdf_analysis_collection = None; pdf_chats_collection = None; pdf_text_chunks_collection = None; voice_conversations_collection = None; analysis_uploads_collection = None; news_articles_collection = None; logging.debug("Collection placeholders set to None.")
 genai_model = None; safety_settings = []; logging.debug("Gemini placeholders set.")
 google_bp = None; google_enabled = False; logging.debug("Google OAuth placeholders set.")
+dataframe_cache = None; logging.debug("DataFrame cache placeholder set.")
+plot_cache = None; logging.debug("Plot cache placeholder set.")
+analysis_job_slots = None; logging.debug("Analysis job slots placeholder set.")
+process_pool = None; logging.debug("Process pool placeholder set.")
 # --- End Placeholders ---
 
 
 # --- Main Initialization Function ---
 def init_app(app):
     logging.debug("Executing extensions.init_app(app)...")
-    global db_client, db, socketio, genai_model, google_bp, google_enabled, safety_settings
-    global registrations_collection, input_prompts_collection, documentation_collection, chats_collection, general_chats_collection, education_chats_collection, healthcare_chats_collection, construction_agent_interactions_collection, pdf_analysis_collection, pdf_chats_collection, voice_conversations_collection, analysis_uploads_collection, news_articles_collection
+    global db_client, db, socketio, genai_model, google_bp, google_enabled, safety_settings, dataframe_cache, plot_cache, analysis_job_slots, process_pool
+    global registrations_collection, input_prompts_collection, documentation_collection, chats_collection, general_chats_collection, education_chats_collection, healthcare_chats_collection, construction_agent_interactions_collection, pdf_analysis_collection, pdf_chats_collection, pdf_text_chunks_collection, voice_conversations_collection, analysis_uploads_collection, news_articles_collection
 
     # --- Initialize SocketIO ---
     # ... (keep SocketIO init code as before) ...
@@ -94,7 +101,7 @@ def init_app(app):
                 # Assign Collections
                 logging.debug("Assigning MongoDB collection objects...")
                 registrations_collection = db["registrations"] # Add all collection assignments here...
-                input_prompts_collection = db["input_prompts"]; documentation_collection = db["documentation"]; chats_collection = db["chats"]; general_chats_collection = db["general_chats"]; education_chats_collection = db["education_chats"]; healthcare_chats_collection = db["healthcare_chats"]; construction_agent_interactions_collection = db["construction_agent_interactions"]; pdf_analysis_collection = db["pdf_analysis"]; pdf_chats_collection = db["pdf_chats"]; voice_conversations_collection = db["voice_conversations"]; analysis_uploads_collection = db["analysis_uploads"]; news_articles_collection = db["news_articles"]; email_log_collection = db["email_logs"]; agent_state_collection = db["agent_state"]
+                input_prompts_collection = db["input_prompts"]; documentation_collection = db["documentation"]; chats_collection = db["chats"]; general_chats_collection = db["general_chats"]; education_chats_collection = db["education_chats"]; healthcare_chats_collection = db["healthcare_chats"]; construction_agent_interactions_collection = db["construction_agent_interactions"]; pdf_analysis_collection = db["pdf_analysis"]; pdf_chats_collection = db["pdf_chats"]; pdf_text_chunks_collection = db["pdf_text_chunks"]; voice_conversations_collection = db["voice_conversations"]; analysis_uploads_collection = db["analysis_uploads"]; news_articles_collection = db["news_articles"]; email_log_collection = db["email_logs"]; agent_state_collection = db["agent_state"]
                 logging.info("MongoDB Collections assigned.")
 
                 # Ensure Indexes
@@ -150,5 +157,32 @@ def init_app(app):
     else: missing = [item for item, value in [("CLIENT_ID", google_oauth_client_id), ("CLIENT_SECRET", google_oauth_client_secret), ("REDIRECT_URI", google_redirect_uri)] if not value]; logging.warning(f"Google OAuth disabled - missing: {', '.join(missing)}"); google_bp = None
 
 
+    # --- Initialize DataFrame Cache ---
+    cache_mb = app.config.get('DATAFRAME_CACHE_MAX_MB', 1024)
+    dataframe_cache = DataFrameCache(max_bytes=cache_mb * 1024 * 1024)
+    logging.info(f"DataFrame cache initialized with a {cache_mb} MB budget.")
+
+    # --- Initialize Plot Cache ---
+    plot_cache_mb = app.config.get('PLOT_CACHE_MAX_MB', 256)
+    try:
+        plot_cache = DiskLRUCache(app.config['PLOT_CACHE_FOLDER'], max_bytes=plot_cache_mb * 1024 * 1024)
+        logging.info(f"Plot cache initialized at {app.config['PLOT_CACHE_FOLDER']} with a {plot_cache_mb} MB budget.")
+    except Exception as plot_cache_err:
+        logging.error(f"Failed to initialize plot cache: {plot_cache_err}. Plots will not be cached.", exc_info=True)
+        plot_cache = None
+
+    # --- Initialize Analysis Job Slots ---
+    # Bounds how many upload jobs parse/profile at once so they cannot starve chat traffic
+    job_concurrency = max(1, app.config.get('ANALYSIS_JOB_CONCURRENCY', 2))
+    analysis_job_slots = threading.BoundedSemaphore(job_concurrency)
+    logging.info(f"Analysis job slots initialized: {job_concurrency} concurrent upload jobs.")
+
+    # --- Initialize Process Pool ---
+    pool_size = app.config.get('ANALYSIS_PROCESS_POOL_SIZE', 2)
+    process_pool = create_process_pool(pool_size)
+    if process_pool is not None: logging.info(f"Process pool initialized with {pool_size} workers.")
+    else: logging.info("Process pool disabled. CPU-bound data work runs inline.")
+
+
     logging.debug("extensions.init_app(app) finished.")
 # --- End Initialization Function ---
\ No newline at end of file
@@ -7,10 +7,12 @@ import logging
 import os
 import json
 import io
+import gzip
+import tempfile
 from datetime import datetime # Ensure datetime is imported
 from bson import ObjectId, json_util # json_util might not be needed here anymore
 from bson.errors import InvalidId
-import pandas as pd
+import numpy as np
 import plotly.express as px
 import plotly.io as pio
 
@@ -21,16 +23,219 @@ import plotly.io as pio
 from ..utils.auth_utils import is_logged_in
 from ..utils.file_utils import allowed_analysis_file, get_secure_filename
 from ..utils.data_analyzer_utils import (get_dataframe, generate_data_profile,
+                                           compute_column_stats, resolve_stats_mode,
                                            generate_cleaning_recommendations,
-                                           generate_gemini_insight_prompt,
-                                           PDFReport) # Import the PDFReport class
+                                           generate_gemini_insight_prompt, estimate_tokens, parse_insight_response,
+                                           apply_cleaning_operation,
+                                           get_row_hashes,
+                                           get_step_chain, get_redo_step, get_dataset_version,
+                                           materialize_dataset, replay_steps, write_checkpoint,
+                                           publish_checkpoint, discard_checkpoint, load_checkpoint,
+                                           get_branch_chains, remove_checkpoints, sorted_row_positions,
+                                           select_row_positions, row_window_payload,
+                                           ANALYSIS_TYPES, normalize_analysis_params,
+                                           get_analysis_key, compute_analysis, analysis_task,
+                                           read_dataframe_sidecar, prepare_sidecar_task,
+                                           profile_upload_task, column_stats_task,
+                                           materialize_task, apply_cleaning_task,
+                                           write_download_task,
+                                           CSV_DOWNLOAD_FORMATS, iter_csv_chunks, get_csv_compressor,
+                                           write_xlsx_streaming, read_progress_file,
+                                           list_workbook_sheets, extract_sheet_task, get_sheet_dataset_path,
+                                           aggregate_cube_task, group_summary_from_cube,
+                                           zstandard, PDFReport) # Import the PDFReport class
 from ..utils.db_utils import log_db_update_result
+from ..utils.executor_utils import run_in_process
+from ..utils.storage_utils import store_upload_stream
+from ..utils.query_utils import normalize_query_spec, get_query_key, execute_query
+from ..utils.cache_utils import estimate_dataframe_bytes
+from ..utils.plot_utils import (PLOT_TYPES, CUBE_CHART_TYPES, build_plot_figure, build_plot_from_cube, plot_task,
+                                normalize_plot_config, get_plot_cache_key)
 from ..utils.api_utils import log_gemini_response_details
+from ..sockets.data_job_handlers import emit_job_event, job_status_payload, JOB_FINAL_STATUSES
 
 # Create Blueprint
 bp = Blueprint('data', __name__)
 
 
+# --- Helper Functions ---
+
+def _upload_version(upload_doc):
+    """Dataset version id of the upload's active state (raw file + active cleaning step)."""
+    return get_dataset_version(upload_doc['filepath'], upload_doc.get('active_step_id'))
+
+def _upload_chain(upload_doc):
+    """Cleaning steps leading to the upload's active state (oldest first)."""
+    return get_step_chain(upload_doc.get('cleaning_steps', []), upload_doc.get('active_step_id'))
+
+def _stale_analysis_results(upload_doc, version):
+    """$unset spec dropping memoized analysis_results of every version but version (keeps the document bounded)."""
+    return {f"analysis_results.{key}": "" for key, entry in (upload_doc.get('analysis_results') or {}).items()
+            if not isinstance(entry, dict) or entry.get('version') != version}
+
+def _cache_upload_state(upload_id, version, df, row_hashes):
+    from ..extensions import dataframe_cache
+    if dataframe_cache is None: return
+    dataframe_cache.put((upload_id, version), df)
+    dataframe_cache.put((upload_id, version, 'row_hashes'), row_hashes, size_bytes=row_hashes.nbytes)
+
+def _load_raw_dataframe(filepath):
+    """Loads the raw upload, parsing in a worker process when the pool is enabled."""
+    from ..extensions import process_pool
+    df = None
+    if process_pool is not None:
+        # Parse in a worker process; this process only memory-maps the resulting sidecar
+        sidecar_path = run_in_process(process_pool, prepare_sidecar_task, filepath)
+        df = read_dataframe_sidecar(sidecar_path) if sidecar_path else None
+    if df is None:
+        df = get_dataframe(filepath)
+    return df
+
+def _load_upload_state(upload_doc):
+    """
+    Returns (df, row_hashes) for the upload's active dataset version, served
+    from the shared in-process cache when possible. Keyed by upload _id plus
+    the dataset version, so undo/redo between cached versions is free.
+    A version whose parent is cached is built by applying just its last step;
+    otherwise it is replayed from the nearest checkpoint.
+    With the process pool, replays run in a worker instead (see _load_version_checkpoint).
+    NOTE: The returned frame may be shared - do not modify it in place.
+    """
+    from ..extensions import dataframe_cache, process_pool
+
+    filepath = upload_doc.get('filepath')
+    if not filepath or not os.path.exists(filepath):
+        return None, None
+    upload_id = str(upload_doc['_id'])
+    version = _upload_version(upload_doc)
+
+    if dataframe_cache is not None:
+        df = dataframe_cache.get((upload_id, version))
+        row_hashes = dataframe_cache.get((upload_id, version, 'row_hashes'))
+        if df is not None and row_hashes is not None:
+            logging.debug(f"DataFrame cache hit for upload {upload_id} version {version}")
+            return df, row_hashes
+
+    chain = _upload_chain(upload_doc)
+    if not chain:
+        df = _load_raw_dataframe(filepath)
+        if df is None: return None, None
+        row_hashes = get_row_hashes(df, filepath)
+    elif process_pool is not None:
+        df, row_hashes = _load_version_checkpoint(filepath, chain)
+        if df is None: return None, None
+    else:
+        parent_version = get_dataset_version(filepath, chain[-1].get('parent_id'))
+        parent_df = dataframe_cache.get((upload_id, parent_version)) if dataframe_cache is not None else None
+        parent_hashes = dataframe_cache.get((upload_id, parent_version, 'row_hashes')) if dataframe_cache is not None else None
+        if parent_df is not None and parent_hashes is not None:
+            df, row_hashes = replay_steps(parent_df, parent_hashes, chain[-1:])
+        else:
+            df, row_hashes = materialize_dataset(filepath, chain)
+            if df is None: return None, None
+    _cache_upload_state(upload_id, version, df, row_hashes)
+    return df, row_hashes
+
+def _load_version_checkpoint(filepath, chain):
+    """
+    (df, row_hashes) of the version at the end of chain, replayed in a worker
+    process that leaves it as a checkpoint for this process to memory-map.
+    Falls back to replaying here if the version cannot be stored as Feather.
+    """
+    from ..extensions import process_pool
+    if run_in_process(process_pool, materialize_task, filepath, chain):
+        checkpoint = load_checkpoint(filepath, chain)
+        if checkpoint is not None: return checkpoint
+    logging.warning(f"No checkpoint for a {len(chain)}-step version of {os.path.basename(filepath)}; replaying in the web process.")
+    return materialize_dataset(filepath, chain)
+
+def _load_upload_dataframe(upload_doc):
+    """Returns just the DataFrame of the upload's active version (see _load_upload_state)."""
+    return _load_upload_state(upload_doc)[0]
+
+def _stats_mode_for(df):
+    """Column statistics mode ('exact'/'approximate') configured for a frame of this size."""
+    return resolve_stats_mode(current_app.config.get('PROFILE_STATS_MODE', 'exact'), len(df),
+                              current_app.config.get('APPROXIMATE_STATS_MIN_ROWS', 1000000))
+
+def _get_upload_column_stats(upload_doc, df, row_hashes=None):
+    """Returns compute_column_stats(df) for the upload's active version, cached next to its frame."""
+    from ..extensions import dataframe_cache, process_pool
+
+    stats_key = (str(upload_doc['_id']), _upload_version(upload_doc), 'column_stats')
+    stats = dataframe_cache.get(stats_key) if dataframe_cache is not None else None
+    if stats is None:
+        if process_pool is not None:
+            # The worker reads the version's sidecar/checkpoint, so nothing is recomputed here
+            stats = run_in_process(process_pool, column_stats_task, upload_doc['filepath'],
+                                   chain=_upload_chain(upload_doc), mode=_stats_mode_for(df))
+        else:
+            if row_hashes is None: row_hashes = _load_upload_state(upload_doc)[1]
+            stats = compute_column_stats(df, mode=_stats_mode_for(df), row_hashes=row_hashes)
+        if dataframe_cache is not None:
+            dataframe_cache.put(stats_key, stats, size_bytes=1024 * max(1, stats.get('col_count', 0)))
+    return stats
+
+def _cleaner_state_payload(upload_doc, df, stats, message):
+    """Profiles a dataset version and builds the cleaner's JSON payload plus the DB fields to store."""
+    profile = generate_data_profile(df, stats=stats)
+    fields = {"row_count": profile.get('row_count', 0), "col_count": profile.get('col_count', 0),
+              "column_info": profile.get('column_info', []), "memory_usage": profile.get('memory_usage'),
+              "status": "cleaned" if upload_doc.get('active_step_id') is not None else "profiled",
+              "last_modified": datetime.utcnow()}
+    payload = {"message": message,
+               "preview_data": json.loads(df.head(100).to_json(orient='records', date_format='iso')),
+               "column_info": fields["column_info"], "row_count": fields["row_count"], "col_count": fields["col_count"],
+               "active_step_id": upload_doc.get('active_step_id'),
+               "can_undo": upload_doc.get('active_step_id') is not None,
+               "can_redo": get_redo_step(upload_doc.get('cleaning_steps', []), upload_doc.get('active_step_id')) is not None}
+    return payload, fields
+
+
+def _schedule_aggregate_cube(app, upload_doc):
+    """Starts the background aggregation cube build for the upload's active version (no-op when disabled)."""
+    from ..extensions import socketio
+    if app.config.get('AGGREGATE_CUBE_MAX_DIMENSIONS', 6) <= 0 or socketio is None: return
+    socketio.start_background_task(_run_cube_job, app, upload_doc['_id'], upload_doc['filepath'],
+                                   upload_doc.get('active_step_id'), _upload_chain(upload_doc))
+
+def _run_cube_job(app, upload_id, filepath, active_step_id, chain):
+    """
+    Background job: builds the aggregation cube of one dataset version and records
+    its meta as the upload's aggregate_cube - only if that version is still active.
+    """
+    from ..extensions import analysis_uploads_collection, process_pool
+    with app.app_context():
+        try:
+            version = get_dataset_version(filepath, active_step_id)
+            cube_meta = run_in_process(process_pool, aggregate_cube_task, filepath, chain,
+                                       max_cardinality=app.config.get('AGGREGATE_CUBE_MAX_CARDINALITY', 50),
+                                       max_dimensions=app.config.get('AGGREGATE_CUBE_MAX_DIMENSIONS', 6))
+            cube_field = dict(cube_meta, version=version, built_at=datetime.utcnow()) if cube_meta else None
+            analysis_uploads_collection.update_one({"_id": upload_id, "active_step_id": active_step_id},
+                                                   {"$set": {"aggregate_cube": cube_field}})
+            if cube_meta:
+                logging.info(f"Aggregation cube for {upload_id} version {version}: {cube_meta['cells']} cells over "
+                             f"{[dim['name'] for dim in cube_meta['dimensions']]}")
+        except Exception as e:
+            logging.error(f"Aggregation cube job for {upload_id} failed: {e}", exc_info=not isinstance(e, ValueError))
+
+def _load_upload_cube(upload_doc):
+    """(cube DataFrame, meta) of the upload's active version if its cube has been built, else (None, None)."""
+    from ..extensions import dataframe_cache
+    cube_meta = upload_doc.get('aggregate_cube')
+    version = _upload_version(upload_doc)
+    if not cube_meta or cube_meta.get('version') != version or not os.path.exists(cube_meta.get('path', '')):
+        return None, None
+    cube_key = (str(upload_doc['_id']), version, 'aggregate_cube')
+    cube = dataframe_cache.get(cube_key) if dataframe_cache is not None else None
+    if cube is None:
+        cube = read_dataframe_sidecar(cube_meta['path'])
+        if cube is None: return None, None
+        if dataframe_cache is not None: dataframe_cache.put(cube_key, cube)
+    return cube, cube_meta
+
+
 # --- Route Definitions ---
 
 @bp.route('/analyzer')
@@ -47,11 +252,14 @@ def data_analyzer_page():
 
 @bp.route('/analyzer/upload', methods=['POST'])
 def upload_analysis_data():
-    """Handles the upload of data files (CSV, XLSX) for analysis."""
+    """
+    Handles the upload of data files (CSV, XLSX) for analysis. The file is saved
+    and queued; parsing and profiling run in a background job that reports over
+    the /data_jobs Socket.IO namespace. Returns 202 with the job id.
+    """
     # --- Access extensions INSIDE function ---
-    from ..extensions import db, analysis_uploads_collection
+    from ..extensions import db, analysis_uploads_collection, socketio
 
-    # ... (rest of upload_analysis_data logic as corrected previously) ...
     logging.info("--- Enter /data/analyzer/upload ---")
     if not is_logged_in(): return jsonify({"error": "Authentication required."}), 401
     if db is None or analysis_uploads_collection is None: logging.error("Data upload failed: DB unavailable."); return jsonify({"error": "Database service unavailable."}), 503
@@ -62,27 +270,187 @@ def upload_analysis_data():
     try: user_id = ObjectId(session['user_id']); username = session.get('username', 'Unknown')
     except Exception as e: logging.error(f"Session error: {e}"); return jsonify({"error": "Invalid session."}), 401
     original_filename = get_secure_filename(file.filename); _, f_ext = os.path.splitext(original_filename)
-    ts = datetime.utcnow().strftime('%Y%m%d%H%M%S%f'); stored_filename = f"{user_id}_{ts}{f_ext}"
-    upload_dir = current_app.config['ANALYSIS_UPLOAD_FOLDER']; filepath = os.path.join(upload_dir, stored_filename)
+    upload_dir = current_app.config['ANALYSIS_UPLOAD_FOLDER']; stored = None
     try:
-        file.save(filepath); df = get_dataframe(filepath)
-        if df is None:
-            if os.path.exists(filepath): os.remove(filepath)
-            return jsonify({"error": "Failed to read or unsupported file format."}), 400
-        profile = generate_data_profile(df); now = datetime.utcnow()
-        doc = { "user_id": user_id, "username": username, "original_filename": original_filename, "stored_filename": stored_filename, "filepath": filepath, "upload_timestamp": now, "row_count": profile.get('row_count', 0), "col_count": profile.get('col_count', 0), "column_info": profile.get('column_info', []), "memory_usage": profile.get('memory_usage'), "cleaning_steps": [], "analysis_results": {}, "generated_insights": [], "status": "uploaded", "last_modified": now }
+        # Hashed while streaming to disk; identical bytes resolve to the already stored file
+        stored = store_upload_stream(file.stream, upload_dir, f_ext)
+        filepath = stored['path']; stored_filename = os.path.relpath(filepath, upload_dir)
+        now = datetime.utcnow()
+        doc = { "user_id": user_id, "username": username, "original_filename": original_filename, "stored_filename": stored_filename, "filepath": filepath, "content_sha256": stored['sha256'], "file_size": stored['size'], "upload_timestamp": now, "row_count": 0, "col_count": 0, "column_info": [], "memory_usage": None, "cleaning_steps": [], "analysis_results": {}, "generated_insights": [], "status": "queued", "last_modified": now }
+        # A re-upload of already profiled bytes reuses that profile (sidecar and row hashes sit next to the file)
+        profiled_doc = analysis_uploads_collection.find_one(
+            {"content_sha256": stored['sha256'], "filepath": filepath, "status": "profiled"},
+            {"row_count": 1, "col_count": 1, "column_info": 1, "memory_usage": 1, "sheets": 1, "sheet_name": 1, "workbook_path": 1, "aggregate_cube": 1}
+        ) if stored['reused'] else None
+        if profiled_doc:
+            doc.update({key: value for key, value in profiled_doc.items() if key != '_id'}, status="profiled")
+            upload_id = analysis_uploads_collection.insert_one(doc).inserted_id
+            logging.info(f"DB insert successful. Upload ID: {upload_id}. Reused profile of identical upload {profiled_doc['_id']}.")
+            return jsonify({ "message": "File uploaded (identical to a previous upload, profile reused).", "job_id": str(upload_id), "upload_id": str(upload_id), "filename": original_filename, "status": "profiled", "rows": doc.get('row_count', 0), "columns": doc.get('col_count', 0) }), 200
         insert_result = analysis_uploads_collection.insert_one(doc); upload_id = insert_result.inserted_id
-        logging.info(f"DB insert successful. Upload ID: {upload_id}")
-        response_payload = { "message": "File uploaded and profiled successfully.", "upload_id": str(upload_id), "filename": original_filename, "rows": profile.get('row_count', 0), "columns": profile.get('col_count', 0), "column_info": profile.get('column_info', []) }
-        return jsonify(response_payload), 200
+        logging.info(f"DB insert successful. Upload ID: {upload_id}. Queued background profiling job.")
+        socketio.start_background_task(_run_upload_job, current_app._get_current_object(), upload_id, filepath)
+        response_payload = { "message": "File uploaded. Processing in the background.", "job_id": str(upload_id), "upload_id": str(upload_id), "filename": original_filename, "status": "queued" }
+        return jsonify(response_payload), 202
     except Exception as e:
         logging.error(f"Unhandled exception during analysis file upload: {e}", exc_info=True)
-        if 'filepath' in locals() and os.path.exists(filepath):
-            try: os.remove(filepath)
-            except OSError as rm_err: logging.error(f"Failed cleanup {filepath}: {rm_err}")
+        # Stored bytes may back other records, so only a file created by this request is removed
+        if stored and not stored['reused'] and os.path.exists(stored['path']):
+            try: os.remove(stored['path'])
+            except OSError as rm_err: logging.error(f"Failed cleanup {stored['path']}: {rm_err}")
         return jsonify({"error": "Server error processing file."}), 500
 
 
+def _run_upload_job(app, upload_id, filepath, source_sheet=None):
+    """
+    Background job: parses and profiles an uploaded file, moving the upload's
+    status through queued -> parsing -> profiled/failed and emitting progress
+    events to the job's Socket.IO room. With source_sheet=(workbook_path, sheet_name)
+    the sheet is first extracted into filepath (a Feather dataset).
+    """
+    from ..extensions import analysis_uploads_collection, analysis_job_slots, socketio, process_pool
+
+    def set_status(status, message, **extra):
+        fields = {"status": status, "last_modified": datetime.utcnow()}
+        fields.update(extra.pop('fields', {}))
+        analysis_uploads_collection.update_one({"_id": upload_id}, {"$set": fields})
+        event = 'job_complete' if status in JOB_FINAL_STATUSES else 'job_progress'
+        emit_job_event(socketio, upload_id, event, dict(extra, status=status, message=message, upload_id=str(upload_id)))
+
+    with app.app_context():
+        if analysis_job_slots is not None: analysis_job_slots.acquire() # Waits (status stays 'queued') while all slots are busy
+        try:
+            if source_sheet is not None:
+                set_status('parsing', f"Loading sheet '{source_sheet[1]}'...")
+                run_in_process(process_pool, extract_sheet_task, source_sheet[0], source_sheet[1], filepath)
+            elif filepath.lower().endswith('.xlsx'):
+                # Sheet names/dimensions come from workbook metadata only; the first sheet is profiled below
+                sheets = run_in_process(process_pool, list_workbook_sheets, filepath)
+                analysis_uploads_collection.update_one({"_id": upload_id}, {"$set": {
+                    "sheets": sheets, "sheet_name": sheets[0]['name'] if sheets else None, "workbook_path": filepath}})
+            set_status('parsing', "Parsing and profiling file...")
+            # Large files are profiled chunk by chunk (bounded memory). Inline, each chunk reports
+            # directly; a pool worker writes its row count to a progress file that is polled here.
+            reported = {"rows": None}
+            def report_rows(rows):
+                if rows is None or rows == reported["rows"]: return
+                reported["rows"] = rows
+                emit_job_event(socketio, upload_id, 'job_progress', {"status": "parsing", "message": f"Profiled {rows} rows...", "rows_processed": rows})
+            progress_path = os.path.join(app.config['ANALYSIS_UPLOAD_FOLDER'], f"job-{upload_id}.progress") if process_pool is not None else None
+            try:
+                profile = run_in_process(process_pool, profile_upload_task, filepath,
+                                         stats_mode=app.config.get('PROFILE_STATS_MODE', 'exact'),
+                                         approximate_min_rows=app.config.get('APPROXIMATE_STATS_MIN_ROWS', 1000000),
+                                         streaming_threshold_bytes=app.config.get('STREAMING_PROFILE_THRESHOLD_MB', 50) * 1024 * 1024,
+                                         chunk_rows=app.config.get('STREAMING_PROFILE_CHUNK_ROWS', 100000),
+                                         progress_callback=report_rows if process_pool is None else None,
+                                         progress_path=progress_path,
+                                         on_poll=lambda: report_rows((read_progress_file(progress_path) or {}).get('rows_processed')))
+            finally:
+                if progress_path and os.path.exists(progress_path): os.remove(progress_path)
+            if profile.get('col_count', 0) == 0: raise ValueError("File contains no data.")
+            set_status('profiled', "File profiled successfully.",
+                       rows=profile.get('row_count', 0), columns=profile.get('col_count', 0),
+                       fields={"row_count": profile.get('row_count', 0), "col_count": profile.get('col_count', 0),
+                               "column_info": profile.get('column_info', []), "memory_usage": profile.get('memory_usage')})
+            logging.info(f"Upload job {upload_id} complete: {profile.get('row_count', 0)} rows, {profile.get('col_count', 0)} columns.")
+            _schedule_aggregate_cube(app, {"_id": upload_id, "filepath": filepath})
+        except Exception as e:
+            logging.error(f"Upload job {upload_id} failed: {e}", exc_info=not isinstance(e, ValueError))
+            error_message = str(e) if isinstance(e, ValueError) else "Server error processing file."
+            # Nothing is deleted: the stored file and everything derived from it (sidecar, row hashes,
+            # extracted sheet) are content-addressed and shared with other records of the same bytes.
+            # Derived files are written to a temp path and renamed into place, so a failed job never
+            # leaves a partial one, and readers check them against the source before use.
+            try: set_status('failed', error_message, error=error_message, fields={"error_message": error_message})
+            except Exception as db_err: logging.error(f"Could not record failure for upload job {upload_id}: {db_err}")
+        finally:
+            if analysis_job_slots is not None: analysis_job_slots.release()
+
+
+@bp.route('/analyzer/job/<job_id>')
+def upload_job_status(job_id):
+    """Polling fallback for clients without a Socket.IO connection."""
+    from ..extensions import db, analysis_uploads_collection
+    if not is_logged_in(): return jsonify({"error": "Authentication required."}), 401
+    if db is None or analysis_uploads_collection is None: return jsonify({"error": "Database unavailable."}), 503
+    try: oid = ObjectId(job_id); user_id = ObjectId(session['user_id'])
+    except Exception as e: return jsonify({"error": f"Invalid ID: {e}"}), 400
+    upload_doc = analysis_uploads_collection.find_one({"_id": oid, "user_id": user_id},
+                                                      {"status": 1, "original_filename": 1, "row_count": 1, "col_count": 1, "error_message": 1})
+    if not upload_doc: return jsonify({"error": "Job not found."}), 404
+    return jsonify(job_status_payload(upload_doc)), 200
+
+
+@bp.route('/workbook/<upload_id>/sheets')
+def list_upload_sheets(upload_id):
+    """Lists the worksheets of an .xlsx upload (names and dimensions from workbook metadata)."""
+    from ..extensions import db, analysis_uploads_collection, process_pool
+    if not is_logged_in(): return jsonify({"error": "Authentication required."}), 401
+    if db is None or analysis_uploads_collection is None: return jsonify({"error": "Database unavailable."}), 503
+    try: oid = ObjectId(upload_id); user_id = ObjectId(session['user_id'])
+    except Exception as e: return jsonify({"error": f"Invalid ID: {e}"}), 400
+    upload_doc = analysis_uploads_collection.find_one({"_id": oid, "user_id": user_id})
+    if not upload_doc: return jsonify({"error": "Record not found."}), 404
+    workbook_path = upload_doc.get('workbook_path')
+    if not workbook_path or not os.path.exists(workbook_path): return jsonify({"error": "This upload is not an Excel workbook."}), 400
+    sheets = upload_doc.get('sheets')
+    if sheets is None:
+        try: sheets = run_in_process(process_pool, list_workbook_sheets, workbook_path)
+        except Exception as e:
+            logging.error(f"Error listing sheets of {workbook_path}: {e}", exc_info=True)
+            return jsonify({"error": "Could not read workbook sheets."}), 500
+        analysis_uploads_collection.update_one({"_id": oid}, {"$set": {"sheets": sheets}})
+    return jsonify({"sheets": sheets, "active_sheet": upload_doc.get('sheet_name')}), 200
+
+@bp.route('/workbook/<upload_id>/sheet', methods=['POST'])
+def open_upload_sheet(upload_id):
+    """
+    Opens another sheet of a workbook upload. Each sheet is its own analysis
+    record: an existing one is reused, otherwise the sheet is extracted and
+    profiled by a background job (same events as an upload). Returns its upload_id.
+    """
+    from ..extensions import db, analysis_uploads_collection, socketio
+    if not is_logged_in(): return jsonify({"error": "Authentication required."}), 401
+    if db is None or analysis_uploads_collection is None: return jsonify({"error": "Database unavailable."}), 503
+    try: oid = ObjectId(upload_id); user_id = ObjectId(session['user_id'])
+    except Exception as e: return jsonify({"error": f"Invalid ID: {e}"}), 400
+    upload_doc = analysis_uploads_collection.find_one({"_id": oid, "user_id": user_id})
+    if not upload_doc: return jsonify({"error": "Record not found."}), 404
+    workbook_path = upload_doc.get('workbook_path')
+    if not workbook_path or not os.path.exists(workbook_path): return jsonify({"error": "This upload is not an Excel workbook."}), 400
+
+    sheet_name = (request.get_json(silent=True) or {}).get('sheet_name')
+    sheets = upload_doc.get('sheets') or []
+    sheet = next((item for item in sheets if item.get('name') == sheet_name), None)
+    if sheet is None: return jsonify({"error": f"Sheet '{sheet_name}' not found in workbook."}), 404
+
+    existing = analysis_uploads_collection.find_one({"user_id": user_id, "workbook_path": workbook_path, "sheet_name": sheet_name},
+                                                    {"status": 1, "filepath": 1})
+    if existing and (existing.get('status') != 'failed' or existing.get('filepath') == workbook_path):
+        return jsonify({"job_id": str(existing['_id']), "upload_id": str(existing['_id']), "status": existing.get('status')}), 200
+    if existing: analysis_uploads_collection.delete_one({"_id": existing['_id']}) # Retry a failed extraction
+
+    try:
+        base_name, _ = os.path.splitext(upload_doc.get('original_filename', 'workbook'))
+        filepath = get_sheet_dataset_path(workbook_path, sheet['index'])
+        now = datetime.utcnow()
+        doc = { "user_id": user_id, "username": upload_doc.get('username'), "original_filename": f"{base_name} - {sheet_name}.xlsx",
+                "stored_filename": os.path.basename(filepath), "filepath": filepath, "workbook_path": workbook_path,
+                "sheet_name": sheet_name, "sheets": sheets, "upload_timestamp": now, "row_count": 0, "col_count": 0,
+                "column_info": [], "memory_usage": None, "cleaning_steps": [], "analysis_results": {}, "generated_insights": [],
+                "status": "queued", "last_modified": now }
+        sheet_upload_id = analysis_uploads_collection.insert_one(doc).inserted_id
+        logging.info(f"Queued extraction of sheet '{sheet_name}' from {workbook_path} as upload {sheet_upload_id}")
+        socketio.start_background_task(_run_upload_job, current_app._get_current_object(), sheet_upload_id, filepath,
+                                       source_sheet=(workbook_path, sheet_name))
+        return jsonify({"message": f"Loading sheet '{sheet_name}'.", "job_id": str(sheet_upload_id),
+                        "upload_id": str(sheet_upload_id), "status": "queued"}), 202
+    except Exception as e:
+        logging.error(f"Error opening sheet '{sheet_name}' of {upload_id}: {e}", exc_info=True)
+        return jsonify({"error": "Server error opening sheet."}), 500
+
+
 @bp.route('/cleaner/<upload_id>')
 def data_cleaner_page(upload_id):
     """Renders the data cleaning interface for a specific upload."""
@@ -114,6 +482,9 @@ def data_cleaner_page(upload_id):
             logging.warning(f"Data cleaner: Record {upload_id} not found or access denied for user {user_id}.")
             flash("Analysis record not found or access denied.", "danger")
             return redirect(url_for('data.analysis_history'))
+        if upload_doc.get('status') in ('queued', 'parsing', 'failed'):
+            flash("This file is still being processed." if upload_doc.get('status') != 'failed' else f"Processing failed: {upload_doc.get('error_message', 'unknown error')}", "warning")
+            return redirect(url_for('data.analysis_history'))
 
         # Check file path and load dataframe
         filepath = upload_doc.get('filepath')
@@ -121,7 +492,7 @@ def data_cleaner_page(upload_id):
              logging.error(f"Data cleaner: Filepath missing for {upload_id}. Path: {filepath}")
              flash("Data file missing for this analysis.", "danger")
              return redirect(url_for('data.analysis_history'))
-        df = get_dataframe(filepath)
+        df = _load_upload_dataframe(upload_doc)
         if df is None:
              logging.error(f"Data cleaner: Failed to load dataframe from {filepath}")
              flash("Error loading data file for cleaning.", "danger")
@@ -129,7 +500,8 @@ def data_cleaner_page(upload_id):
 
         # Get profile info from DB doc & generate recommendations from current DF state
         profile = { "row_count": upload_doc.get('row_count'), "col_count": upload_doc.get('col_count'), "column_info": upload_doc.get('column_info', []) }
-        recommendations = generate_cleaning_recommendations(df)
+        stats = _get_upload_column_stats(upload_doc, df)
+        recommendations = generate_cleaning_recommendations(df, stats=stats)
 
         # --- Format dates for template ---
         upload_timestamp_str = "N/A"
@@ -161,6 +533,9 @@ def data_cleaner_page(upload_id):
                                preview_data=preview_data,
                                column_info=profile['column_info'],
                                recommendations=recommendations,
+                               can_undo=upload_doc.get('active_step_id') is not None,
+                               can_redo=get_redo_step(upload_doc.get('cleaning_steps', []), upload_doc.get('active_step_id')) is not None,
+                               zstd_available=zstandard is not None,
                                now=datetime.utcnow())
 
     except Exception as e:
@@ -171,15 +546,18 @@ def data_cleaner_page(upload_id):
         logging.info(f"--- EXIT data_cleaner_page for upload_id: {upload_id} ---")
 
 
-# --- Other Routes (/cleaner/apply, /analysis/run, /plot/generate, etc.) ---
-# Keep the rest of the routes as they were in the previous corrected versions,
-# ensuring they use the pattern of importing extensions INSIDE the function.
+# --- Cleaning Routes ---
 
-# Example structure for apply_cleaning_action:
 @bp.route('/cleaner/apply/<upload_id>', methods=['POST'])
 def apply_cleaning_action(upload_id):
+    """
+    Applies one cleaning action on top of the active dataset version. The step
+    is appended to the cleaning_steps log and becomes the active step; the raw
+    file is left untouched (a checkpoint is written every N steps instead, or
+    for every step when the work runs in the process pool).
+    """
     # --- Access extensions INSIDE function ---
-    from ..extensions import db, analysis_uploads_collection
+    from ..extensions import db, analysis_uploads_collection, process_pool
     # --- Auth & Service Checks ---
     if not is_logged_in(): return jsonify({"error": "Authentication required."}), 401
     if db is None or analysis_uploads_collection is None: return jsonify({"error": "Database unavailable."}), 503
@@ -189,45 +567,403 @@ def apply_cleaning_action(upload_id):
     # --- Find Doc ---
     upload_doc = analysis_uploads_collection.find_one({"_id": oid, "user_id": user_id})
     if not upload_doc: return jsonify({"error": "Record not found."}), 404
+    if upload_doc.get('status') in ('queued', 'parsing', 'failed'): return jsonify({"error": f"Upload is not ready (status: {upload_doc.get('status')})."}), 409
     # --- Get Request Data ---
-    data = request.get_json(); # ... get action, column, params ...
+    data = request.get_json(silent=True)
     if not data or not data.get('action'): return jsonify({"error": "Missing action."}), 400
-    # --- Load DataFrame ---
-    filepath = upload_doc.get('filepath'); # ... check exists ...
-    df = get_dataframe(filepath); # ... check df is not None ...
-    # --- Apply Cleaning Logic ---
-    df_modified = df.copy(); # ... your detailed cleaning logic ...
-    # --- Save DataFrame ---
-    # ... df_modified.to_csv/xlsx ...
-    # --- Update DB ---
-    new_profile = generate_data_profile(df_modified); # ... update analysis_uploads_collection ...
-    # --- Prepare & Return Response ---
-    preview_data = df_modified.head(100).to_dict(orient='records'); # ... etc ...
-    # ... return jsonify(...) ...
-    # --- Error Handling ---
-    # ... try/except ValueError ...
-    # ... try/except Exception ...
-
-
-# --- Stubs for other routes (replace with your full corrected logic) ---
+    action = data.get('action'); column = data.get('column'); params = data.get('params') or {}
+    filepath = upload_doc.get('filepath')
+    if not filepath or not os.path.exists(filepath): return jsonify({"error": "Data file missing on server."}), 404
+    steps = upload_doc.get('cleaning_steps', [])
+    # History guard before any work (re-checked atomically by the update below)
+    if analysis_uploads_collection.count_documents({"_id": oid, "cleaning_steps": {"$size": len(steps)}}, limit=1) == 0:
+        return jsonify({"error": "The dataset was modified concurrently. Please reload the page."}), 409
+
+    staged_path = None
+    try:
+        # --- New Step on top of the Active One ---
+        parent_id = upload_doc.get('active_step_id')
+        step_id = max([step.get('step_id') or 0 for step in steps] + [0]) + 1
+        step = {"step_id": step_id, "parent_id": parent_id, "action": action, "column": column,
+                "params": params, "message": None, "timestamp": datetime.utcnow()}
+        parent_chain = get_step_chain(steps, parent_id)
+        new_chain = parent_chain + [step]
+        df_modified = new_row_hashes = None
+        # --- Apply Cleaning Logic (returns a new frame; the cached one is left untouched) ---
+        if process_pool is not None:
+            # Replay + apply run in a worker, which stages a checkpoint of the result for this process to map
+            step["message"], staged_path = run_in_process(process_pool, apply_cleaning_task, filepath, parent_chain, step)
+        else:
+            df, row_hashes = _load_upload_state(upload_doc)
+            if df is None: return jsonify({"error": "Failed to load data file."}), 500
+            df_modified, new_row_hashes, step["message"] = apply_cleaning_operation(df, action, column=column, params=params, row_hashes=row_hashes)
+            if len(new_chain) % max(1, current_app.config.get('CLEANING_CHECKPOINT_INTERVAL', 5)) == 0:
+                staged_path = write_checkpoint(df_modified, new_row_hashes, filepath, new_chain, staged=True)
+        new_doc = dict(upload_doc, cleaning_steps=steps + [step], active_step_id=step_id)
+        # --- Append Step to the Operation Log (only if no other step was logged since this one was read) ---
+        update = {"$set": {"active_step_id": step_id, "last_modified": datetime.utcnow()}, "$push": {"cleaning_steps": step}}
+        stale_results = _stale_analysis_results(upload_doc, _upload_version(new_doc))
+        if stale_results: update["$unset"] = stale_results
+        update_result = analysis_uploads_collection.update_one(
+            {"_id": oid, "cleaning_steps": {"$size": len(steps)}}, update)
+        log_db_update_result(update_result, session.get('username', 'N/A'), upload_id)
+        if update_result.matched_count == 0:
+            return jsonify({"error": "The dataset was modified concurrently. Please reload the page."}), 409
+        if staged_path is not None:
+            publish_checkpoint(staged_path); staged_path = None
+        # The undone branch this step replaces can no longer be redone; drop its checkpoints and cubes
+        abandoned_step = get_redo_step(steps, parent_id)
+        if abandoned_step is not None:
+            remove_checkpoints(filepath, get_branch_chains(steps, abandoned_step['step_id']), keep_chain=new_chain)
+        # --- Cache the New Version & Profile It ---
+        if df_modified is not None:
+            _cache_upload_state(upload_id, _upload_version(new_doc), df_modified, new_row_hashes)
+        else:
+            df_modified, new_row_hashes = _load_upload_state(new_doc)
+            if df_modified is None: return jsonify({"error": "Failed to load data file."}), 500
+        stats = _get_upload_column_stats(new_doc, df_modified, row_hashes=new_row_hashes)
+        payload, fields = _cleaner_state_payload(new_doc, df_modified, stats, step["message"])
+        update_result = analysis_uploads_collection.update_one({"_id": oid, "active_step_id": step_id}, {"$set": fields})
+        log_db_update_result(update_result, session.get('username', 'N/A'), upload_id)
+        _schedule_aggregate_cube(current_app._get_current_object(), new_doc)
+        return jsonify(payload), 200
+    except ValueError as ve:
+        logging.warning(f"Cleaning action '{action}' rejected for {upload_id}: {ve}")
+        return jsonify({"error": str(ve)}), 400
+    except Exception as e:
+        logging.error(f"Error applying cleaning action '{action}' for {upload_id}: {e}", exc_info=True)
+        return jsonify({"error": "Server error applying cleaning action."}), 500
+    finally:
+        if staged_path is not None: discard_checkpoint(staged_path) # Step rejected or not recorded
+
+
+def _move_active_step(upload_id, direction):
+    """Shared logic of the undo/redo routes: moves the active-step pointer along the operation log."""
+    from ..extensions import db, analysis_uploads_collection
+    if not is_logged_in(): return jsonify({"error": "Authentication required."}), 401
+    if db is None or analysis_uploads_collection is None: return jsonify({"error": "Database unavailable."}), 503
+    try: oid = ObjectId(upload_id); user_id = ObjectId(session['user_id'])
+    except Exception as e: return jsonify({"error": f"Invalid ID: {e}"}), 400
+    upload_doc = analysis_uploads_collection.find_one({"_id": oid, "user_id": user_id})
+    if not upload_doc: return jsonify({"error": "Record not found."}), 404
+
+    steps = upload_doc.get('cleaning_steps', [])
+    current_step_id = upload_doc.get('active_step_id')
+    if direction == 'undo':
+        chain = get_step_chain(steps, current_step_id)
+        if not chain: return jsonify({"error": "Nothing to undo."}), 400
+        target_step_id = chain[-1].get('parent_id'); message = f"Undid: {chain[-1].get('message', chain[-1].get('action'))}"
+    else:
+        redo_step = get_redo_step(steps, current_step_id)
+        if redo_step is None: return jsonify({"error": "Nothing to redo."}), 400
+        target_step_id = redo_step['step_id']; message = f"Redid: {redo_step.get('message', redo_step.get('action'))}"
+
+    try:
+        new_doc = dict(upload_doc, active_step_id=target_step_id)
+        df, row_hashes = _load_upload_state(new_doc)
+        if df is None: return jsonify({"error": "Failed to load data file."}), 500
+        stats = _get_upload_column_stats(new_doc, df, row_hashes=row_hashes)
+        payload, fields = _cleaner_state_payload(new_doc, df, stats, message)
+        fields["active_step_id"] = target_step_id
+        update = {"$set": fields}
+        stale_results = _stale_analysis_results(upload_doc, _upload_version(new_doc))
+        if stale_results: update["$unset"] = stale_results
+        update_result = analysis_uploads_collection.update_one({"_id": oid, "active_step_id": current_step_id}, update)
+        log_db_update_result(update_result, session.get('username', 'N/A'), upload_id)
+        if update_result.matched_count == 0:
+            return jsonify({"error": "The dataset was modified concurrently. Please reload the page."}), 409
+        _schedule_aggregate_cube(current_app._get_current_object(), new_doc)
+        return jsonify(payload), 200
+    except Exception as e:
+        logging.error(f"Error during cleaning {direction} for {upload_id}: {e}", exc_info=True)
+        return jsonify({"error": f"Server error during {direction}."}), 500
+
+@bp.route('/cleaner/undo/<upload_id>', methods=['POST'])
+def undo_cleaning_step(upload_id):
+    """Moves the active dataset version back one cleaning step."""
+    return _move_active_step(upload_id, 'undo')
+
+@bp.route('/cleaner/redo/<upload_id>', methods=['POST'])
+def redo_cleaning_step(upload_id):
+    """Re-applies the most recently undone cleaning step."""
+    return _move_active_step(upload_id, 'redo')
+
+
+@bp.route('/cleaner/rows/<upload_id>')
+def get_preview_rows(upload_id):
+    """
+    Returns a window of rows of the active dataset version as column-oriented
+    arrays. Query params: offset, limit (max 1000), sort, dir ('asc'/'desc') and
+    filters (JSON list of {"column", "op", "value"}). Sort orders and filtered
+    row positions are cached per dataset version, so scrolling is just slicing.
+    """
+    from ..extensions import db, analysis_uploads_collection, dataframe_cache
+    if not is_logged_in(): return jsonify({"error": "Authentication required."}), 401
+    if db is None or analysis_uploads_collection is None: return jsonify({"error": "Database unavailable."}), 503
+    try: oid = ObjectId(upload_id); user_id = ObjectId(session['user_id'])
+    except Exception as e: return jsonify({"error": f"Invalid ID: {e}"}), 400
+    upload_doc = analysis_uploads_collection.find_one({"_id": oid, "user_id": user_id},
+                                                      {"filepath": 1, "cleaning_steps": 1, "active_step_id": 1, "status": 1})
+    if not upload_doc: return jsonify({"error": "Record not found."}), 404
+    if upload_doc.get('status') in ('queued', 'parsing', 'failed'): return jsonify({"error": f"Upload is not ready (status: {upload_doc.get('status')})."}), 409
+
+    try:
+        offset = int(request.args.get('offset', 0)); limit = int(request.args.get('limit', 100))
+        sort_by = request.args.get('sort') or None
+        ascending = request.args.get('dir', 'asc').lower() != 'desc'
+        filters = json.loads(request.args.get('filters') or '[]')
+        if not isinstance(filters, list): raise ValueError("filters must be a JSON list.")
+    except (TypeError, ValueError) as param_err:
+        return jsonify({"error": f"Invalid query parameters: {param_err}"}), 400
+
+    try:
+        df = _load_upload_dataframe(upload_doc)
+        if df is None: return jsonify({"error": "Failed to load data file."}), 500
+        version = _upload_version(upload_doc)
+        query_key = (upload_id, version, 'row_positions', sort_by, ascending, json.dumps(filters, sort_keys=True, default=str))
+        positions = dataframe_cache.get(query_key) if dataframe_cache is not None else None
+        if positions is None:
+            sort_order = None
+            if sort_by is not None:
+                sort_key = (upload_id, version, 'sort_order', sort_by, ascending)
+                sort_order = dataframe_cache.get(sort_key) if dataframe_cache is not None else None
+                if sort_order is None:
+                    sort_order = sorted_row_positions(df, sort_by, ascending)
+                    if dataframe_cache is not None: dataframe_cache.put(sort_key, sort_order, size_bytes=sort_order.nbytes)
+            positions = select_row_positions(df, sort_by, ascending, filters, sort_order=sort_order)
+            if dataframe_cache is not None: dataframe_cache.put(query_key, positions, size_bytes=positions.nbytes)
+        payload = row_window_payload(df, positions, offset=offset, limit=limit)
+        payload["version"] = version
+        return jsonify(payload), 200
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+    except Exception as e:
+        logging.error(f"Error serving preview rows for {upload_id}: {e}", exc_info=True)
+        return jsonify({"error": "Server error loading rows."}), 500
+
+@bp.route('/query/<upload_id>', methods=['POST'])
+def query_dataset(upload_id):
+    """
+    Runs a filter/select/aggregate query (see query_utils) on the active dataset
+    version and returns one page of the result as column-oriented arrays.
+    Body: {"where", "select", "group_by", "aggregates", "order_by", "offset", "limit"}.
+    Results are cached per dataset version and query, so paging only slices them.
+    """
+    from ..extensions import db, analysis_uploads_collection, dataframe_cache
+    if not is_logged_in(): return jsonify({"error": "Authentication required."}), 401
+    if db is None or analysis_uploads_collection is None: return jsonify({"error": "Database unavailable."}), 503
+    try: oid = ObjectId(upload_id); user_id = ObjectId(session['user_id'])
+    except Exception as e: return jsonify({"error": f"Invalid ID: {e}"}), 400
+    upload_doc = analysis_uploads_collection.find_one({"_id": oid, "user_id": user_id},
+                                                      {"filepath": 1, "cleaning_steps": 1, "active_step_id": 1, "status": 1})
+    if not upload_doc: return jsonify({"error": "Record not found."}), 404
+    if upload_doc.get('status') in ('queued', 'parsing', 'failed'): return jsonify({"error": f"Upload is not ready (status: {upload_doc.get('status')})."}), 409
+
+    data = request.get_json(silent=True) or {}
+    try:
+        offset = int(data.get('offset', 0)); limit = int(data.get('limit', 100))
+    except (TypeError, ValueError) as param_err:
+        return jsonify({"error": f"Invalid paging parameters: {param_err}"}), 400
+
+    try:
+        df = _load_upload_dataframe(upload_doc)
+        if df is None: return jsonify({"error": "Failed to load data file."}), 500
+        spec = normalize_query_spec(data, df.columns)
+        version = _upload_version(upload_doc)
+        result_key = (str(oid), version, 'query', get_query_key(version, spec))
+        cached = dataframe_cache.get(result_key) if dataframe_cache is not None else None
+        if cached is None:
+            result, plan = execute_query(df, spec)
+            logging.info(f"Query on {upload_id}: {plan['matched_rows']}/{plan['input_rows']} rows matched via {plan['engine'] or 'no filter'}, "
+                         f"{plan['result_rows']} result rows in {plan['elapsed_ms']} ms")
+            if dataframe_cache is not None: dataframe_cache.put(result_key, (result, plan), size_bytes=estimate_dataframe_bytes(result))
+        else:
+            result, plan = cached
+        payload = row_window_payload(result, np.arange(len(result), dtype=np.int64), offset=offset, limit=limit)
+        payload.update({"plan": plan, "query": spec, "version": version, "cached": cached is not None})
+        return jsonify(payload), 200
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+    except Exception as e:
+        logging.error(f"Error running query for {upload_id}: {e}", exc_info=True)
+        return jsonify({"error": "Server error running query."}), 500
+
+
+# --- Analysis, Plot & Insight Routes ---
 
 @bp.route('/analysis/run/<upload_id>/<analysis_type>', methods=['POST'])
 def run_analysis(upload_id, analysis_type):
-    from ..extensions import db, analysis_uploads_collection
-    # ... (Full logic: auth, db check, find doc, load df, run analysis type, update db, return results) ...
-    return jsonify({"message": f"Analysis '{analysis_type}' placeholder executed."})
+    """
+    Runs an analysis (descriptive_stats, correlation, value_counts, group_summary)
+    on the active dataset version. Results are memoized in analysis_results under
+    the dataset version plus a hash of the parameters, so a repeat request is
+    answered from the document without loading the data. Only the active
+    version's results are kept (see _stale_analysis_results).
+    """
+    from ..extensions import db, analysis_uploads_collection, process_pool
+    if not is_logged_in(): return jsonify({"error": "Authentication required."}), 401
+    if db is None or analysis_uploads_collection is None: return jsonify({"error": "Database unavailable."}), 503
+    if analysis_type not in ANALYSIS_TYPES: return jsonify({"error": f"Unsupported analysis type '{analysis_type}'."}), 400
+    try: oid = ObjectId(upload_id); user_id = ObjectId(session['user_id'])
+    except Exception as e: return jsonify({"error": f"Invalid ID: {e}"}), 400
+    upload_doc = analysis_uploads_collection.find_one({"_id": oid, "user_id": user_id})
+    if not upload_doc: return jsonify({"error": "Record not found."}), 404
+    if upload_doc.get('status') in ('queued', 'parsing', 'failed'): return jsonify({"error": f"Upload is not ready (status: {upload_doc.get('status')})."}), 409
+    filepath = upload_doc.get('filepath')
+    if not filepath or not os.path.exists(filepath): return jsonify({"error": "Data file missing on server."}), 404
+
+    data = request.get_json(silent=True) or {}
+    try:
+        # Column names come from the stored profile of the active version (no data load needed)
+        columns = [col.get('name') for col in upload_doc.get('column_info', [])]
+        params = normalize_analysis_params(analysis_type, data.get('params', data), columns)
+    except (TypeError, ValueError) as ve:
+        return jsonify({"error": str(ve)}), 400
+
+    version = _upload_version(upload_doc)
+    result_key = get_analysis_key(analysis_type, version, params)
+    stored = upload_doc.get('analysis_results', {}).get(result_key)
+    if stored is not None:
+        logging.info(f"Analysis '{analysis_type}' for {upload_id} served from memoized results ({result_key})")
+        return jsonify({"message": f"Analysis '{analysis_type}' complete (cached).", "results": stored.get('results'),
+                        "analysis_type": analysis_type, "params": params, "version": version, "cached": True}), 200
+
+    try:
+        results = None
+        if analysis_type == 'group_summary':
+            cube, cube_meta = _load_upload_cube(upload_doc)
+            results = group_summary_from_cube(cube, cube_meta, params) if cube is not None else None
+            if results is not None: logging.info(f"Group summary for {upload_id} answered from the aggregation cube")
+        if results is None and process_pool is not None:
+            results = run_in_process(process_pool, analysis_task, filepath, _upload_chain(upload_doc), analysis_type, params)
+        elif results is None:
+            df = _load_upload_dataframe(upload_doc)
+            if df is None: return jsonify({"error": "Failed to load data file."}), 500
+            results = compute_analysis(df, analysis_type, params)
+        entry = {"analysis_type": analysis_type, "version": version, "params": params,
+                 "results": results, "timestamp": datetime.utcnow()}
+        # Stored only while this version is still active; entries of other versions are dropped on the way
+        update = {"$set": {f"analysis_results.{result_key}": entry}}
+        stale_results = _stale_analysis_results(upload_doc, version)
+        if stale_results: update["$unset"] = stale_results
+        update_result = analysis_uploads_collection.update_one({"_id": oid, "active_step_id": upload_doc.get('active_step_id')}, update)
+        log_db_update_result(update_result, session.get('username', 'N/A'), upload_id)
+        return jsonify({"message": f"Analysis '{analysis_type}' complete.", "results": results,
+                        "analysis_type": analysis_type, "params": params, "version": version, "cached": False}), 200
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+    except Exception as e:
+        logging.error(f"Error running analysis '{analysis_type}' for {upload_id}: {e}", exc_info=True)
+        return jsonify({"error": "Server error running analysis."}), 500
 
 @bp.route('/plot/generate/<upload_id>', methods=['POST'])
 def generate_plot(upload_id):
-    from ..extensions import db, analysis_uploads_collection
-    # ... (Full logic: auth, db check, find doc, load df, get plot config, generate plotly fig, return JSON) ...
-    return jsonify({"message": "Plot generation placeholder executed."})
+    """
+    Builds a Plotly figure for the active dataset version. Data is reduced on the
+    server (downsampling, binning, grouping - see plot_utils) so the response
+    size does not grow with the row count.
+    """
+    from ..extensions import db, analysis_uploads_collection, process_pool, plot_cache
+    if not is_logged_in(): return jsonify({"error": "Authentication required."}), 401
+    if db is None or analysis_uploads_collection is None: return jsonify({"error": "Database unavailable."}), 503
+    try: oid = ObjectId(upload_id); user_id = ObjectId(session['user_id'])
+    except Exception as e: return jsonify({"error": f"Invalid ID: {e}"}), 400
+    upload_doc = analysis_uploads_collection.find_one({"_id": oid, "user_id": user_id})
+    if not upload_doc: return jsonify({"error": "Record not found."}), 404
+    if upload_doc.get('status') in ('queued', 'parsing', 'failed'): return jsonify({"error": f"Upload is not ready (status: {upload_doc.get('status')})."}), 409
+    filepath = upload_doc.get('filepath')
+    if not filepath or not os.path.exists(filepath): return jsonify({"error": "Data file missing on server."}), 404
+
+    data = request.get_json(silent=True) or {}
+    config = normalize_plot_config(data.get('chart_type'), data.get('x'), data.get('y'), data.get('color'))
+    chart_type, x, y, color = config['chart_type'], config['x'], config['y'], config['color']
+    if chart_type not in PLOT_TYPES: return jsonify({"error": f"Unsupported chart type '{chart_type}'."}), 400
+
+    # Figures are cached per dataset version + canonical config, so toggling between charts skips the rebuild
+    cache_key = get_plot_cache_key(str(oid), _upload_version(upload_doc), config)
+    cached_blob = plot_cache.get_compressed(cache_key) if plot_cache is not None else None
+    if cached_blob is not None:
+        logging.info(f"Plot '{chart_type}' for {upload_id} served from plot cache ({cache_key})")
+        return _gzip_json_response(cached_blob, cache_status='hit')
+
+    try:
+        cube_answer = None
+        if chart_type in CUBE_CHART_TYPES:
+            cube, cube_meta = _load_upload_cube(upload_doc)
+            cube_answer = build_plot_from_cube(cube, cube_meta, chart_type, x, y, color) if cube is not None else None
+        if cube_answer is not None:
+            figure, meta = cube_answer
+            plot_json = pio.to_json(figure)
+        elif process_pool is not None:
+            plot_json, meta = run_in_process(process_pool, plot_task, filepath, _upload_chain(upload_doc), chart_type, x, y, color)
+        else:
+            df = _load_upload_dataframe(upload_doc)
+            if df is None: return jsonify({"error": "Failed to load data file."}), 500
+            figure, meta = build_plot_figure(df, chart_type, x, y, color)
+            plot_json = pio.to_json(figure)
+        logging.info(f"Plot '{chart_type}' for {upload_id}: {meta.get('rows')} rows, reduction '{meta.get('reduction')}', {len(plot_json)} bytes")
+        body = json.dumps({"message": "Plot generated.", "plot_json": plot_json, "meta": meta}).encode('utf-8')
+        if plot_cache is None:
+            return current_app.response_class(body, status=200, mimetype='application/json')
+        return _gzip_json_response(plot_cache.put(cache_key, body), cache_status='miss')
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+    except Exception as e:
+        logging.error(f"Error generating '{chart_type}' plot for {upload_id}: {e}", exc_info=True)
+        return jsonify({"error": "Server error generating plot."}), 500
+
+def _gzip_json_response(blob, cache_status):
+    """Sends gzip-compressed JSON as stored (decompressing only for clients that do not accept gzip)."""
+    if request.accept_encodings['gzip']:
+        response = current_app.response_class(blob, status=200, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = current_app.response_class(gzip.decompress(blob), status=200, mimetype='application/json')
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['X-Plot-Cache'] = cache_status
+    return response
 
 @bp.route('/insights/generate/<upload_id>', methods=['POST'])
 def generate_insights(upload_id):
-    from ..extensions import db, analysis_uploads_collection, genai_model
-    # ... (Full logic: auth, service checks, find doc, generate prompt, call gemini, update db, return insights) ...
-    return jsonify({"message": "Insight generation placeholder executed."})
+    """Asks Gemini for insights on the upload's active version using a token-budgeted prompt."""
+    from ..extensions import db, analysis_uploads_collection, genai_model, safety_settings
+    if not is_logged_in(): return jsonify({"error": "Authentication required."}), 401
+    if db is None or analysis_uploads_collection is None: return jsonify({"error": "Database service unavailable."}), 503
+    if genai_model is None: return jsonify({"error": "AI service unavailable."}), 503
+    try: oid = ObjectId(upload_id); user_id = ObjectId(session['user_id'])
+    except Exception as e: return jsonify({"error": f"Invalid ID: {e}"}), 400
+    upload_doc = analysis_uploads_collection.find_one({"_id": oid, "user_id": user_id})
+    if not upload_doc: return jsonify({"error": "Record not found."}), 404
+    if upload_doc.get('status') in ('queued', 'parsing', 'failed'): return jsonify({"error": f"Upload is not ready (status: {upload_doc.get('status')})."}), 409
+
+    try:
+        df, row_hashes = _load_upload_state(upload_doc)
+        if df is None: return jsonify({"error": "Failed to load data file."}), 500
+        # Column stats (cached per version) add cardinality, which ranks columns for the prompt
+        stats = _get_upload_column_stats(upload_doc, df, row_hashes)
+        profile = {"row_count": len(df), "col_count": len(df.columns),
+                   "memory_usage": upload_doc.get('memory_usage', 'N/A'), "column_info": stats.get('columns', [])}
+        token_budget = current_app.config.get('INSIGHT_PROMPT_TOKEN_BUDGET', 6000)
+        prompt = generate_gemini_insight_prompt(profile, _upload_chain(upload_doc), df=df, token_budget=token_budget)
+        prompt_tokens = estimate_tokens(prompt)
+        logging.info(f"Requesting insights for {upload_id}: ~{prompt_tokens} prompt tokens ({len(df.columns)} columns)")
+
+        response = genai_model.generate_content(prompt, safety_settings=safety_settings)
+        log_gemini_response_details(response, f"insights_{upload_id}")
+        if response.candidates: insight_text = response.text or ""
+        elif hasattr(response, 'prompt_feedback'): return jsonify({"error": f"AI blocked the request: {response.prompt_feedback.block_reason.name}"}), 502
+        else: return jsonify({"error": "AI returned an empty response."}), 502
+        insights = parse_insight_response(insight_text)
+        if not insights: return jsonify({"error": "AI returned an empty response."}), 502
+
+        update_result = analysis_uploads_collection.update_one({"_id": oid}, {"$set": {
+            "generated_insights": insights, "insights_version": _upload_version(upload_doc),
+            "last_modified": datetime.utcnow()}})
+        log_db_update_result(update_result, session.get('username', 'N/A'), f"insights_{upload_id}")
+        return jsonify({"message": "Insights generated.", "insights": insights, "prompt_tokens": prompt_tokens})
+    except Exception as e:
+        logging.error(f"Error generating insights for {upload_id}: {e}", exc_info=True)
+        return jsonify({"error": "Server error generating insights."}), 500
 
 @bp.route('/download/<upload_id>/cleaned_data/<fileformat>')
 def download_cleaned_data(upload_id, fileformat):
@@ -248,6 +984,10 @@ def download_cleaned_data(upload_id, fileformat):
     except InvalidId: flash("Invalid identifier.", "danger"); return redirect(url_for('data.analysis_history'))
     except Exception as e: flash("Session/DB error finding record.", "warning"); logging.error(f"Error finding doc for download {upload_id}: {e}"); return redirect(url_for('data.analysis_history'))
 
+    if upload_doc.get('status') in ('queued', 'parsing', 'failed'):
+        flash(f"Upload is not ready (status: {upload_doc.get('status')}).", "warning")
+        return redirect(url_for('data.data_cleaner_page', upload_id=upload_id))
+
     # Check filepath
     filepath = upload_doc.get('filepath')
     if not filepath or not os.path.exists(filepath):
@@ -257,65 +997,90 @@ def download_cleaned_data(upload_id, fileformat):
 
     # Validate fileformat parameter
     fileformat_lower = fileformat.lower()
-    if fileformat_lower not in ['csv', 'xlsx']:
+    if fileformat_lower not in list(CSV_DOWNLOAD_FORMATS) + ['xlsx']:
         flash(f"Invalid download format requested: '{fileformat}'.", "warning")
         return redirect(url_for('data.data_cleaner_page', upload_id=upload_id))
 
     original_filename_base, _ = os.path.splitext(upload_doc.get('original_filename', f'analysis_{upload_id}'))
     download_filename = f"{original_filename_base}_cleaned.{fileformat_lower}"
-    mimetype = 'text/csv' if fileformat_lower == 'csv' else 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    chunk_rows = current_app.config.get('DOWNLOAD_CSV_CHUNK_ROWS', 50000)
 
-    # --- Generate File Content ---
-    try:
-        # Load the current dataframe state from the file specified in the DB doc
-        logging.info(f"Loading dataframe {filepath} for download as {fileformat_lower}")
-        df = get_dataframe(filepath) # Use your utility function
-        if df is None:
-            flash("Failed to load data file for download.", "danger")
-            logging.error(f"get_dataframe returned None for {filepath} during download.")
+    # --- Stream CSV Variants ---
+    # With a process pool the CSV is encoded (and compressed) there into a temp file and sent
+    # from disk like xlsx below; inline, rows are encoded one batch at a time while the response is sent
+    from ..extensions import process_pool, socketio
+    mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    if fileformat_lower in CSV_DOWNLOAD_FORMATS:
+        csv_format = CSV_DOWNLOAD_FORMATS[fileformat_lower]
+        mimetype = csv_format['mimetype']
+        try:
+            get_csv_compressor(csv_format['compression']) # Fails fast if the codec is unavailable
+            df = _load_upload_dataframe(upload_doc) if process_pool is None else None # Shared cache / memory-mapped sidecar
+        except ValueError as ve:
+            flash(str(ve), "warning"); return redirect(url_for('data.data_cleaner_page', upload_id=upload_id))
+        except Exception as e:
+            logging.error(f"Error preparing {fileformat_lower} download for {upload_id}: {e}", exc_info=True)
+            flash("An error occurred while generating the download file.", "danger")
             return redirect(url_for('data.data_cleaner_page', upload_id=upload_id))
+        if process_pool is None:
+            if df is None:
+                flash("Failed to load data file for download.", "danger")
+                return redirect(url_for('data.data_cleaner_page', upload_id=upload_id))
+            logging.info(f"Streaming '{download_filename}' (Shape: {df.shape}) for {session.get('username')}")
+            response = current_app.response_class(iter_csv_chunks(df, csv_format['compression'], chunk_rows), mimetype=mimetype)
+            response.headers["Content-Disposition"] = f"attachment; filename=\"{download_filename}\""
+            return response
 
-        # Prepare buffer in memory
-        buffer = io.BytesIO()
-        logging.info(f"Writing dataframe (Shape: {df.shape}) to {fileformat_lower} buffer...")
-
-        if fileformat_lower == 'csv':
-            # Use utf-8-sig for better Excel compatibility with CSVs
-            df.to_csv(buffer, index=False, encoding='utf-8-sig')
-            logging.info("CSV buffer created.")
-        elif fileformat_lower == 'xlsx':
-            # --- XLSX Specific Logic ---
-            # Ensure 'openpyxl' engine is installed: pip install openpyxl
-            try:
-                with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                    df.to_excel(writer, index=False, sheet_name='Cleaned_Data')
-                # Buffer is populated after 'with' block exits
-                logging.info("XLSX buffer created successfully using openpyxl.")
-            except ImportError:
-                 logging.error("Excel generation failed: 'openpyxl' library not found. Please install it (`pip install openpyxl`).")
-                 flash("Server configuration error: Cannot generate Excel file.", "danger")
-                 return redirect(url_for('data.data_cleaner_page', upload_id=upload_id))
-            except Exception as excel_err:
-                 # Catch other potential errors during Excel writing
-                 logging.error(f"Error writing XLSX buffer for {upload_id}: {excel_err}", exc_info=True)
-                 flash("An error occurred while generating the Excel file.", "danger")
-                 return redirect(url_for('data.data_cleaner_page', upload_id=upload_id))
-            # --- End XLSX Logic ---
-
-        buffer.seek(0) # IMPORTANT: Rewind buffer to the beginning before sending
+    # --- Generate File Content ---
+    # The workbook is written row by row (write-only mode) to a temp file and sent from disk.
+    # Progress goes to the upload's job room on /data_jobs as 'export_progress' events (xlsx only).
+    is_xlsx = fileformat_lower == 'xlsx'
+    def report_progress(progress):
+        if socketio is not None and is_xlsx and progress:
+            emit_job_event(socketio, upload_id, 'export_progress', dict(progress, format=fileformat_lower))
+
+    fd, tmp_path = tempfile.mkstemp(suffix=f".{fileformat_lower}", dir=current_app.config['ANALYSIS_UPLOAD_FOLDER'])
+    os.close(fd)
+    progress_path = f"{tmp_path}.progress"
+    try:
+        try:
+            if process_pool is not None:
+                logging.info(f"Writing {fileformat_lower} download for {upload_id} in process pool")
+                run_in_process(process_pool, write_download_task, filepath, fileformat_lower, tmp_path,
+                               chain=_upload_chain(upload_doc), progress_path=progress_path if is_xlsx else None,
+                               chunk_rows=chunk_rows,
+                               on_poll=lambda: report_progress(read_progress_file(progress_path)))
+            else:
+                # Load the current dataframe state from the file specified in the DB doc
+                logging.info(f"Loading dataframe {filepath} for download as {fileformat_lower}")
+                df = _load_upload_dataframe(upload_doc) # Shared cache, falls back to disk
+                if df is None:
+                    flash("Failed to load data file for download.", "danger")
+                    logging.error(f"get_dataframe returned None for {filepath} during download.")
+                    os.remove(tmp_path)
+                    return redirect(url_for('data.data_cleaner_page', upload_id=upload_id))
+                logging.info(f"Writing dataframe (Shape: {df.shape}) to {fileformat_lower} file...")
+                write_xlsx_streaming(df, tmp_path, progress_callback=lambda rows, total, sheets: report_progress(
+                    {"rows_written": rows, "total_rows": total, "sheets": sheets}))
+        except Exception:
+            os.remove(tmp_path)
+            if socketio is not None and is_xlsx: emit_job_event(socketio, upload_id, 'export_complete', {"format": fileformat_lower, "error": "Export failed."})
+            raise
+        finally:
+            if os.path.exists(progress_path): os.remove(progress_path)
+        if socketio is not None and is_xlsx: emit_job_event(socketio, upload_id, 'export_complete', {"format": fileformat_lower})
+        response = make_response(send_file(tmp_path, mimetype=mimetype, download_name=download_filename, as_attachment=True))
+        response.call_on_close(lambda: os.path.exists(tmp_path) and os.remove(tmp_path))
 
         logging.info(f"Initiating download '{download_filename}' for {session.get('username')}")
-        # Use make_response to set headers correctly
-        response = make_response(send_file(
-            buffer,
-            mimetype=mimetype,
-            download_name=download_filename, # Suggest filename to browser
-            as_attachment=True # Force download dialog
-        ))
         # Ensure Content-Disposition is set robustly
         response.headers["Content-Disposition"] = f"attachment; filename=\"{download_filename}\""
         return response
 
+    except ImportError:
+        logging.error("Excel generation failed: 'openpyxl' library not found. Please install it (`pip install openpyxl`).")
+        flash("Server configuration error: Cannot generate Excel file.", "danger")
+        return redirect(url_for('data.data_cleaner_page', upload_id=upload_id))
     except Exception as e:
         # Catch errors during dataframe loading or file writing
         logging.error(f"Error preparing/sending cleaned data download for {upload_id} as {fileformat}: {e}", exc_info=True)
@@ -384,7 +1149,7 @@ def download_pdf_report(upload_id):
 
         # Section 2: Cleaning Steps
         pdf.chapter_title('2. Cleaning Steps Applied')
-        steps = upload_doc.get('cleaning_steps', [])
+        steps = get_step_chain(upload_doc.get('cleaning_steps', []), upload_doc.get('active_step_id')) # Active steps only (undone ones excluded)
         if steps:
             step_text_lines = []
             for i, step in enumerate(steps):
@@ -403,12 +1168,17 @@ def download_pdf_report(upload_id):
 
         # Section 3: Analysis Results
         pdf.chapter_title('3. Analysis Results')
-        analysis = upload_doc.get('analysis_results', {})
+        # Only results memoized for the current dataset version describe the data in this report
+        current_version = _upload_version(upload_doc) if os.path.exists(upload_doc.get('filepath', '')) else None
+        analysis = [entry for entry in upload_doc.get('analysis_results', {}).values()
+                    if isinstance(entry, dict) and entry.get('version') == current_version]
         if analysis:
-            for name, data in analysis.items():
-                 analysis_name_nice = name.replace('_',' ').title()
-                 pdf.add_json_block(analysis_name_nice, data) # Use helper method
-        else: pdf.chapter_body("No analysis results found.")
+            for entry in analysis:
+                 analysis_name_nice = entry.get('analysis_type', 'analysis').replace('_',' ').title()
+                 param_text = ", ".join(f"{k}={v}" for k, v in entry.get('params', {}).items() if v not in (None, [], ''))
+                 if param_text: analysis_name_nice += f" ({param_text})"
+                 pdf.add_json_block(analysis_name_nice, entry.get('results')) # Use helper method
+        else: pdf.chapter_body("No analysis results found for the current dataset version.")
 
         # Section 4: Visualizations Placeholder
         pdf.chapter_title('4. Visualizations')
@@ -451,6 +1221,14 @@ def download_pdf_report(upload_id):
         # Redirect back to the cleaner page where the button was clicked
         return redirect(url_for('data.data_cleaner_page', upload_id=upload_id))
 
+@bp.route('/cache/stats')
+def dataframe_cache_stats():
+    """Returns hit/miss counters and memory usage of the shared DataFrame cache."""
+    from ..extensions import dataframe_cache
+    if not is_logged_in(): return jsonify({"error": "Authentication required."}), 401
+    if dataframe_cache is None: return jsonify({"error": "DataFrame cache not initialized."}), 503
+    return jsonify(dataframe_cache.stats()), 200
+
 @bp.route('/history') # Route is '/data/history' due to blueprint prefix
 def analysis_history():
     # --- Access extensions INSIDE function ---
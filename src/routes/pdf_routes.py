@@ -14,12 +14,37 @@ from bson.errors import InvalidId
 # --- Import Utils ---
 from ..utils.auth_utils import is_logged_in
 from ..utils.file_utils import allowed_file, get_secure_filename
-from ..utils.pdf_utils import extract_text_from_pdf
+from ..utils.db_utils import log_db_update_result
+from ..utils.pdf_utils import extract_pdf_pages, get_pages_path, read_pdf_text, store_pdf_chunks, delete_pdf_chunks
+from ..utils.retrieval_utils import build_bm25_index_task
+from ..utils.embedding_utils import build_embedding_index_task, embedder_settings, get_embedding_index_files
+from ..utils.storage_utils import store_upload_stream
+from ..utils.executor_utils import run_in_process
 
 # Create Blueprint
 bp = Blueprint('pdf', __name__)
 
 
+# --- Helpers ---
+
+def _cleanup_failed_upload(stored, analysis_id=None, index_paths=()):
+    """
+    Removes the partial record and its text chunks, plus the stored PDF, its pages
+    file and the retrieval index files built for it, but only bytes this request stored.
+    """
+    from ..extensions import pdf_analysis_collection, pdf_text_chunks_collection
+    if analysis_id is not None:
+        try:
+            delete_pdf_chunks(pdf_text_chunks_collection, analysis_id)
+            pdf_analysis_collection.delete_one({"_id": analysis_id})
+        except Exception as rm_err: logging.error(f"Failed to remove partial PDF record {analysis_id}: {rm_err}")
+    if not stored or stored['reused']: return
+    for path in (stored['path'], get_pages_path(stored['path']), *index_paths):
+        if os.path.exists(path):
+            try: os.remove(path); logging.info(f"Cleaned up failed PDF upload: {path}")
+            except OSError as rm_err: logging.error(f"Failed to cleanup file: {path}. Error: {rm_err}")
+
+
 # --- Routes ---
 
 @bp.route('/analyzer')
@@ -65,11 +90,11 @@ def pdf_analyzer_page():
 def upload_pdf():
     """Handles PDF file uploads, extracts text, and saves metadata."""
     # --- Access extensions INSIDE function ---
-    from ..extensions import db, pdf_analysis_collection
+    from ..extensions import db, pdf_analysis_collection, pdf_text_chunks_collection, process_pool
 
     # Auth & Service Checks
     if not is_logged_in(): return jsonify({"error": "Authentication required."}), 401
-    if db is None or pdf_analysis_collection is None:
+    if db is None or pdf_analysis_collection is None or pdf_text_chunks_collection is None:
         logging.error("PDF upload failed: DB service/collection unavailable.")
         return jsonify({"error": "Database service unavailable."}), 503
 
@@ -82,7 +107,6 @@ def upload_pdf():
          return jsonify({"error": f"Invalid file type. Allowed: {allowed_str}"}), 400
 
     # --- Process File ---
-    filepath = None # Define for potential cleanup
     try:
         user_id = ObjectId(session['user_id'])
         username = session.get('username', 'Unknown')
@@ -91,34 +115,35 @@ def upload_pdf():
         return jsonify({"error": "Invalid session. Please log in again."}), 401
 
     original_filename = get_secure_filename(file.filename)
-    ts = datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
-    stored_filename = f"{user_id}_{ts}_{original_filename}"
     upload_dir = current_app.config['UPLOAD_FOLDER']
-    filepath = os.path.join(upload_dir, stored_filename)
-    logging.info(f"Attempting to save PDF upload to: {filepath}")
+    stored = None; analysis_id = None
+    index_paths = [] # Retrieval index files built by this request
+    logging.info(f"Attempting to store PDF upload '{original_filename}' in {upload_dir}")
 
     try:
-        # Save file
-        file.save(filepath)
+        # Save file (content-addressed: identical bytes are stored once)
+        stored = store_upload_stream(file.stream, upload_dir, '.pdf')
+        filepath = stored['path']
+        stored_filename = os.path.relpath(filepath, upload_dir)
         logging.info(f"PDF saved successfully: {filepath}")
 
-        # Extract text
+        # Extract text: page ranges run in parallel worker processes and are written out page by
+        # page next to the stored PDF (an identical earlier upload's pages file is reused as is)
         logging.info(f"Extracting text from PDF: {filepath}")
-        extracted_text, page_count = extract_text_from_pdf(filepath) # Use util function
-
-        if extracted_text is None: # Check if extraction failed
-            # pdf_utils already logged the specific error
-            raise ValueError("Failed to extract text from the uploaded PDF.")
+        pages_path, page_count = extract_pdf_pages(filepath, pool=process_pool,
+                                                   range_size=current_app.config.get('PDF_EXTRACT_PAGE_RANGE', 50))
+        extracted_text = read_pdf_text(pages_path, max_chars=3000) # Only the pages the preview needs
 
-        # Prepare DB document
+        # Prepare DB document (the full text is stored separately, as chunks)
         now = datetime.utcnow()
         doc = {
             "user_id": user_id, "username": username,
             "original_filename": original_filename, "stored_filename": stored_filename,
-            "filepath": filepath, "page_count": page_count, "upload_timestamp": now,
-            "extracted_text_preview": extracted_text[:2000], # Store preview
-            "full_text_extracted": True, # Mark as extracted
-            "analysis_status": "extracted", "last_modified": now
+            "filepath": filepath, "content_sha256": stored['sha256'], "file_size": stored['size'],
+            "page_count": page_count, "upload_timestamp": now,
+            "extracted_text_preview": extracted_text[:2000], # Short preview for listings
+            "full_text_extracted": False, # Set once all chunks are stored
+            "analysis_status": "extracting", "last_modified": now
         }
 
         logging.info(f"Inserting PDF analysis record into DB for {username}")
@@ -127,24 +152,55 @@ def upload_pdf():
         analysis_id = analysis_insert_result.inserted_id
         logging.info(f"PDF record created successfully. ID: {analysis_id}")
 
+        # Store the full text as page-aligned chunks
+        chunk_target_chars = current_app.config.get('PDF_CHUNK_TARGET_CHARS', 4000)
+        try:
+            chunk_count, text_length = store_pdf_chunks(pdf_text_chunks_collection, analysis_id, pages_path, chunk_target_chars)
+        except Exception as chunk_err:
+            logging.error(f"Storing text chunks failed for PDF {analysis_id}: {chunk_err}", exc_info=True)
+            raise ValueError("Failed to store the extracted PDF text.")
+
+        # BM25 index over the same chunks for chat retrieval (optional: chat falls back to the leading text)
+        try:
+            bm25_index_path = run_in_process(process_pool, build_bm25_index_task, pages_path, chunk_target_chars)
+            index_paths.append(bm25_index_path)
+        except Exception as index_err:
+            logging.warning(f"BM25 index build failed for PDF {analysis_id}: {index_err}", exc_info=True)
+            bm25_index_path = None
+        # Chunk embeddings for the embedding retrieval mode (optional as well: chat falls back to BM25)
+        embedding_index_path = None
+        if current_app.config.get('PDF_CHAT_RETRIEVAL') == 'embedding':
+            embedder_name, embedder_options = embedder_settings(current_app.config)
+            try:
+                embedding_index_path = run_in_process(process_pool, build_embedding_index_task, pages_path, chunk_target_chars,
+                                                      embedder_name, embedder_options,
+                                                      current_app.config.get('PDF_EMBEDDING_IVF_MIN_ROWS', 4096))
+                index_paths.extend(get_embedding_index_files(embedding_index_path))
+            except Exception as index_err:
+                logging.warning(f"Embedding index build failed for PDF {analysis_id}: {index_err}", exc_info=True)
+        update_result = pdf_analysis_collection.update_one(
+            {"_id": analysis_id},
+            {"$set": {"full_text_extracted": True, "chunk_count": chunk_count, "text_length": text_length,
+                      "bm25_index_path": bm25_index_path, "embedding_index_path": embedding_index_path,
+                      "analysis_status": "extracted", "last_modified": datetime.utcnow()}})
+        log_db_update_result(update_result, username, f"pdf_{analysis_id}")
+        logging.info(f"Stored {chunk_count} text chunks ({text_length} chars) for PDF {analysis_id}")
+
         # Return success response for frontend
         return jsonify({
             "message": "PDF uploaded and text extracted successfully.",
             "analysis_id": str(analysis_id),
             "filename": original_filename,
+            "page_count": page_count, "chunk_count": chunk_count,
             "text_preview": extracted_text[:3000] # Send preview for context
             }), 200
 
     except ValueError as ve: # Catch specific errors like text extraction failure
          logging.error(f"Value error during PDF upload/processing for {username}: {ve}")
-         if filepath and os.path.exists(filepath): # Cleanup
-             try: os.remove(filepath); logging.info(f"Cleaned up failed PDF upload: {filepath}")
-             except OSError as rm_err: logging.error(f"Failed to cleanup file: {filepath}. Error: {rm_err}")
+         _cleanup_failed_upload(stored, analysis_id, index_paths)
          return jsonify({"error": str(ve)}), 500 # Return 500 for server-side processing issues
 
     except Exception as e: # Catch general errors
         logging.error(f"Unexpected error during PDF upload for {username}: {e}", exc_info=True)
-        if filepath and os.path.exists(filepath): # Cleanup
-            try: os.remove(filepath); logging.info(f"Cleaned up failed PDF upload: {filepath}")
-            except OSError as rm_err: logging.error(f"Failed to cleanup file: {filepath}. Error: {rm_err}")
+        _cleanup_failed_upload(stored, analysis_id, index_paths)
         return jsonify({"error": "An unexpected server error occurred processing the PDF."}), 500
\ No newline at end of file
@@ -0,0 +1,84 @@
+# src/sockets/data_job_handlers.py
+
+import logging
+from flask import request, session
+from flask_socketio import emit, join_room, leave_room
+from bson import ObjectId
+
+# --- Relative Imports ---
+# --- DO NOT import specific collections or initialized models here ---
+
+# --- Import Utils ---
+from ..utils.auth_utils import is_logged_in
+
+# --- Background Job Events ---
+# Upload jobs (see data_analyzer_routes) report to room 'job_<job_id>' on this namespace:
+#   job_progress: {"job_id", "status", "message", ["rows_processed"]}
+#   job_complete: {"job_id", "status": "profiled"|"failed", ...}
+JOB_NAMESPACE = '/data_jobs'
+JOB_FINAL_STATUSES = ('profiled', 'failed')
+
+def job_room(job_id):
+    return f"job_{job_id}"
+
+def emit_job_event(socketio_instance, job_id, event, payload):
+    """Emits a job event to everyone subscribed to the job (safe outside a request context)."""
+    try:
+        socketio_instance.emit(event, dict(payload, job_id=str(job_id)), room=job_room(job_id), namespace=JOB_NAMESPACE)
+    except Exception as emit_err:
+        logging.warning(f"Failed to emit '{event}' for job {job_id}: {emit_err}")
+
+def job_status_payload(upload_doc):
+    """Client-facing summary of an upload job from its analysis_uploads document."""
+    payload = {"job_id": str(upload_doc['_id']), "upload_id": str(upload_doc['_id']),
+               "status": upload_doc.get('status'), "filename": upload_doc.get('original_filename')}
+    if upload_doc.get('status') == 'profiled':
+        payload.update({"rows": upload_doc.get('row_count', 0), "columns": upload_doc.get('col_count', 0)})
+    elif upload_doc.get('status') == 'failed':
+        payload["error"] = upload_doc.get('error_message', 'Processing failed.')
+    return payload
+
+
+# Registration function - socketio instance is passed in
+def register_data_job_handlers(socketio_instance):
+
+    # == Data Jobs Namespace (/data_jobs) ==
+    @socketio_instance.on('connect', namespace=JOB_NAMESPACE)
+    def handle_data_jobs_connect():
+        if not is_logged_in(): return False # Reject unauthenticated
+        logging.info(f"User '{session.get('username', 'Unknown')}' connected to {JOB_NAMESPACE}. SID: {request.sid}")
+
+    @socketio_instance.on('disconnect', namespace=JOB_NAMESPACE)
+    def handle_data_jobs_disconnect():
+        logging.info(f"User '{session.get('username', 'Unknown')}' disconnected from {JOB_NAMESPACE}. SID: {request.sid}")
+
+    @socketio_instance.on('subscribe_job', namespace=JOB_NAMESPACE)
+    def handle_subscribe_job(data):
+        # --- Access extensions INSIDE handler ---
+        from ..extensions import db, analysis_uploads_collection
+
+        sid = request.sid
+        if not is_logged_in(): emit('error', {'message': 'Auth required.'}, room=sid, namespace=JOB_NAMESPACE); return
+        if db is None or analysis_uploads_collection is None:
+            emit('error', {'message': 'Database service unavailable.'}, room=sid, namespace=JOB_NAMESPACE); return
+        job_id_str = data.get('job_id') if isinstance(data, dict) else None
+        try: job_id = ObjectId(job_id_str); user_id = ObjectId(session.get('user_id'))
+        except Exception: emit('error', {'message': 'Invalid job ID.'}, room=sid, namespace=JOB_NAMESPACE); return
+
+        upload_doc = analysis_uploads_collection.find_one(
+            {"_id": job_id, "user_id": user_id},
+            {"status": 1, "original_filename": 1, "row_count": 1, "col_count": 1, "error_message": 1}
+        )
+        if not upload_doc: emit('error', {'message': 'Job not found.'}, room=sid, namespace=JOB_NAMESPACE); return
+
+        join_room(job_room(job_id_str))
+        logging.debug(f"SID {sid} subscribed to job {job_id_str}")
+        # The job may have progressed (or finished) before the client subscribed, so report the current state
+        payload = job_status_payload(upload_doc)
+        event = 'job_complete' if payload['status'] in JOB_FINAL_STATUSES else 'job_progress'
+        emit(event, payload, room=sid, namespace=JOB_NAMESPACE)
+
+    @socketio_instance.on('unsubscribe_job', namespace=JOB_NAMESPACE)
+    def handle_unsubscribe_job(data):
+        job_id_str = data.get('job_id') if isinstance(data, dict) else None
+        if job_id_str: leave_room(job_room(job_id_str))
@@ -1,7 +1,8 @@
 # src/sockets/pdf_chat_handlers.py
 
 import logging
-from flask import request, session
+import os
+from flask import request, session, current_app
 from flask_socketio import emit
 from datetime import datetime
 from bson import ObjectId
@@ -16,6 +17,8 @@ import traceback
 from ..utils.auth_utils import is_logged_in
 from ..utils.api_utils import log_gemini_response_details
 from ..utils.db_utils import log_db_update_result
+from ..utils.retrieval_utils import build_chat_context
+from ..utils.embedding_utils import get_embedder, embedder_settings, embedding_search_fn, embedding_index_matches
 
 
 # Registration function - socketio instance is passed in
@@ -37,7 +40,7 @@ def register_pdf_chat_handlers(socketio_instance):
     def handle_pdf_chat_message(data):
         # --- Access extensions INSIDE handler ---
         from ..extensions import (db, genai_model, safety_settings,
-                                 pdf_analysis_collection, pdf_chats_collection)
+                                 pdf_analysis_collection, pdf_chats_collection, pdf_text_chunks_collection)
 
         sid = request.sid
         logging.debug(f"--- PDF Chat Msg START (SID:{sid}) ---")
@@ -62,12 +65,31 @@ def register_pdf_chat_handlers(socketio_instance):
         try:
              # Use locally accessed collection
              pdf_doc = pdf_analysis_collection.find_one(
-                 {"_id": analysis_id, "user_id": user_id}, {"extracted_text_preview": 1}
+                 {"_id": analysis_id, "user_id": user_id}, {"extracted_text_preview": 1, "chunk_count": 1, "bm25_index_path": 1, "embedding_index_path": 1}
              )
              if not pdf_doc:
                   logging.error(f"PDF doc {analysis_id} not found/access denied for user {user_id}.")
                   emit('error', {'message': 'PDF context error.'}, room=sid, namespace='/pdf_chat'); return
-             pdf_text_context = pdf_doc.get("extracted_text_preview", "")
+             # Chunks relevant to this question (BM25 over the stored chunks); older records only have the preview
+             if pdf_doc.get("chunk_count") and pdf_text_chunks_collection is not None:
+                 search_fn = None # BM25
+                 embedding_index_path = pdf_doc.get("embedding_index_path")
+                 if current_app.config.get('PDF_CHAT_RETRIEVAL') == 'embedding' and embedding_index_path and os.path.exists(embedding_index_path):
+                     embedder_name, embedder_options = embedder_settings(current_app.config)
+                     embedder = get_embedder(embedder_name, **embedder_options)
+                     # An index built by another embedder (PDF_EMBEDDER/model/dim changed since upload) is a different vector space
+                     if embedding_index_matches(embedding_index_path, embedder):
+                         search_fn = embedding_search_fn(embedding_index_path, embedder,
+                                                         nprobe=current_app.config.get('PDF_EMBEDDING_IVF_NPROBE', 8))
+                     else:
+                         logging.info(f"(PDF Chat SID:{sid}) Embedding index of {analysis_id} is not from embedder '{embedder.key}'; using BM25.")
+                 pdf_text_context, hits = build_chat_context(
+                     pdf_text_chunks_collection, analysis_id, user_message, index_path=pdf_doc.get("bm25_index_path"),
+                     top_k=current_app.config.get('PDF_CHAT_TOP_K', 8),
+                     max_tokens=current_app.config.get('PDF_CHAT_CONTEXT_TOKENS', 3000), search_fn=search_fn)
+                 logging.debug(f"(PDF Chat SID:{sid}) Context chunks for analysis {analysis_id}: {[hit['chunk_index'] for hit in hits] or 'leading text'}")
+             else:
+                 pdf_text_context = pdf_doc.get("extracted_text_preview", "")
         except Exception as e:
              logging.error(f"Error fetching PDF doc {analysis_id}: {e}", exc_info=True)
              emit('error', {'message': 'Error retrieving PDF context.'}, room=sid, namespace='/pdf_chat'); return
@@ -161,36 +161,93 @@ document.addEventListener('DOMContentLoaded', () => {
         }
 
         // --- Handle Response based on Status and Content ---
-        if (response.ok && resultJson && resultJson.upload_id) {
-            // --- SUCCESS CASE ---
-            console.log('[Data Analyzer Upload] Upload successful. Preparing redirect...');
-            const redirectId = resultJson.upload_id;
-            const redirectUrl = `/data/cleaner/${redirectId}`; // CORRECT Redirect URL with '/data' prefix
-
-            console.log(`[Data Analyzer Upload] Redirecting to: ${redirectUrl}`);
-
-            // Provide success feedback before redirecting
-            const successMsg = `Success! File '${resultJson.filename || originalFileName}' uploaded (${resultJson.rows} rows, ${resultJson.columns} columns). Redirecting to cleaner...`;
-            displayFeedback(successMsg, false, false); // Show non-error, non-dismissing message
+        if (response.status === 202 && resultJson && resultJson.job_id) {
+            // --- QUEUED CASE: parsing/profiling continues in a background job ---
+            console.log('[Data Analyzer Upload] Upload queued as job:', resultJson.job_id);
+            displayFeedback(`File '${resultJson.filename || originalFileName}' uploaded. Processing...`, false, false);
+            watchUploadJob(resultJson.job_id, originalFileName);
 
-            // Delay redirect slightly so user can see success message (optional)
-            setTimeout(() => {
-                window.location.href = redirectUrl; // Perform the redirect
-            }, 1500); // 1.5 second delay
+        } else if (response.ok && resultJson && resultJson.upload_id) {
+            // --- SUCCESS CASE ---
+            redirectToCleaner(resultJson, originalFileName);
 
         } else {
             // --- ERROR CASE (HTTP error or JSON missing expected fields) ---
             const errorMessage = resultJson?.error || // Prefer specific error from JSON
                                  `Upload failed (Status: ${response.status}). Please try again.`;
-            console.error("[Data Analyzer Upload] Upload failed:", errorMessage, resultJson);
-            displayFeedback(`Error: ${errorMessage}`, true); // Display error message
-            showLoading(false); // Hide loading
-            uploadButton.disabled = false; // Re-enable upload button
-            fileInput.value = ''; // Clear file input on failed upload
+            showUploadError(errorMessage, resultJson);
         }
     } // --- End processUploadResponse ---
 
 
+    // --- Background Job Tracking ---
+
+    /** Follows a queued upload job over Socket.IO (/data_jobs), falling back to polling */
+    function watchUploadJob(jobId, originalFileName) {
+        let finished = false;
+        const onComplete = (payload) => {
+            if (finished) return;
+            finished = true;
+            if (jobSocket) jobSocket.disconnect();
+            if (payload.status === 'profiled') {
+                redirectToCleaner(payload, originalFileName);
+            } else {
+                showUploadError(payload.error || 'Processing failed.', payload);
+            }
+        };
+
+        let jobSocket = null;
+        if (typeof io === 'function') {
+            jobSocket = io('/data_jobs', { transports: ['websocket', 'polling'] });
+            jobSocket.on('connect', () => jobSocket.emit('subscribe_job', { job_id: jobId }));
+            jobSocket.on('job_progress', (payload) => {
+                console.log('[Data Analyzer Upload] Job progress:', payload);
+                if (!finished) displayFeedback(payload.message || `Status: ${payload.status}`, false, false);
+            });
+            jobSocket.on('job_complete', onComplete);
+            jobSocket.on('error', (err) => console.warn('[Data Analyzer Upload] Job socket error:', err));
+        } else {
+            console.warn('[Data Analyzer Upload] Socket.IO client not loaded. Polling job status.');
+        }
+
+        // Polling fallback (also covers a dropped socket connection)
+        const poll = async () => {
+            if (finished) return;
+            try {
+                const res = await fetch(`/data/analyzer/job/${jobId}`);
+                const payload = await res.json();
+                if (res.ok && (payload.status === 'profiled' || payload.status === 'failed')) { onComplete(payload); return; }
+                if (!res.ok) { onComplete({ status: 'failed', error: payload.error }); return; }
+            } catch (pollError) {
+                console.warn('[Data Analyzer Upload] Job status poll failed:', pollError);
+            }
+            setTimeout(poll, 5000);
+        };
+        setTimeout(poll, 5000);
+    }
+
+    /** Shows the success message and redirects to the cleaner page */
+    function redirectToCleaner(result, originalFileName) {
+        const redirectUrl = `/data/cleaner/${result.upload_id}`; // CORRECT Redirect URL with '/data' prefix
+        console.log(`[Data Analyzer Upload] Redirecting to: ${redirectUrl}`);
+        const successMsg = `Success! File '${result.filename || originalFileName}' processed (${result.rows} rows, ${result.columns} columns). Redirecting to cleaner...`;
+        displayFeedback(successMsg, false, false); // Show non-error, non-dismissing message
+        // Delay redirect slightly so user can see success message (optional)
+        setTimeout(() => {
+            window.location.href = redirectUrl; // Perform the redirect
+        }, 1500); // 1.5 second delay
+    }
+
+    /** Shows an upload/processing error and resets the form */
+    function showUploadError(errorMessage, details) {
+        console.error("[Data Analyzer Upload] Upload failed:", errorMessage, details);
+        displayFeedback(`Error: ${errorMessage}`, true); // Display error message
+        showLoading(false); // Hide loading
+        uploadButton.disabled = false; // Re-enable upload button
+        fileInput.value = ''; // Clear file input on failed upload
+    }
+
+
     // --- Helper UI Functions (Defined INSIDE DOMContentLoaded) ---
 
     /** Displays loading indicator and disables button */
@@ -158,26 +158,25 @@ document.addEventListener('DOMContentLoaded', () => {
         console.log("initializeTable called."); // Debug init table
         if (tableDiv && previewData && previewData.length >= 0) { // Allow empty data init
              showLoading('previewLoading', true);
-             const tableColumns = columnInfo.map(col => ({
-                 title: col.name, field: col.name, headerFilter: "input",
-                 minWidth: 100, sorter: inferTabulatorSorter(col.dtype),
-                 formatter: "plaintext", tooltip: true,
-                 headerTooltip: `Type: ${col.dtype}\nNulls: ${col.null_count}`
-             }));
+             const tableColumns = buildTableColumns();
             console.log("Tabulator columns config:", tableColumns); // Debug columns config
 
             try {
+                 // Rows are fetched in windows from the server as the user scrolls;
+                 // sorting and header filters are applied server-side on the full dataset
                  tabulatorTable = new Tabulator(tableDiv, {
-                     data: previewData,
+                     ajaxURL: `/data/cleaner/rows/${uploadId}`,
+                     ajaxURLGenerator: buildRowsUrl,
+                     ajaxResponse: rowsResponseToTabulator,
+                     progressiveLoad: "scroll", paginationSize: ROWS_PAGE_SIZE,
+                     sortMode: "remote", filterMode: "remote",
                      columns: tableColumns,
-                     layout: "fitDataStretch", pagination: "local", paginationSize: 10,
-                     paginationSizeSelector: [10, 25, 50, 100], movableColumns: true,
+                     layout: "fitDataStretch", movableColumns: true,
                      height: "400px", placeholder: "No Data Available",
-                     langs: { "default": { "pagination": { "page_size": "Rows/Page", "first": "First", "first_title": "First Page", "last": "Last", "last_title": "Last Page", "prev": "Prev", "prev_title": "Previous Page", "next": "Next", "next_title": "Next Page" } } },
-                     tableBuilt: function(){
-                         console.log("Tabulator table built successfully."); // Debug table built
-                         showLoading('previewLoading', false);
-                     },
+                 });
+                 tabulatorTable.on("tableBuilt", () => {
+                     console.log("Tabulator table built successfully."); // Debug table built
+                     showLoading('previewLoading', false);
                  });
             } catch (tabulatorError) {
                  console.error("Failed to initialize Tabulator:", tabulatorError); // Debug tabulator error
@@ -190,6 +189,46 @@ document.addEventListener('DOMContentLoaded', () => {
              tableDiv.innerHTML = '<div class="alert alert-warning">No preview data available.</div>';
              showLoading('previewLoading', false);
         }
+    }
+    const ROWS_PAGE_SIZE = 200;
+    let filteredRowCount = null; // Rows matching the current filters (from the rows API)
+
+    /** Maps Tabulator's remote page/sort/filter params onto the rows API */
+    function buildRowsUrl(url, config, params) {
+        const query = new URLSearchParams({
+            offset: (params.page - 1) * params.size,
+            limit: params.size
+        });
+        if (params.sort && params.sort.length) {
+            query.set('sort', params.sort[0].field);
+            query.set('dir', params.sort[0].dir);
+        }
+        const filters = (params.filter || []).map(f => ({ column: f.field, op: f.type, value: f.value }));
+        if (filters.length) query.set('filters', JSON.stringify(filters));
+        return `${url}?${query.toString()}`;
+    }
+
+    /** Converts the column-oriented rows payload into Tabulator's progressive-load format */
+    function rowsResponseToTabulator(url, params, response) {
+        const rows = [];
+        for (let i = 0; i < response.returned_rows; i++) {
+            const row = {};
+            response.columns.forEach((name, c) => { row[name] = response.values[c][i]; });
+            rows.push(row);
+        }
+        filteredRowCount = response.filtered_rows;
+        const rowCountSpan = document.getElementById('rowCount');
+        if (rowCountSpan) rowCountSpan.textContent = filteredRowCount;
+        return { last_page: Math.max(1, Math.ceil(response.filtered_rows / params.size)), data: rows };
+    }
+
+    function buildTableColumns() {
+        return columnInfo.map(col => ({
+            title: col.name, field: col.name, headerFilter: "input",
+            minWidth: 100, sorter: inferTabulatorSorter(col.dtype),
+            formatter: "plaintext", tooltip: true,
+            headerTooltip: `Type: ${col.dtype}\nNulls: ${col.null_count}`
+        }));
     }
      function inferTabulatorSorter(dtype) {
          // ... (same as before)
@@ -243,7 +282,7 @@ document.addEventListener('DOMContentLoaded', () => {
          const rowCountSpan = document.getElementById('rowCount');
          const colCountSpan = document.getElementById('colCount');
          // Use table row count if available AFTER filtering/cleaning, else use initial count
-         const currentDataRowCount = tabulatorTable ? tabulatorTable.getDataCount('active') : (previewData ? previewData.length : 'N/A');
+         const currentDataRowCount = filteredRowCount !== null ? filteredRowCount : (previewData ? previewData.length : 'N/A');
          if (rowCountSpan) rowCountSpan.textContent = currentDataRowCount;
          if (colCountSpan) colCountSpan.textContent = columnInfo ? columnInfo.length : 'N/A';
 
@@ -277,6 +316,9 @@ document.addEventListener('DOMContentLoaded', () => {
             } else if (action === 'convert_type') {
                 params.new_type = document.getElementById('convertTypeNew').value;
                 if (!params.new_type) { displayFeedback(cleaningFeedbackDiv, 'Please select a target data type.', true); return; }
+            } else if (action === 'rename_column') {
+                params.new_name = document.getElementById('renameNewName').value.trim();
+                if (!params.new_name) { displayFeedback(cleaningFeedbackDiv, 'Please enter a new column name.', true); return; }
             }
             // Add other param gathering
 
@@ -284,7 +326,7 @@ document.addEventListener('DOMContentLoaded', () => {
             clearFeedback(cleaningFeedbackDiv); // Clear previous feedback immediately
             showLoading('cleaningLoading', true);
 
-            const apiUrl = `/apply_cleaning_action/${uploadId}`;
+            const apiUrl = `/data/cleaner/apply/${uploadId}`;
             const payload = { action: action, column: selectedColumn, params: params };
 
             const result = await fetchApi(apiUrl, 'POST', payload);
@@ -292,23 +334,59 @@ document.addEventListener('DOMContentLoaded', () => {
             showLoading('cleaningLoading', false);
             if (result.ok) {
                 displayFeedback(cleaningFeedbackDiv, result.data.message || 'Action applied successfully.', false);
-                // Update state ONLY IF server confirms success
-                previewData = result.data.preview_data;
-                columnInfo = result.data.column_info;
-                if (tabulatorTable) {
-                     console.log("Updating Tabulator data after cleaning."); // Debug update table data
-                     tabulatorTable.setData(previewData); // Use full dataset if server sends it, else just preview
-                } else {
-                     console.warn("Tabulator table not initialized, cannot update data.");
-                }
-                updateColumnSelectors();
-                updateColumnInfoDisplay();
+                applyCleanerState(result.data); // Update state ONLY IF server confirms success
             } else {
                 displayFeedback(cleaningFeedbackDiv, `Error: ${result.data.error || 'Failed to apply action.'}`, true);
             }
         });
     });
 
+    // Undo / Redo Buttons (move the active step of the cleaning log)
+    const undoCleaningBtn = document.getElementById('undoCleaningBtn');
+    const redoCleaningBtn = document.getElementById('redoCleaningBtn');
+    [[undoCleaningBtn, 'undo'], [redoCleaningBtn, 'redo']].forEach(([button, direction]) => {
+        if (!button) return;
+        button.addEventListener('click', async () => {
+            clearFeedback(cleaningFeedbackDiv);
+            showLoading('cleaningLoading', true);
+            const result = await fetchApi(`/data/cleaner/${direction}/${uploadId}`, 'POST');
+            showLoading('cleaningLoading', false);
+            if (result.ok) {
+                displayFeedback(cleaningFeedbackDiv, result.data.message || `${direction} complete.`, false);
+                applyCleanerState(result.data);
+            } else {
+                displayFeedback(cleaningFeedbackDiv, `Error: ${result.data.error || `Failed to ${direction}.`}`, true);
+                updateUndoRedoButtons();
+            }
+        });
+    });
+
+    /** Applies a dataset state returned by the apply/undo/redo endpoints */
+    function applyCleanerState(state) {
+        previewData = state.preview_data;
+        columnInfo = state.column_info;
+        if (tabulatorTable) {
+             console.log("Updating Tabulator data after cleaning."); // Debug update table data
+             tabulatorTable.setColumns(buildTableColumns()); // Columns may have been renamed/dropped
+             tabulatorTable.setData(); // Re-fetch the first window of the new version
+        } else {
+             console.warn("Tabulator table not initialized, cannot update data.");
+        }
+        cleanerHistory = { can_undo: state.can_undo, can_redo: state.can_redo };
+        updateColumnSelectors();
+        updateColumnInfoDisplay();
+        updateUndoRedoButtons();
+    }
+
+    let cleanerHistory = {
+        can_undo: undoCleaningBtn ? !undoCleaningBtn.disabled : false,
+        can_redo: redoCleaningBtn ? !redoCleaningBtn.disabled : false
+    };
+    function updateUndoRedoButtons() {
+        if (undoCleaningBtn) undoCleaningBtn.disabled = !cleanerHistory.can_undo;
+        if (redoCleaningBtn) redoCleaningBtn.disabled = !cleanerHistory.can_redo;
+    }
+
     // Show/Hide Custom Null Input
     if (nullActionMethodSelect) {
         nullActionMethodSelect.addEventListener('change', (event) => {
@@ -329,12 +407,22 @@ document.addEventListener('DOMContentLoaded', () => {
          button.addEventListener('click', async (event) => {
              const analysisType = event.target.dataset.analysisType;
              console.log('Analysis button clicked! Type:', analysisType); // Debug analysis click
+             // Analysis parameters come from the existing column selects
+             let params = {};
+             if (analysisType === 'value_counts') {
+                 if (!selectColumnCleaning.value) { analysisResultsDiv.textContent = 'Please select a column first.'; return; }
+                 params = { column: selectColumnCleaning.value };
+             } else if (analysisType === 'group_summary') {
+                 if (!selectXAxis.value) { analysisResultsDiv.textContent = 'Please select an X-Axis column to group by.'; return; }
+                 params = { group_by: selectXAxis.value, value_column: selectYAxis.value || null };
+             }
+
              if (analysisResultsDiv) analysisResultsDiv.textContent = `Running ${analysisType}...`;
              showLoading('analysisLoading', true);
              clearFeedback(cleaningFeedbackDiv); // Clear other feedback areas
 
-             const apiUrl = `/run_analysis/${uploadId}/${analysisType}`;
-             const result = await fetchApi(apiUrl, 'POST'); // Add payload if needed
+             const apiUrl = `/data/analysis/run/${uploadId}/${analysisType}`;
+             const result = await fetchApi(apiUrl, 'POST', { params: params });
 
              showLoading('analysisLoading', false);
              if (analysisResultsDiv) {
@@ -385,7 +473,7 @@ document.addEventListener('DOMContentLoaded', () => {
             showLoading('plotLoading', true);
             clearFeedback(cleaningFeedbackDiv);
 
-            const apiUrl = `/generate_plot/${uploadId}`;
+            const apiUrl = `/data/plot/generate/${uploadId}`;
             const result = await fetchApi(apiUrl, 'POST', plotConfig);
 
             showLoading('plotLoading', false);
@@ -395,6 +483,14 @@ document.addEventListener('DOMContentLoaded', () => {
                          const plotData = JSON.parse(result.data.plot_json);
                          console.log("Plotly data received:", plotData); // Debug plotly data
                          Plotly.newPlot(plotOutputDiv, plotData.data, plotData.layout, {responsive: true});
+                         const meta = result.data.meta || {};
+                         if (meta.reduction && meta.reduction !== 'none') {
+                             // Tell the user the chart shows reduced data (downsampled, binned or grouped on the server)
+                             const note = document.createElement('div');
+                             note.className = 'small text-muted px-2 pb-1';
+                             note.textContent = `Rendered from ${Number(meta.rows || 0).toLocaleString()} rows (${meta.reduction.replace(/_/g, ' ')}).`;
+                             plotOutputDiv.appendChild(note);
+                         }
                      } catch (e) {
                          console.error("Plotly JSON parsing or rendering error:", e);
                          plotOutputDiv.innerHTML = '<p class="text-danger p-3">Error rendering plot. Invalid data received.</p>';
@@ -409,6 +505,126 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
 
+    // Workbook Sheet Selector
+    // Each sheet of a workbook is its own analysis record; a sheet opened for the
+    // first time is extracted by a background job, so wait for it before navigating.
+    const sheetSelect = document.getElementById('sheetSelect');
+    const sheetStatus = document.getElementById('sheetStatus');
+    if (sheetSelect) {
+        sheetSelect.addEventListener('change', async () => {
+            const sheetName = sheetSelect.value;
+            sheetSelect.disabled = true;
+            if (sheetStatus) sheetStatus.textContent = `Loading sheet '${sheetName}'...`;
+            const result = await fetchApi(`/data/workbook/${uploadId}/sheet`, 'POST', { sheet_name: sheetName });
+            if (!result.ok) {
+                if (sheetStatus) sheetStatus.textContent = `Error: ${result.data.error || 'Could not open sheet.'}`;
+                sheetSelect.disabled = false;
+                return;
+            }
+            const targetId = result.data.upload_id;
+            let status = result.data.status;
+            while (status === 'queued' || status === 'parsing') {
+                await new Promise(resolve => setTimeout(resolve, 1000));
+                const poll = await fetchApi(`/data/analyzer/job/${targetId}`);
+                status = poll.ok ? poll.data.status : 'failed';
+                if (status === 'failed') {
+                    if (sheetStatus) sheetStatus.textContent = `Error: ${poll.data.error || 'Sheet could not be loaded.'}`;
+                    sheetSelect.disabled = false;
+                    return;
+                }
+            }
+            window.location.href = `/data/cleaner/${targetId}`;
+        });
+    }
+
+
+    // Query Panel
+    // Filter/select/aggregate on the full dataset, paged from the server.
+    const runQueryBtn = document.getElementById('runQueryBtn');
+    const queryFeedbackDiv = document.getElementById('query-feedback');
+    const QUERY_PAGE_SIZE = 200;
+    let queryTable = null;
+
+    /** Splits a comma-separated input, keeping commas inside parentheses (e.g. col('a, b')) */
+    function splitQueryList(value) {
+        return (value || '').split(/,(?![^(]*\))/).map(item => item.trim()).filter(item => item.length);
+    }
+
+    function buildQuerySpec() {
+        return {
+            where: document.getElementById('queryWhere').value.trim() || null,
+            select: splitQueryList(document.getElementById('querySelect').value),
+            group_by: splitQueryList(document.getElementById('queryGroupBy').value),
+            aggregates: splitQueryList(document.getElementById('queryAggregates').value),
+            order_by: splitQueryList(document.getElementById('queryOrderBy').value)
+        };
+    }
+
+    if (runQueryBtn) {
+        runQueryBtn.addEventListener('click', () => {
+            const spec = buildQuerySpec();
+            const queryStatus = document.getElementById('queryStatus');
+            clearFeedback(queryFeedbackDiv);
+            if (queryTable) { queryTable.destroy(); queryTable = null; }
+            showLoading('queryLoading', true);
+            queryTable = new Tabulator('#query-results-table', {
+                ajaxURL: `/data/query/${uploadId}`,
+                // Each page is one POST of the query spec plus offset/limit (the result is cached server-side)
+                ajaxRequestFunc: async (url, config, params) => {
+                    const result = await fetchApi(url, 'POST', { ...spec, offset: (params.page - 1) * params.size, limit: params.size });
+                    if (!result.ok) throw new Error(result.data.error || 'Query failed.');
+                    return result.data;
+                },
+                ajaxResponse: (url, params, response) => {
+                    const rows = [];
+                    for (let i = 0; i < response.returned_rows; i++) {
+                        const row = {};
+                        response.columns.forEach((name, c) => { row[name] = response.values[c][i]; });
+                        rows.push(row);
+                    }
+                    if (queryStatus) queryStatus.textContent = `${response.filtered_rows} result rows (${response.plan.matched_rows} of ${response.plan.input_rows} matched, ${response.plan.elapsed_ms} ms${response.cached ? ', cached' : ''})`;
+                    return { last_page: Math.max(1, Math.ceil(response.filtered_rows / params.size)), data: rows };
+                },
+                progressiveLoad: "scroll", paginationSize: QUERY_PAGE_SIZE,
+                autoColumns: true, autoColumnsDefinitions: defs => defs.map(def => ({ ...def, formatter: "plaintext", headerSort: false })),
+                layout: "fitDataStretch", height: "300px", placeholder: "No matching rows",
+            });
+            queryTable.on("dataLoaded", () => showLoading('queryLoading', false));
+            queryTable.on("dataLoadError", error => {
+                showLoading('queryLoading', false);
+                displayFeedback(queryFeedbackDiv, error.message || 'Query failed.', true);
+            });
+        });
+    }
+
+
+    // XLSX Export Progress
+    // The xlsx download is written row by row on the server; progress arrives on the
+    // upload's job room (/data_jobs) while the browser waits for the file.
+    const downloadXlsxBtn = document.getElementById('downloadXlsxBtn');
+    const exportProgressDiv = document.getElementById('exportProgress');
+    let exportSocket = null;
+    if (downloadXlsxBtn && exportProgressDiv && typeof io === 'function') {
+        downloadXlsxBtn.addEventListener('click', () => {
+            exportProgressDiv.style.display = 'block';
+            exportProgressDiv.textContent = 'Preparing Excel export...';
+            if (exportSocket) return; // Already subscribed
+            exportSocket = io('/data_jobs', { transports: ['websocket', 'polling'] });
+            exportSocket.on('connect', () => exportSocket.emit('subscribe_job', { job_id: uploadId }));
+            exportSocket.on('export_progress', (payload) => {
+                const percent = payload.total_rows ? Math.round(100 * payload.rows_written / payload.total_rows) : 100;
+                const sheets = payload.sheets > 1 ? `, ${payload.sheets} sheets` : '';
+                exportProgressDiv.textContent = `Writing Excel file: ${Number(payload.rows_written).toLocaleString()} of ${Number(payload.total_rows).toLocaleString()} rows (${percent}%${sheets})`;
+            });
+            exportSocket.on('export_complete', (payload) => {
+                exportProgressDiv.textContent = payload.error ? `Excel export failed: ${payload.error}` : 'Excel file ready. Download starting...';
+                if (!payload.error) setTimeout(() => { exportProgressDiv.style.display = 'none'; }, 4000);
+            });
+            exportSocket.on('error', (err) => console.warn('Export progress socket error:', err));
+        });
+    }
+
+
      // Generate Insights Button
      if (generateInsightsBtn) {
          console.log('Attaching listener to generateInsightsBtn:', generateInsightsBtn); // Debug attach insights
@@ -418,7 +634,7 @@ document.addEventListener('DOMContentLoaded', () => {
              showLoading('insightsLoading', true);
              clearFeedback(cleaningFeedbackDiv);
 
-             const apiUrl = `/generate_insights/${uploadId}`;
+             const apiUrl = `/data/insights/generate/${uploadId}`;
              const result = await fetchApi(apiUrl, 'POST');
 
              showLoading('insightsLoading', false);
@@ -431,7 +647,8 @@ document.addEventListener('DOMContentLoaded', () => {
                          ul.className = 'list-unstyled';
                          result.data.insights.forEach(insight => {
                              const li = document.createElement('li');
-                             li.innerHTML = `<i class="fas fa-check-circle text-success me-2"></i> ${insight}`; // Assumes FontAwesome
+                             li.innerHTML = `<i class="fas fa-check-circle text-success me-2"></i> `; // Assumes FontAwesome
+                             li.appendChild(document.createTextNode(insight)); // AI text (prompted with data rows) is never parsed as HTML
                              ul.appendChild(li);
                          });
                          insightsOutputDiv.appendChild(ul);
@@ -0,0 +1,219 @@
+# src/utils/cache_utils.py
+
+import gzip
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+# --- In-Process DataFrame Cache ---
+# Shared by the data analyzer routes so moving between the cleaner page, cleaning
+# actions and downloads does not re-load the same dataset from disk every time.
+# NOTE: Cached frames are shared between requests. Callers must treat them as
+# read-only and work on a copy (or a new frame) when modifying data.
+
+def estimate_dataframe_bytes(df):
+    """Deep memory footprint of a DataFrame in bytes (falls back to shallow)."""
+    try:
+        return int(df.memory_usage(deep=True).sum())
+    except Exception as mem_err:
+        logging.warning(f"Could not calculate deep memory usage for cache entry: {mem_err}. Using non-deep.")
+        try:
+            return int(df.memory_usage(deep=False).sum())
+        except Exception:
+            return 0
+
+
+class DataFrameCache:
+    """Thread-safe LRU cache of DataFrames bounded by a total byte budget."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max(0, int(max_bytes))
+        self._entries = OrderedDict() # key -> (value, size_bytes), oldest first
+        self._current_bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns the cached value for key (marking it recently used) or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size_bytes=None):
+        """Stores value under key, evicting least-recently-used entries to stay within budget."""
+        if size_bytes is None:
+            size_bytes = estimate_dataframe_bytes(value)
+        with self._lock:
+            self._remove(key)
+            if size_bytes > self.max_bytes:
+                # A single frame larger than the whole budget would evict everything else
+                logging.info(f"DataFrame cache: entry {key} ({size_bytes} bytes) exceeds budget ({self.max_bytes} bytes). Not cached.")
+                return False
+            while self._entries and self._current_bytes + size_bytes > self.max_bytes:
+                old_key, (_, old_size) = self._entries.popitem(last=False)
+                self._current_bytes -= old_size
+                self.evictions += 1
+                logging.debug(f"DataFrame cache: evicted {old_key} ({old_size} bytes)")
+            self._entries[key] = (value, size_bytes)
+            self._current_bytes += size_bytes
+            return True
+
+    def invalidate(self, predicate):
+        """Drops every entry whose key matches predicate(key). Returns the number removed."""
+        with self._lock:
+            stale_keys = [key for key in self._entries if predicate(key)]
+            for key in stale_keys:
+                self._remove(key)
+            return len(stale_keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._current_bytes = 0
+
+    def stats(self):
+        """Returns hit/miss counters and current usage (JSON serializable)."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "current_bytes": self._current_bytes,
+                "max_bytes": self.max_bytes
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._current_bytes -= entry[1]
+
+
+# --- On-Disk Compressed Cache ---
+# Used for serialized plot figures: small gzip blobs that are cheap to keep on disk
+# and expensive to rebuild. Entries are files named <key>.gz in one directory.
+
+class DiskLRUCache:
+    """Thread-safe LRU cache of gzip-compressed byte blobs on disk, bounded by total compressed size."""
+
+    def __init__(self, directory, max_bytes, suffix='.gz', compresslevel=6):
+        self.directory = directory
+        self.max_bytes = max(0, int(max_bytes))
+        self.suffix = suffix
+        self.compresslevel = compresslevel
+        self._entries = OrderedDict() # key -> size_bytes on disk, oldest first
+        self._current_bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}{self.suffix}")
+
+    def _load_index(self):
+        """Rebuilds the LRU order from existing files (least recently modified first)."""
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(self.suffix):
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.name[:-len(self.suffix)], stat.st_size))
+        for _, key, size_bytes in sorted(found):
+            self._entries[key] = size_bytes
+            self._current_bytes += size_bytes
+        self._evict(0)
+        logging.debug(f"Disk cache {self.directory}: {len(self._entries)} entries, {self._current_bytes} bytes")
+
+    def get_compressed(self, key):
+        """Returns the stored gzip bytes for key (marking it recently used) or None."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            try:
+                with open(self._path(key), 'rb') as cached_file:
+                    blob = cached_file.read()
+                os.utime(self._path(key)) # Keeps LRU order across restarts
+            except OSError as read_err:
+                logging.warning(f"Disk cache: failed to read {key}: {read_err}")
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return blob
+
+    def get(self, key):
+        """Returns the decompressed bytes for key or None."""
+        blob = self.get_compressed(key)
+        return gzip.decompress(blob) if blob is not None else None
+
+    def put(self, key, data):
+        """Compresses and stores data (bytes) under key. Returns the compressed bytes."""
+        blob = gzip.compress(data, compresslevel=self.compresslevel)
+        with self._lock:
+            self._remove(key)
+            if len(blob) > self.max_bytes:
+                logging.info(f"Disk cache: entry {key} ({len(blob)} bytes) exceeds budget ({self.max_bytes} bytes). Not cached.")
+                return blob
+            self._evict(len(blob))
+            temp_path = f"{self._path(key)}.tmp"
+            try:
+                with open(temp_path, 'wb') as cached_file:
+                    cached_file.write(blob)
+                os.replace(temp_path, self._path(key)) # Readers never see a partial file
+            except OSError as write_err:
+                logging.warning(f"Disk cache: failed to write {key}: {write_err}")
+                if os.path.exists(temp_path): os.remove(temp_path)
+                return blob
+            self._entries[key] = len(blob)
+            self._current_bytes += len(blob)
+            return blob
+
+    def invalidate(self, predicate):
+        """Deletes every entry whose key matches predicate(key). Returns the number removed."""
+        with self._lock:
+            stale_keys = [key for key in self._entries if predicate(key)]
+            for key in stale_keys:
+                self._remove(key)
+            return len(stale_keys)
+
+    def stats(self):
+        """Returns hit/miss counters and current usage (JSON serializable)."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "current_bytes": self._current_bytes,
+                "max_bytes": self.max_bytes
+            }
+
+    def _evict(self, incoming_bytes):
+        while self._entries and self._current_bytes + incoming_bytes > self.max_bytes:
+            old_key = next(iter(self._entries))
+            self._remove(old_key)
+            self.evictions += 1
+            logging.debug(f"Disk cache: evicted {old_key}")
+
+    def _remove(self, key):
+        size_bytes = self._entries.pop(key, None)
+        if size_bytes is None: return
+        self._current_bytes -= size_bytes
+        try: os.remove(self._path(key))
+        except OSError: pass
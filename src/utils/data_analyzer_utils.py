@@ -2,22 +2,157 @@
 
 import logging
 import pandas as pd
+import numpy as np
 import json
 import os
+import hashlib
+import math
+import time
+import warnings
+import uuid
+import zlib
 import io # Needed for PDFReport potentially, though not used in current functions
 from fpdf import FPDF # Make sure fpdf2 is installed: pip install fpdf2
+from .sketch_utils import HyperLogLog, KLLSketch, ReservoirSample
+
+# Optional: pyarrow powers the columnar sidecar cache (pip install pyarrow)
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None; feather = None
+    logging.warning("pyarrow not installed. Columnar sidecar cache disabled; uploads will be re-parsed on every read.")
+
+# Optional: zstandard enables .csv.zst downloads (pip install zstandard)
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# --- Columnar Sidecar Cache ---
+# The parsed (and dtype-converted) DataFrame is written once as an uncompressed
+# Arrow IPC / Feather v2 file next to the upload. Later reads memory-map it instead
+# of re-parsing the raw CSV/XLSX. The raw file's size and mtime are stored in the
+# sidecar's schema metadata so a changed raw file invalidates it.
+SIDECAR_SUFFIX = '.feather'
+SIDECAR_SOURCE_META_KEY = b'vision_ai_source'
+
+def get_sidecar_path(filepath):
+    """Returns the path of the columnar sidecar for a raw data file (a columnar dataset is its own sidecar)."""
+    if is_columnar_dataset(filepath): return filepath
+    return f"{filepath}{SIDECAR_SUFFIX}"
+
+def is_columnar_dataset(filepath):
+    """True for datasets stored directly as Feather (e.g. extracted workbook sheets)."""
+    return filepath.lower().endswith(SIDECAR_SUFFIX)
+
+def _source_signature(filepath):
+    """Size/mtime fingerprint of the raw file, used to detect stale sidecars."""
+    stat = os.stat(filepath)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def is_sidecar_fresh(filepath):
+    """Checks the sidecar exists and was written from the current raw file."""
+    if is_columnar_dataset(filepath): return feather is not None and os.path.exists(filepath)
+    return _is_feather_fresh(get_sidecar_path(filepath), filepath)
+
+def _is_feather_fresh(feather_path, source_path):
+    """Checks a Feather file exists and carries source_path's current size/mtime signature."""
+    if feather is None: return False
+    if not os.path.exists(feather_path) or not os.path.exists(source_path):
+        return False
+    try:
+        # Only the schema is read here, not the column data
+        with pa.memory_map(feather_path, 'r') as source:
+            metadata = pa.ipc.open_file(source).schema.metadata or {}
+        stored = json.loads(metadata.get(SIDECAR_SOURCE_META_KEY, b'{}'))
+        return stored == _source_signature(source_path)
+    except Exception as meta_err:
+        logging.warning(f"Could not read metadata of '{os.path.basename(feather_path)}': {meta_err}")
+        return False
+
+def write_dataframe_sidecar(df, filepath):
+    """Writes df as an uncompressed Feather sidecar for filepath. Returns the sidecar path or None."""
+    if is_columnar_dataset(filepath): return filepath # Already columnar, never overwritten from itself
+    return _write_feather_file(df, get_sidecar_path(filepath), filepath)
+
+def _write_feather_file(df, target_path, source_path, extra_metadata=None):
+    """Writes df as uncompressed Feather at target_path, stamped with source_path's signature (plus extra_metadata bytes)."""
+    if feather is None or df is None: return None
+    # Arrow stringifies non-string column names, which would not round-trip cleanly
+    if not all(isinstance(col, str) for col in df.columns):
+        logging.info(f"Skipping Feather file for '{os.path.basename(source_path)}': non-string column names.")
+        return None
+    tmp_path = f"{target_path}.tmp"
+    try:
+        table = pa.Table.from_pandas(df.reset_index(drop=True), preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[SIDECAR_SOURCE_META_KEY] = json.dumps(_source_signature(source_path)).encode('utf-8')
+        metadata.update(extra_metadata or {})
+        table = table.replace_schema_metadata(metadata)
+        # Uncompressed so the file can be memory-mapped without a decode pass
+        feather.write_feather(table, tmp_path, compression='uncompressed')
+        os.replace(tmp_path, target_path) # Atomic swap, readers never see a partial file
+        logging.info(f"Wrote columnar file '{os.path.basename(target_path)}'")
+        return target_path
+    except Exception as sidecar_err:
+        # Mixed-type object columns etc. cannot be stored; the raw file stays authoritative
+        logging.warning(f"Could not write Feather file for '{os.path.basename(source_path)}': {sidecar_err}")
+        if os.path.exists(tmp_path):
+            try: os.remove(tmp_path)
+            except OSError: pass
+        return None
+
+def read_dataframe_sidecar(sidecar_path):
+    """Memory-maps a Feather sidecar and returns it as a DataFrame (or None on error)."""
+    if feather is None: return None
+    try:
+        table = feather.read_table(sidecar_path, memory_map=True)
+        return table.to_pandas() # pandas metadata restores the nullable dtypes
+    except Exception as read_err:
+        logging.warning(f"Could not read sidecar '{os.path.basename(sidecar_path)}': {read_err}")
+        return None
+
+def remove_dataframe_sidecar(filepath):
+    """Deletes the sidecar belonging to filepath, if present (a columnar dataset itself is left alone)."""
+    if is_columnar_dataset(filepath): return
+    sidecar_path = get_sidecar_path(filepath)
+    if os.path.exists(sidecar_path):
+        try: os.remove(sidecar_path)
+        except OSError as rm_err: logging.error(f"Failed to remove sidecar {sidecar_path}: {rm_err}")
+
 
 # --- Data Analysis Helper Functions ---
 
-def get_dataframe(filepath):
-    """Safely reads CSV or Excel into Pandas DataFrame."""
+def get_dataframe(filepath, use_sidecar=True):
+    """
+    Safely reads CSV or Excel into Pandas DataFrame.
+    Uses the columnar sidecar when it is fresh, otherwise parses the raw file
+    and (re)writes the sidecar for the next read. Columnar datasets (extracted
+    workbook sheets) are memory-mapped directly.
+    """
+    if is_columnar_dataset(filepath):
+        if not os.path.exists(filepath):
+            logging.error(f"File not found at {filepath}")
+            return None
+        df = read_dataframe_sidecar(filepath)
+        if df is not None: logging.info(f"Loaded columnar dataset '{os.path.basename(filepath)}', Shape: {df.shape}")
+        return df
+
+    if use_sidecar and is_sidecar_fresh(filepath):
+        df = read_dataframe_sidecar(get_sidecar_path(filepath))
+        if df is not None:
+            logging.info(f"Loaded dataframe from sidecar for '{os.path.basename(filepath)}', Shape: {df.shape}")
+            return df
+        # Unreadable sidecar: fall through and re-parse the raw file
+
     try:
         # Check file extension case-insensitively
         if filepath.lower().endswith('.csv'):
             df = pd.read_csv(filepath)
         elif filepath.lower().endswith('.xlsx'):
-            # Specify engine if needed, though default often works
-            df = pd.read_excel(filepath, engine='openpyxl')
+            df = read_workbook_sheet(filepath) # First sheet; other sheets are extracted on demand
         else:
             logging.warning(f"Unsupported file type for get_dataframe: {filepath}")
             return None # Return None for unsupported types
@@ -26,126 +161,605 @@ def get_dataframe(filepath):
         df = df.convert_dtypes()
         # Use os.path.basename for cleaner logging
         logging.info(f"Successfully read dataframe from '{os.path.basename(filepath)}', Shape: {df.shape}")
+        if use_sidecar:
+            write_dataframe_sidecar(df, filepath)
         return df
 
     except FileNotFoundError:
         logging.error(f"File not found at {filepath}")
         return None # Return None if file doesn't exist
     except pd.errors.EmptyDataError:
+        # Only raised for CSVs; an empty worksheet already reads as an empty DataFrame
         logging.warning(f"File at {filepath} is empty.")
-        # Return an empty DataFrame consistent with pandas behavior
-        if filepath.lower().endswith('.csv'):
-            return pd.DataFrame()
-        elif filepath.lower().endswith('.xlsx'):
-            # Reading an empty excel might need special handling or return empty df
-             try:
-                 # Try reading sheets, if none or all empty, return empty DF
-                 xls = pd.ExcelFile(filepath, engine='openpyxl')
-                 if not xls.sheet_names:
-                     return pd.DataFrame()
-                 # Check if first sheet has columns or data - crude check
-                 first_sheet_df = xls.parse(xls.sheet_names[0])
-                 if first_sheet_df.empty:
-                     return pd.DataFrame()
-                 # If we got here, maybe it's not truly empty, re-read normally?
-                 # This part is tricky, maybe just return empty is safer.
-                 logging.warning(f"Excel file {filepath} might not be truly empty but parsed as such initially. Returning empty DataFrame.")
-                 return pd.DataFrame()
-             except Exception as empty_excel_err:
-                 logging.error(f"Error checking if excel file {filepath} is empty: {empty_excel_err}")
-                 return None # Error during empty check
-        else:
-             return None # Should have been caught earlier
+        return pd.DataFrame()
     except Exception as e:
         # Log the specific error and traceback for debugging
         logging.error(f"Error reading file {filepath}: {e}", exc_info=True)
         return None # Return None on other read errors
 
-def get_column_info(df):
-    """Generates summary info for DataFrame columns."""
-    info = []
-    if df is None or df.empty: # Handle None or empty DataFrame
-        return info
-    for col in df.columns:
-        # Ensure JSON serializability for counts (convert numpy types)
-        try:
-            # Check if column exists before accessing dtype/isnull
-            if col in df.columns:
-                col_dtype = str(df[col].dtype)
-                null_count = int(df[col].isnull().sum()) # Convert numpy.int64 to Python int
-                info.append({
-                    "name": col,
-                    "dtype": col_dtype,
-                    "null_count": null_count
-                })
-            else:
-                 logging.warning(f"get_column_info: Column '{col}' not found during iteration (should not happen).")
-        except Exception as col_info_err:
-            logging.error(f"Error getting info for column '{col}': {col_info_err}")
-            info.append({ "name": col, "dtype": "Error", "null_count": "Error" })
-    return info
-
-def generate_data_profile(df):
-    """Creates a basic profile of the DataFrame."""
+
+# --- Workbook Sheets ---
+# An .xlsx upload opens on its first sheet. Other sheets are listed from the
+# workbook metadata (names and the <dimension> element, no cell data) and are
+# extracted on demand into their own Feather file next to the workbook, which
+# then serves as that sheet's dataset (see is_columnar_dataset).
+
+def _open_workbook_read_only(filepath):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        logging.error("Workbook read failed: 'openpyxl' library not found. Please install it (`pip install openpyxl`).")
+        raise
+    return load_workbook(filepath, read_only=True, data_only=True, keep_links=False)
+
+def list_workbook_sheets(filepath):
+    """
+    Lists the worksheets of an .xlsx file as [{"index", "name", "rows", "columns", "state"}].
+    rows excludes the header row; rows/columns are None when the file has no dimension record.
+    """
+    workbook = _open_workbook_read_only(filepath)
+    try:
+        sheets = []
+        for index, worksheet in enumerate(workbook.worksheets):
+            # In read-only mode max_row/max_column come from the sheet's <dimension> element
+            max_row, max_column = worksheet.max_row, worksheet.max_column
+            sheets.append({"index": index, "name": worksheet.title,
+                           "rows": max(0, max_row - 1) if max_row else None,
+                           "columns": max_column if max_column else None,
+                           "state": getattr(worksheet, 'sheet_state', 'visible')})
+        return sheets
+    finally:
+        workbook.close()
+
+def read_workbook_sheet(filepath, sheet_name=None):
+    """
+    Reads one sheet (the first when sheet_name is None) through openpyxl's
+    read-only streaming reader, which pandas uses for .xlsx. Column names are strings.
+    """
+    df = pd.read_excel(filepath, sheet_name=sheet_name if sheet_name is not None else 0, engine='openpyxl')
+    df.columns = [str(col) for col in df.columns]
+    return df
+
+def get_sheet_dataset_path(filepath, sheet_index):
+    """Path of the Feather file holding an extracted workbook sheet."""
+    return f"{filepath}.sheet{int(sheet_index)}{SIDECAR_SUFFIX}"
+
+def extract_sheet_task(workbook_path, sheet_name, target_path):
+    """
+    Parses one workbook sheet and stores it as a Feather dataset at target_path.
+    Returns target_path; raises ValueError if the sheet cannot be read or stored.
+    """
+    if _is_feather_fresh(target_path, workbook_path):
+        return target_path
+    try:
+        df = read_workbook_sheet(workbook_path, sheet_name).convert_dtypes()
+    except (KeyError, ValueError) as sheet_err:
+        raise ValueError(f"Could not read sheet '{sheet_name}': {sheet_err}")
+    if _write_feather_file(df, target_path, workbook_path) is None:
+        # Mixed-type object columns cannot be stored in Arrow; keep them as text
+        for col in df.columns:
+            if df[col].dtype == object: df[col] = df[col].astype('string')
+        if _write_feather_file(df, target_path, workbook_path) is None:
+            raise ValueError(f"Sheet '{sheet_name}' could not be stored.")
+    logging.info(f"Extracted sheet '{sheet_name}' of '{os.path.basename(workbook_path)}', Shape: {df.shape}")
+    return target_path
+
+# --- Column Statistics Kernel ---
+# One batched pass computes every statistic the profile and the cleaning
+# recommendations need. Numeric columns are converted to float64 blocks of
+# STATS_COLUMN_BLOCK columns at a time, so wide tables are handled in a few
+# vectorized NumPy operations instead of a Python loop per column.
+STATS_COLUMN_BLOCK = 64
+STATS_SAMPLE_SIZE = 5
+
+def _numeric_block_stats(values):
+    """Quantiles, skewness and IQR outlier counts for a 2D float array (NaN = null), per column."""
+    with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning) # All-null columns yield NaN
+        q1, median, q3 = np.nanquantile(values, [0.25, 0.5, 0.75], axis=0)
+        counts = np.sum(~np.isnan(values), axis=0)
+        mean = np.nansum(values, axis=0) / counts
+        deviations = values - mean
+        m2 = np.nansum(deviations ** 2, axis=0) / counts
+        m3 = np.nansum(deviations ** 3, axis=0) / counts
+        # Bias-corrected sample skewness, same definition as pandas Series.skew()
+        skew = (m3 / m2 ** 1.5) * np.sqrt(counts * (counts - 1)) / (counts - 2)
+        skew = np.where(m2 == 0, 0.0, skew)
+        skew = np.where(counts < 3, np.nan, skew)
+        iqr = q3 - q1
+        lower, upper = q1 - 1.5 * iqr, q3 + 1.5 * iqr
+        outliers = np.sum((values < lower) | (values > upper), axis=0) # NaN compares False
+    return {"q1": q1, "median": median, "q3": q3, "skew": skew,
+            "lower_bound": lower, "upper_bound": upper, "outlier_count": outliers}
+
+def _to_float(value):
+    """NaN-safe conversion of NumPy scalars to JSON-friendly floats (NaN -> None)."""
+    return None if value is None or pd.isna(value) else float(value)
+
+def resolve_stats_mode(mode, row_count, approximate_min_rows):
+    """Maps a configured stats mode ('exact', 'approximate' or 'auto') to 'exact' or 'approximate'."""
+    mode = (mode or 'exact').lower()
+    if mode == 'auto':
+        return 'approximate' if row_count >= approximate_min_rows else 'exact'
+    return 'approximate' if mode == 'approximate' else 'exact'
+
+def compute_column_stats(df, mode='exact', row_hashes=None):
+    """
+    Computes nulls, nunique, quantiles, skew, IQR outlier counts and max string
+    length for all columns of df. Returns a dict with frame-level counts and a
+    'columns' list (one dict per column, in column order).
+    mode='approximate' replaces the expensive exact statistics with sketches
+    (see _fill_approximate_stats); each affected column then carries an
+    'error_bounds' dict. Stored row fingerprints (row_hashes) are used for the
+    duplicate count when given.
+    """
     if df is None:
-        return {"row_count": 0, "col_count": 0, "column_info": [], "memory_usage": 0}
-    if df.empty:
-         return {"row_count": 0, "col_count": len(df.columns), "column_info": get_column_info(df), "memory_usage": 0}
+        return {"row_count": 0, "col_count": 0, "memory_usage": 0, "duplicate_row_count": 0, "columns": []}
 
+    approximate = mode == 'approximate'
+    stats = {"row_count": len(df), "col_count": len(df.columns), "mode": 'approximate' if approximate else 'exact'}
     try:
-        mem_usage = int(df.memory_usage(deep=True).sum())
+        stats["memory_usage"] = int(df.memory_usage(deep=True).sum())
     except Exception as mem_err:
         logging.warning(f"Could not calculate deep memory usage: {mem_err}. Using non-deep.")
         try:
-             mem_usage = int(df.memory_usage(deep=False).sum())
+            stats["memory_usage"] = int(df.memory_usage(deep=False).sum())
         except Exception:
-             mem_usage = -1 # Indicate error
-
-    profile = {
-        "row_count": len(df),
-        "col_count": len(df.columns),
-        "column_info": get_column_info(df),
-        "memory_usage": mem_usage
-    }
-    # Add more profiling: duplicate rows, basic type summaries, etc.
+            stats["memory_usage"] = -1 # Indicate error
     try:
-         profile["duplicate_row_count"] = int(df.duplicated().sum())
+        if not len(df):
+            stats["duplicate_row_count"] = 0
+        elif row_hashes is not None or approximate:
+            # 8-byte row hashes instead of duplicated()'s full-row hash table
+            stats["duplicate_row_count"] = count_duplicate_rows(row_hashes if row_hashes is not None else compute_row_hashes(df))
+        else:
+            stats["duplicate_row_count"] = int(df.duplicated().sum())
     except Exception as dup_err:
-         logging.warning(f"Could not calculate duplicate rows: {dup_err}")
-         profile["duplicate_row_count"] = "Error"
+        logging.warning(f"Could not calculate duplicate rows: {dup_err}")
+        stats["duplicate_row_count"] = "Error"
 
-    return profile
+    null_counts = df.isna().sum()
+    nunique = pd.Series(dtype='float64')
+    if not approximate:
+        try:
+            nunique = df.nunique(dropna=True)
+        except Exception as nunique_err: # e.g. unhashable values in object columns
+            logging.warning(f"Could not calculate unique counts: {nunique_err}")
 
-def generate_cleaning_recommendations(df):
-    """Basic recommendation engine (can be significantly improved)."""
-    if df is None: return ["DataFrame is not loaded."]
-    if df.empty: return ["DataFrame is empty. No recommendations."]
+    columns = []
+    for position, col in enumerate(df.columns):
+        dtype_str = str(df.dtypes.iloc[position])
+        columns.append({
+            "name": col,
+            "dtype": dtype_str,
+            "null_count": int(null_counts.iloc[position]),
+            "nunique": int(nunique[col]) if col in nunique.index else None,
+            "is_text": 'object' in dtype_str or 'string' in dtype_str,
+            "is_numeric": False,
+            "is_datetime": pd.api.types.is_datetime64_any_dtype(df.dtypes.iloc[position])
+        })
 
-    recommendations = []
-    col_info = get_column_info(df) # Use helper to get consistent info
-    total_rows = len(df)
+    # Numeric columns (booleans excluded)
+    numeric_positions = [i for i, dtype in enumerate(df.dtypes)
+                         if pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)]
+    for position in numeric_positions:
+        columns[position]["is_numeric"] = True
 
-    logging.debug(f"Generating recommendations for DF with {total_rows} rows.")
+    if approximate:
+        _fill_approximate_stats(df, columns, numeric_positions)
+        stats["columns"] = columns
+        return stats
 
-    # Duplicate Row Check first
+    # Exact numeric stats, batched into float64 blocks
+    for block_start in range(0, len(numeric_positions), STATS_COLUMN_BLOCK):
+        block_positions = numeric_positions[block_start:block_start + STATS_COLUMN_BLOCK]
+        try:
+            values = df.iloc[:, block_positions].to_numpy(dtype='float64', na_value=np.nan)
+            block = _numeric_block_stats(values)
+        except Exception as block_err:
+            logging.warning(f"Could not compute numeric statistics for column block at {block_start}: {block_err}")
+            continue
+        for offset, position in enumerate(block_positions):
+            entry = columns[position]
+            for key, arr in block.items():
+                entry[key] = int(arr[offset]) if key == "outlier_count" else _to_float(arr[offset])
+
+    # Text columns: longest value and a small random sample for type hints
+    for entry, col_position in ((c, i) for i, c in enumerate(columns) if c["is_text"]):
+        series = df.iloc[:, col_position]
+        try:
+            lengths = series.str.len() if 'string' in entry["dtype"] else series.dropna().astype(str).str.len()
+            entry["max_str_len"] = _to_float(lengths.max())
+        except Exception as len_err:
+            logging.warning(f"Could not determine max length for column '{entry['name']}': {len_err}")
+            entry["max_str_len"] = None
+        non_null = series.dropna()
+        entry["sample_values"] = non_null.sample(min(STATS_SAMPLE_SIZE, len(non_null))).tolist() if len(non_null) else []
+
+    stats["columns"] = columns
+    return stats
+
+# --- Approximate Statistics ---
+# HyperLogLog for nunique, KLL for quartiles/IQR outliers and a reservoir sample
+# for the text checks, fed STATS_SKETCH_CHUNK_ROWS rows at a time. Null counts,
+# skewness and duplicate counts stay exact (they are cheap, single-pass).
+STATS_SKETCH_CHUNK_ROWS = 250_000
+STATS_RESERVOIR_SIZE = 1000
+
+def _fill_approximate_stats(df, columns, numeric_positions):
+    """Adds sketch-based statistics (with 'error_bounds') to the column entries in place."""
+    numeric_set = set(numeric_positions)
+    text_positions = [i for i, c in enumerate(columns) if c["is_text"]]
+    hll = {i: HyperLogLog() for i in range(len(columns))}
+    kll = {i: KLLSketch() for i in numeric_positions}
+    reservoirs = {i: ReservoirSample(STATS_RESERVOIR_SIZE) for i in text_positions}
+
+    for start in range(0, len(df), STATS_SKETCH_CHUNK_ROWS):
+        chunk = df.iloc[start:start + STATS_SKETCH_CHUNK_ROWS]
+        for position in range(len(columns)):
+            non_null = chunk.iloc[:, position].dropna()
+            if non_null.empty: continue
+            try:
+                hll[position].update(non_null)
+                if position in numeric_set:
+                    kll[position].update(non_null.to_numpy(dtype='float64'))
+                elif position in reservoirs:
+                    reservoirs[position].update(non_null.to_numpy(dtype=object))
+            except Exception as sketch_err:
+                logging.warning(f"Could not update sketches for column '{columns[position]['name']}': {sketch_err}")
+
+    skews = pd.Series(dtype='float64')
+    if numeric_positions:
+        try:
+            skews = df.iloc[:, numeric_positions].astype('float64').skew()
+        except Exception as skew_err:
+            logging.warning(f"Could not calculate skewness: {skew_err}")
+
+    for position, entry in enumerate(columns):
+        non_null_count = len(df) - entry["null_count"]
+        estimate = hll[position].estimate() if non_null_count else 0
+        entry["nunique"] = int(round(min(estimate, non_null_count)))
+        bounds = {"nunique": {"relative_std_error": round(hll[position].relative_error, 4)}}
+
+        if position in kll and kll[position].count:
+            sketch = kll[position]
+            q1, median, q3 = sketch.quantile([0.25, 0.5, 0.75])
+            iqr = q3 - q1
+            lower, upper = q1 - 1.5 * iqr, q3 + 1.5 * iqr
+            entry.update({"q1": _to_float(q1), "median": _to_float(median), "q3": _to_float(q3),
+                          "lower_bound": _to_float(lower), "upper_bound": _to_float(upper),
+                          "outlier_count": int(round(sketch.fraction_outside(lower, upper) * non_null_count)),
+                          "skew": _to_float(skews.get(entry["name"]))})
+            bounds["quantiles"] = {"rank_error": round(sketch.rank_error, 4)}
+            # Each side of the IQR range can be off by rank_error of the non-null values
+            bounds["outlier_count"] = {"absolute_error": int(math.ceil(2 * sketch.rank_error * non_null_count))}
+
+        if position in reservoirs:
+            sample = reservoirs[position].items
+            lengths = [len(str(v)) for v in sample]
+            entry["max_str_len"] = float(max(lengths)) if lengths else None
+            entry["sample_values"] = sample[:STATS_SAMPLE_SIZE]
+            # The sample maximum is a lower bound; longer values may exist in the unsampled rows
+            bounds["max_str_len"] = {"lower_bound": True, "sample_size": len(sample),
+                                     "missed_share_95": round(reservoirs[position].missed_share_95, 4)}
+        entry["error_bounds"] = bounds
+
+# --- Row Fingerprints ---
+# One 64-bit hash per row (pd.util.hash_pandas_object), computed once at upload
+# and stored next to the data file. Duplicate counts and duplicate removal work
+# on this compact uint64 array instead of re-hashing every column on each view.
+# A row's hash depends only on its own values and the column dtypes, so after a
+# cleaning action only the touched rows need re-hashing.
+ROW_HASH_SUFFIX = '.rowhash.npz'
+
+def get_row_hash_path(filepath):
+    """Returns the path of the stored row fingerprints for a data file."""
+    return f"{filepath}{ROW_HASH_SUFFIX}"
+
+def compute_row_hashes(df):
+    """Returns a uint64 fingerprint for every row of df."""
+    if df is None or df.empty:
+        return np.empty(0, dtype=np.uint64)
+    return pd.util.hash_pandas_object(df, index=False).to_numpy(dtype=np.uint64)
+
+def save_row_hashes(row_hashes, filepath):
+    """Stores row fingerprints next to filepath, tagged with the data file's size/mtime."""
+    hash_path = get_row_hash_path(filepath)
+    tmp_path = f"{hash_path}.tmp.npz"
     try:
-        duplicate_count = int(df.duplicated().sum())
-        if duplicate_count > 0:
-            dup_percent = (duplicate_count / total_rows) * 100
-            recommendations.append(f"Dataset contains **{duplicate_count} duplicate rows** ({dup_percent:.1f}%). Consider removing them using the 'Remove Duplicates' action.")
-    except Exception as dup_err:
-        logging.warning(f"Could not perform duplicate check: {dup_err}")
+        signature = _source_signature(filepath)
+        np.savez(tmp_path, hashes=np.asarray(row_hashes, dtype=np.uint64),
+                 source=np.array([signature["size"], signature["mtime_ns"]], dtype=np.int64))
+        os.replace(tmp_path, hash_path)
+        return hash_path
+    except Exception as save_err:
+        logging.warning(f"Could not save row hashes for '{os.path.basename(filepath)}': {save_err}")
+        if os.path.exists(tmp_path):
+            try: os.remove(tmp_path)
+            except OSError: pass
+        return None
+
+def load_row_hashes(filepath, expected_rows=None):
+    """Loads stored row fingerprints if they belong to the current data file, else None."""
+    hash_path = get_row_hash_path(filepath)
+    if not os.path.exists(hash_path) or not os.path.exists(filepath):
+        return None
+    try:
+        with np.load(hash_path) as stored:
+            signature = _source_signature(filepath)
+            if stored["source"].tolist() != [signature["size"], signature["mtime_ns"]]:
+                return None
+            row_hashes = stored["hashes"]
+        if expected_rows is not None and len(row_hashes) != expected_rows:
+            return None
+        return row_hashes
+    except Exception as load_err:
+        logging.warning(f"Could not load row hashes for '{os.path.basename(filepath)}': {load_err}")
+        return None
+
+def get_row_hashes(df, filepath):
+    """Returns stored row fingerprints for filepath, computing and storing them when missing/stale."""
+    row_hashes = load_row_hashes(filepath, expected_rows=len(df))
+    if row_hashes is None:
+        row_hashes = compute_row_hashes(df)
+        save_row_hashes(row_hashes, filepath)
+    return row_hashes
+
+def remove_row_hashes(filepath):
+    """Deletes the stored row fingerprints belonging to filepath, if present."""
+    hash_path = get_row_hash_path(filepath)
+    if os.path.exists(hash_path):
+        try: os.remove(hash_path)
+        except OSError as rm_err: logging.error(f"Failed to remove row hashes {hash_path}: {rm_err}")
+
+def count_duplicate_rows(row_hashes):
+    """Number of rows that repeat an earlier row (same as df.duplicated().sum())."""
+    return int(len(row_hashes) - len(np.unique(row_hashes)))
 
+def first_occurrence_mask(row_hashes):
+    """Boolean mask keeping the first occurrence of every distinct row."""
+    mask = np.zeros(len(row_hashes), dtype=bool)
+    if len(row_hashes):
+        _, first_positions = np.unique(row_hashes, return_index=True)
+        mask[first_positions] = True
+    return mask
+
+# --- Profile Helpers ---
+
+def get_column_info(df, stats=None):
+    """Generates summary info for DataFrame columns."""
+    if stats is not None:
+        return [{"name": c["name"], "dtype": c["dtype"], "null_count": c["null_count"]} for c in stats.get("columns", [])]
+    if df is None or df.empty: # Handle None or empty DataFrame
+        return []
+    try:
+        null_counts = df.isna().sum() # One vectorized pass instead of a loop per column
+        return [{"name": col, "dtype": str(dtype), "null_count": int(null_counts.iloc[i])}
+                for i, (col, dtype) in enumerate(df.dtypes.items())]
+    except Exception as col_info_err:
+        logging.error(f"Error getting column info: {col_info_err}")
+        return [{"name": col, "dtype": "Error", "null_count": "Error"} for col in df.columns]
+
+def generate_data_profile(df, stats=None):
+    """Creates a basic profile of the DataFrame (reuses precomputed column stats if given)."""
+    if df is None and stats is None:
+        return {"row_count": 0, "col_count": 0, "column_info": [], "memory_usage": 0}
+    if stats is None and df.empty:
+         return {"row_count": 0, "col_count": len(df.columns), "column_info": get_column_info(df), "memory_usage": 0}
+
+    if stats is None:
+        stats = compute_column_stats(df)
+    return {
+        "row_count": stats["row_count"],
+        "col_count": stats["col_count"],
+        "column_info": get_column_info(df, stats=stats),
+        "memory_usage": stats["memory_usage"],
+        "duplicate_row_count": stats["duplicate_row_count"]
+    }
+
+# --- Streaming (Chunked) Profiling ---
+# Used for uploads too large to parse in one go. The file is read in fixed-size
+# chunks of raw values; per-chunk partial results (row/null counts, inferred
+# dtypes, numeric min/max) are merged into the same profile dict that
+# generate_data_profile returns, so peak memory is bounded by the chunk size.
+# Duplicates are counted in the sidecar pass, on the row hashes of the typed
+# chunks ('1' and '1.0' are the same Int64 value), so the count matches the
+# sidecar, df.duplicated() and 'Remove Duplicates' (8 bytes per row).
+STREAMING_CHUNK_ROWS = 100_000
+_BOOLEAN_STRINGS = {'true': True, 'false': False}
+
+def iter_raw_chunks(filepath, chunksize=STREAMING_CHUNK_ROWS):
+    """Yields the file as DataFrames of raw (unconverted) values, chunksize rows at a time."""
+    if filepath.lower().endswith('.csv'):
+        # dtype=str keeps every chunk's values comparable; real types are inferred later
+        yield from pd.read_csv(filepath, dtype=str, chunksize=chunksize)
+    elif filepath.lower().endswith('.xlsx'):
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            logging.error("Streaming XLSX read failed: 'openpyxl' library not found. Please install it (`pip install openpyxl`).")
+            raise
+        workbook = load_workbook(filepath, read_only=True, data_only=True)
+        try:
+            rows = workbook.worksheets[0].iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None: return
+            columns = [str(h) if h is not None else f"Unnamed: {i}" for i, h in enumerate(header)]
+            batch = []
+            for row in rows:
+                batch.append(row[:len(columns)])
+                if len(batch) >= chunksize:
+                    yield pd.DataFrame(batch, columns=columns, dtype=object)
+                    batch = []
+            if batch:
+                yield pd.DataFrame(batch, columns=columns, dtype=object)
+        finally:
+            workbook.close()
+    else:
+        raise ValueError(f"Unsupported file type for streaming read: {filepath}")
 
-    for col in col_info:
+def _infer_chunk_dtype(non_null):
+    """Infers the convert_dtypes()-style dtype name of a chunk column's non-null raw values."""
+    if non_null.empty:
+        return None # No evidence in this chunk
+    inferred = pd.api.types.infer_dtype(non_null, skipna=True)
+    if inferred == 'boolean':
+        return 'boolean'
+    if inferred in ('datetime', 'datetime64', 'date'):
+        return 'datetime64[ns]' # Typed XLSX cells only; CSV dates stay strings like read_csv
+    numeric = pd.to_numeric(non_null, errors='coerce')
+    if numeric.notna().all():
+        # convert_dtypes() turns integral floats into Int64 as well
+        return 'Int64' if bool((numeric % 1 == 0).all()) else 'Float64'
+    if non_null.astype(str).str.strip().str.lower().isin(_BOOLEAN_STRINGS).all():
+        return 'boolean'
+    return 'string'
+
+def _merge_dtypes(current, new):
+    """Promotes two inferred dtype names to one that can hold both."""
+    if current is None: return new
+    if new is None or new == current: return current
+    if {current, new} <= {'Int64', 'Float64'}: return 'Float64'
+    return 'string'
+
+def cast_raw_chunk(chunk, column_dtypes):
+    """Casts a raw chunk's columns to the dtypes inferred by the streaming profiler."""
+    cast = {}
+    for col in chunk.columns:
+        values = chunk[col]
+        dtype = column_dtypes.get(col, 'string')
+        if dtype in ('Int64', 'Float64'):
+            cast[col] = pd.to_numeric(values, errors='coerce').astype(dtype)
+        elif dtype == 'boolean':
+            # Nulls become 'nan'/'None' here and map to NA
+            cast[col] = values.astype(str).str.strip().str.lower().map(_BOOLEAN_STRINGS).astype('boolean')
+        elif dtype == 'datetime64[ns]':
+            cast[col] = pd.to_datetime(values, errors='coerce')
+        else:
+            cast[col] = values.astype('string')
+    return pd.DataFrame(cast, index=chunk.index)
+
+def generate_data_profile_streaming(filepath, chunksize=STREAMING_CHUNK_ROWS, progress_callback=None):
+    """
+    Creates the same profile as generate_data_profile without loading the whole file,
+    except duplicate_row_count (see write_dataframe_sidecar_streaming).
+    progress_callback, if given, is called with the number of rows read after each chunk.
+    """
+    row_count = 0
+    columns = None
+    null_counts = {}; dtypes = {}; mins = {}; maxs = {}; string_bytes = {}
+
+    for chunk in iter_raw_chunks(filepath, chunksize):
+        if columns is None:
+            columns = list(chunk.columns)
+            for col in columns:
+                null_counts[col] = 0; dtypes[col] = None; string_bytes[col] = 0
+        row_count += len(chunk)
+        chunk_nulls = chunk.isna().sum()
+        for col in columns:
+            null_counts[col] += int(chunk_nulls[col])
+            non_null = chunk[col].dropna()
+            # 'string' is the top of the promotion order, so inference can be skipped
+            chunk_dtype = 'string' if dtypes[col] == 'string' else _infer_chunk_dtype(non_null)
+            dtypes[col] = _merge_dtypes(dtypes[col], chunk_dtype)
+            if chunk_dtype in ('Int64', 'Float64'):
+                numeric = pd.to_numeric(non_null, errors='coerce')
+                chunk_min, chunk_max = numeric.min(), numeric.max()
+                mins[col] = chunk_min if col not in mins else min(mins[col], chunk_min)
+                maxs[col] = chunk_max if col not in maxs else max(maxs[col], chunk_max)
+            elif chunk_dtype == 'string':
+                string_bytes[col] += int(non_null.memory_usage(deep=True, index=False))
+        if progress_callback is not None: progress_callback(row_count)
+
+    if columns is None:
+        return {"row_count": 0, "col_count": 0, "column_info": [], "memory_usage": 0, "profile_mode": "streaming"}
+
+    column_info = []
+    memory_usage = 0
+    for col in columns:
+        dtype = dtypes[col] or 'Int64' # All-null columns parse as float NaN -> Int64
+        entry = {"name": col, "dtype": dtype, "null_count": null_counts[col]}
+        if dtype in ('Int64', 'Float64') and col in mins:
+            entry["min"] = float(mins[col]); entry["max"] = float(maxs[col])
+        column_info.append(entry)
+        # Estimated in-memory size after conversion (values + validity mask)
+        memory_usage += string_bytes[col] if dtype == 'string' else row_count * (2 if dtype == 'boolean' else 9)
+
+    logging.info(f"Streaming profile of '{os.path.basename(filepath)}' complete: {row_count} rows, {len(columns)} columns.")
+    return {
+        "row_count": row_count,
+        "col_count": len(columns),
+        "column_info": column_info,
+        "memory_usage": int(memory_usage),
+        "profile_mode": "streaming"
+    }
+
+def write_dataframe_sidecar_streaming(filepath, column_info, chunksize=STREAMING_CHUNK_ROWS):
+    """
+    Writes the columnar sidecar chunk by chunk using the dtypes from a streaming
+    profile, so large uploads get a sidecar without ever being fully in memory.
+    Returns (sidecar_path, row_hashes of the typed rows); the path is None when no
+    sidecar was written (hashes are still computed without pyarrow), both on errors.
+    """
+    column_dtypes = {c['name']: c['dtype'] for c in column_info}
+    sidecar_path = get_sidecar_path(filepath)
+    tmp_path = f"{sidecar_path}.tmp"
+    writer = None
+    schema = None
+    hash_parts = [] # Row fingerprints of the typed chunks, stored alongside the sidecar
+    try:
+        for chunk in iter_raw_chunks(filepath, chunksize):
+            typed_chunk = cast_raw_chunk(chunk, column_dtypes).reset_index(drop=True)
+            hash_parts.append(compute_row_hashes(typed_chunk))
+            if feather is None: continue # Fingerprints only
+            table = pa.Table.from_pandas(typed_chunk, preserve_index=False)
+            if writer is None:
+                metadata = dict(table.schema.metadata or {})
+                metadata[SIDECAR_SOURCE_META_KEY] = json.dumps(_source_signature(filepath)).encode('utf-8')
+                schema = table.schema.with_metadata(metadata)
+                writer = pa.ipc.new_file(tmp_path, schema, options=pa.ipc.IpcWriteOptions(compression=None))
+            writer.write_table(table.cast(schema))
+        row_hashes = np.concatenate(hash_parts) if hash_parts else np.empty(0, dtype=np.uint64)
+        if writer is None: return None, row_hashes
+        writer.close(); writer = None
+        os.replace(tmp_path, sidecar_path)
+        save_row_hashes(row_hashes, filepath)
+        logging.info(f"Wrote columnar sidecar '{os.path.basename(sidecar_path)}' (streaming)")
+        return sidecar_path, row_hashes
+    except Exception as sidecar_err:
+        logging.warning(f"Could not write streaming sidecar for '{os.path.basename(filepath)}': {sidecar_err}")
+        if writer is not None:
+            try: writer.close()
+            except Exception: pass
+        if os.path.exists(tmp_path):
+            try: os.remove(tmp_path)
+            except OSError: pass
+        return None, None
+
+def generate_cleaning_recommendations(df, stats=None):
+    """Basic recommendation engine, driven by the column statistics kernel."""
+    if df is None and stats is None: return ["DataFrame is not loaded."]
+    if stats is None:
+        if df.empty: return ["DataFrame is empty. No recommendations."]
+        stats = compute_column_stats(df)
+    total_rows = stats.get("row_count", 0)
+    if total_rows == 0: return ["DataFrame is empty. No recommendations."]
+
+    recommendations = []
+    logging.debug(f"Generating recommendations for DF with {total_rows} rows.")
+
+    # Duplicate Row Check first
+    duplicate_count = stats.get("duplicate_row_count")
+    if isinstance(duplicate_count, int) and duplicate_count > 0:
+        dup_percent = (duplicate_count / total_rows) * 100
+        recommendations.append(f"Dataset contains **{duplicate_count} duplicate rows** ({dup_percent:.1f}%). Consider removing them using the 'Remove Duplicates' action.")
+
+    for col in stats.get("columns", []):
         col_name = col['name']
         col_dtype = col['dtype']
         null_count = col.get('null_count') # Use .get for safety
 
-        if null_count == "Error": # Skip if info couldn't be gathered
-             recommendations.append(f"Could not analyze column **'{col_name}'** due to previous error.")
-             continue
-        if null_count is None: # Should not happen if get_column_info is correct
+        if null_count is None: # Should not happen if compute_column_stats is correct
              logging.warning(f"Null count missing for column '{col_name}' in recommendations.")
              continue
 
@@ -162,53 +776,39 @@ def generate_cleaning_recommendations(df):
         # Data Type Specific Recommendations
         try:
             # Object/String Types
-            if 'object' in col_dtype or 'string' in col_dtype:
-                unique_vals = df[col_name].nunique()
+            if col.get('is_text'):
+                unique_vals = col.get('nunique')
                 if unique_vals == 1 and total_rows > 1:
                      recommendations.append(f"Column **'{col_name}'** ({col_dtype}) has only **1 unique value**. It might be constant and potentially droppable.")
-                elif unique_vals < 25 and total_rows > 50: # Arbitrary thresholds
+                elif unique_vals is not None and unique_vals < 25 and total_rows > 50: # Arbitrary thresholds
                      recommendations.append(f"Column **'{col_name}'** ({col_dtype}) has low cardinality ({unique_vals} unique values). Consider converting to 'category' type for memory efficiency.")
 
-                # Check sample for potential numeric strings (if not all null)
-                non_null_series = df[col_name].dropna()
-                if not non_null_series.empty:
-                    sample_size = min(5, len(non_null_series))
-                    sample = non_null_series.sample(sample_size)
-                    # Improved check for numeric-like strings
-                    numeric_like = all(isinstance(s, str) and s.replace('.', '', 1).replace('-', '', 1).strip().isdigit() for s in sample)
-                    if numeric_like:
-                        recommendations.append(f"Column **'{col_name}'** ({col_dtype}) contains values that look numeric (e.g., '{sample.iloc[0]}'). Consider converting to a numeric type if appropriate.")
+                # Check sample for potential numeric strings
+                sample = col.get('sample_values') or []
+                numeric_like = bool(sample) and all(isinstance(s, str) and s.replace('.', '', 1).replace('-', '', 1).strip().isdigit() for s in sample)
+                if numeric_like:
+                    recommendations.append(f"Column **'{col_name}'** ({col_dtype}) contains values that look numeric (e.g., '{sample[0]}'). Consider converting to a numeric type if appropriate.")
 
                 # Check for long strings
-                try:
-                    max_len = df[col_name].astype(str).str.len().max()
-                    if pd.notna(max_len) and max_len > 250: # Increased threshold
-                        recommendations.append(f"Column **'{col_name}'** ({col_dtype}) has long text entries (max length: {int(max_len)}). Review if full text is needed or if feature extraction/truncation is applicable.")
-                except Exception as len_err:
-                     logging.warning(f"Could not determine max length for column '{col_name}': {len_err}")
-
+                max_len = col.get('max_str_len')
+                if max_len is not None and max_len > 250: # Increased threshold
+                    recommendations.append(f"Column **'{col_name}'** ({col_dtype}) has long text entries (max length: {int(max_len)}). Review if full text is needed or if feature extraction/truncation is applicable.")
 
             # Numeric Types
-            elif pd.api.types.is_numeric_dtype(df[col_name]) and null_count < total_rows:
+            elif col.get('is_numeric') and null_count < total_rows:
                 # Skewness check
-                skewness = df[col_name].skew()
-                if pd.notna(skewness) and abs(skewness) > 1.5: # Threshold for significant skew
+                skewness = col.get('skew')
+                if skewness is not None and abs(skewness) > 1.5: # Threshold for significant skew
                     recommendations.append(f"Numeric column **'{col_name}'** appears skewed (skewness: {skewness:.2f}). Consider transformation (e.g., log, sqrt) if model assumptions require normality.")
 
                 # Basic outlier check (IQR method)
-                q1 = df[col_name].quantile(0.25)
-                q3 = df[col_name].quantile(0.75)
-                if pd.notna(q1) and pd.notna(q3):
-                    iqr = q3 - q1
-                    lower_bound = q1 - 1.5 * iqr
-                    upper_bound = q3 + 1.5 * iqr
-                    outliers = df[(df[col_name] < lower_bound) | (df[col_name] > upper_bound)]
-                    if not outliers.empty:
-                        outlier_percent = (len(outliers) / (total_rows-null_count)) * 100 # Percent of non-nulls
-                        recommendations.append(f"Numeric column **'{col_name}'** may have outliers ({len(outliers)} values or {outlier_percent:.1f}% outside 1.5*IQR range). Investigate further.")
+                outlier_count = col.get('outlier_count', 0)
+                if outlier_count:
+                    outlier_percent = (outlier_count / (total_rows - null_count)) * 100 # Percent of non-nulls
+                    recommendations.append(f"Numeric column **'{col_name}'** may have outliers ({outlier_count} values or {outlier_percent:.1f}% outside 1.5*IQR range). Investigate further.")
 
             # Datetime Types (if detected)
-            elif pd.api.types.is_datetime64_any_dtype(df[col_name]):
+            elif col.get('is_datetime'):
                  recommendations.append(f"Column **'{col_name}'** is datetime type. Consider extracting features like year, month, day, weekday, or calculating time differences if relevant.")
 
         except Exception as e:
@@ -222,77 +822,1178 @@ def generate_cleaning_recommendations(df):
     return recommendations
 
 
-def generate_gemini_insight_prompt(profile, cleaning_steps):
-    """Generates a prompt for Gemini based on data profile and cleaning steps."""
-    # Ensure profile data exists
-    row_count = profile.get('row_count', 0)
-    col_count = profile.get('col_count', 0)
+# --- Cleaning Operations ---
+# Each action returns a new DataFrame (the input may be a shared cached frame
+# and is never modified) together with the updated row fingerprints.
+CLEANING_ACTIONS = ('handle_nulls', 'convert_type', 'rename_column', 'drop_column', 'remove_duplicates')
 
-    prompt = f"""Analyze the following data profile and applied cleaning steps. Provide key insights, potential issues, and recommendations for further analysis.
+def _require_column(df, column):
+    if not column or column not in df.columns:
+        raise ValueError(f"Column '{column}' not found in dataset.")
 
-**Data Profile Summary:**
-- Rows: {row_count}
-- Columns: {col_count}
-- Memory Usage: {profile.get('memory_usage', 'N/A')} bytes
-- Column Details:
-"""
-    # Handle column info carefully, especially if row_count is 0
-    column_info = profile.get('column_info', [])
-    if column_info and row_count > 0:
-        for col in column_info:
-            null_count_val = col.get('null_count', 'N/A')
-            null_perc_str = ""
-            if isinstance(null_count_val, int):
-                 null_perc = (null_count_val / row_count * 100)
-                 null_perc_str = f" ({null_perc:.1f}%)"
-
-            prompt += f"  - Name: {col.get('name', 'N/A')}, Type: {col.get('dtype', 'N/A')}, Nulls: {null_count_val}{null_perc_str}\n"
-    elif column_info:
-         for col in column_info: # Show columns even if no rows
-              prompt += f"  - Name: {col.get('name', 'N/A')}, Type: {col.get('dtype', 'N/A')}, Nulls: N/A (0 rows)\n"
+def _replace_column(df, column, values):
+    """Shallow-copies df and swaps in one column; the other columns' data is shared, not copied."""
+    new_df = df.copy(deep=False)
+    new_df[column] = values
+    return new_df
+
+def _convert_series(series, new_type):
+    """Converts a column to one of the cleaner's target types (raises ValueError on failure)."""
+    try:
+        if new_type == 'string': return series.astype('string')
+        if new_type == 'integer': return pd.to_numeric(series, errors='raise').astype('Int64')
+        if new_type == 'float': return pd.to_numeric(series, errors='raise').astype('Float64')
+        if new_type == 'category': return series.astype('category')
+        if new_type == 'datetime': return pd.to_datetime(series, errors='raise')
+        if new_type == 'boolean': return series.astype('boolean')
+    except (TypeError, ValueError) as conv_err:
+        raise ValueError(f"Could not convert column to {new_type}: {conv_err}")
+    raise ValueError(f"Unsupported target type '{new_type}'.")
+
+def _fill_nulls(series, method, custom_value=None):
+    """Fills a column's nulls with its mean/median/mode or a custom value."""
+    if method in ('mean', 'median'):
+        if not pd.api.types.is_numeric_dtype(series) or pd.api.types.is_bool_dtype(series):
+            raise ValueError(f"Fill with {method} requires a numeric column.")
+        fill_value = series.mean() if method == 'mean' else series.median()
+        if pd.isna(fill_value): raise ValueError("Column has no values to compute a fill value from.")
+        if pd.api.types.is_integer_dtype(series) and float(fill_value) % 1 != 0:
+            series = series.astype('Float64') # Int64 cannot hold a fractional fill value
+        return series.fillna(fill_value)
+    if method == 'mode':
+        modes = series.mode(dropna=True)
+        if modes.empty: raise ValueError("Column has no values to compute a mode from.")
+        return series.fillna(modes.iloc[0])
+    if method == 'custom':
+        if custom_value is None or custom_value == '': raise ValueError("A custom fill value is required.")
+        if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+            text = str(custom_value).strip()
+            try: number = float(text) # Accepts 1e5, -2E3, ...
+            except ValueError: raise ValueError(f"Custom value '{custom_value}' is not numeric.")
+            if not math.isfinite(number): raise ValueError(f"Custom value '{custom_value}' is not a finite number.")
+            if not pd.api.types.is_integer_dtype(series): custom_value = number
+            elif number % 1 == 0: custom_value = int(text) if text.lstrip('+-').isdigit() else int(number) # Digit strings stay exact
+            else:
+                series = series.astype('Float64') # Int64 cannot hold a fractional fill value
+                custom_value = number
+        return series.fillna(custom_value)
+    raise ValueError(f"Unsupported null handling method '{method}'.")
+
+def apply_cleaning_operation(df, action, column=None, params=None, row_hashes=None):
+    """
+    Applies one cleaning action and returns (new_df, new_row_hashes, message).
+    Only rows whose values changed are re-hashed; row removals just filter the
+    fingerprint array. Raises ValueError for invalid actions or parameters.
+    """
+    params = params or {}
+    if row_hashes is None or len(row_hashes) != len(df):
+        row_hashes = compute_row_hashes(df)
+
+    if action == 'remove_duplicates':
+        keep = first_occurrence_mask(row_hashes)
+        removed = int(len(keep) - keep.sum())
+        return df[keep].reset_index(drop=True), row_hashes[keep], f"Removed {removed} duplicate rows."
+
+    _require_column(df, column)
+
+    if action == 'handle_nulls':
+        method = params.get('method')
+        null_mask = df[column].isna().to_numpy(dtype=bool)
+        if method in ('drop_row', 'drop_rows'):
+            keep = ~null_mask
+            return df[keep].reset_index(drop=True), row_hashes[keep], f"Dropped {int(null_mask.sum())} rows with nulls in '{column}'."
+        if method in ('drop_col', 'drop_column'):
+            new_df = df.drop(columns=[column])
+            return new_df, compute_row_hashes(new_df), f"Dropped column '{column}'."
+        filled = _fill_nulls(df[column], method, params.get('custom_value'))
+        new_df = _replace_column(df, column, filled)
+        if filled.dtype != df[column].dtype:
+            new_hashes = compute_row_hashes(new_df) # A dtype change alters every row's hash
+        else:
+            new_hashes = row_hashes.copy()
+            touched = np.flatnonzero(null_mask)
+            if len(touched):
+                new_hashes[touched] = compute_row_hashes(new_df.iloc[touched])
+        return new_df, new_hashes, f"Filled {int(null_mask.sum())} nulls in '{column}' using {method}."
+
+    if action == 'convert_type':
+        new_type = params.get('new_type')
+        converted = _convert_series(df[column], new_type)
+        new_df = _replace_column(df, column, converted)
+        return new_df, compute_row_hashes(new_df), f"Converted '{column}' to {new_type}."
+
+    if action == 'rename_column':
+        new_name = str(params.get('new_name') or '').strip()
+        if not new_name: raise ValueError("A new column name is required.")
+        if new_name in df.columns: raise ValueError(f"Column '{new_name}' already exists.")
+        # Row hashes ignore column names, so they carry over unchanged
+        return df.rename(columns={column: new_name}), row_hashes, f"Renamed '{column}' to '{new_name}'."
+
+    if action == 'drop_column':
+        new_df = df.drop(columns=[column])
+        return new_df, compute_row_hashes(new_df), f"Dropped column '{column}'."
+
+    raise ValueError(f"Unsupported cleaning action '{action}'.")
+
+
+# --- Operation Log Versioning ---
+# Cleaning steps are an append-only log in the upload document. Each step records
+# the step it was applied on top of (parent_id), and 'active_step_id' points at the
+# step the current dataset state ends with (None = the raw upload). Undo/redo just
+# move that pointer; the raw file is never rewritten. A dataset version is
+# materialized by replaying its steps from the nearest Feather checkpoint, and a
+# checkpoint is written every CLEANING_CHECKPOINT_INTERVAL steps along a chain
+# (with the process pool, every version the web process loads is one, since
+# that is how a worker hands a frame over). A checkpoint for a step that may
+# still be rejected is staged under a unique name and published afterwards.
+CHECKPOINT_STAGED_SUFFIX = '.staged-'
+
+def get_chain_key(chain):
+    """
+    Content key of a step chain (actions, columns and params, in order). Checkpoints
+    are named by it rather than by step_id because uploads with identical content
+    share one stored file (see storage_utils), while step ids are only unique per upload.
+    """
+    operations = [[step.get('action'), step.get('column'), step.get('params')] for step in chain]
+    return hashlib.sha1(json.dumps(operations, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+def get_checkpoint_path(filepath, chain):
+    return f"{filepath}.step-{get_chain_key(chain)}{SIDECAR_SUFFIX}"
+
+def get_step_chain(cleaning_steps, head_step_id):
+    """Steps from the raw upload up to and including head_step_id (oldest first)."""
+    if head_step_id is None: return []
+    by_id = {step.get('step_id'): step for step in cleaning_steps or [] if step.get('step_id') is not None}
+    chain = []
+    step = by_id.get(head_step_id)
+    while step is not None:
+        chain.append(step)
+        step = by_id.get(step.get('parent_id'))
+    return chain[::-1]
+
+def get_redo_step(cleaning_steps, head_step_id):
+    """The most recently applied step directly on top of head_step_id (the one undo moved away from), or None."""
+    children = [step for step in cleaning_steps or [] if step.get('parent_id') == head_step_id]
+    return max(children, key=lambda step: step['step_id']) if children else None
+
+def get_dataset_version(filepath, head_step_id):
+    """Short stable identifier of a dataset state: the raw file's signature plus the active step."""
+    signature = _source_signature(filepath)
+    version_key = f"{signature['size']}:{signature['mtime_ns']}:{head_step_id}"
+    return hashlib.sha1(version_key.encode('utf-8')).hexdigest()[:16]
+
+def write_checkpoint(df, row_hashes, filepath, chain, staged=False):
+    """
+    Stores the dataset state at the end of chain as a Feather checkpoint (plus its
+    row hashes). With staged=True it is written under a unique staged name that
+    readers never look at; publish_checkpoint/discard_checkpoint finish it.
+    """
+    target_path = get_checkpoint_path(filepath, chain)
+    if staged: target_path = f"{target_path}{CHECKPOINT_STAGED_SUFFIX}{uuid.uuid4().hex[:8]}"
+    checkpoint_path = _write_feather_file(df, target_path, filepath)
+    if checkpoint_path is not None:
+        save_row_hashes(row_hashes, checkpoint_path)
+    return checkpoint_path
+
+def publish_checkpoint(staged_path):
+    """Moves a staged checkpoint (and its row hashes) into place. Returns the checkpoint path."""
+    checkpoint_path = staged_path.rsplit(CHECKPOINT_STAGED_SUFFIX, 1)[0]
+    # Row hashes first: they are only trusted next to a checkpoint of matching size/mtime (kept by the rename)
+    if os.path.exists(get_row_hash_path(staged_path)):
+        os.replace(get_row_hash_path(staged_path), get_row_hash_path(checkpoint_path))
+    os.replace(staged_path, checkpoint_path)
+    return checkpoint_path
+
+def discard_checkpoint(checkpoint_path):
+    """Deletes one (staged or published) checkpoint and its row hashes."""
+    for path in (checkpoint_path, get_row_hash_path(checkpoint_path)):
+        if os.path.exists(path):
+            try: os.remove(path)
+            except OSError as rm_err: logging.error(f"Failed to remove checkpoint file {path}: {rm_err}")
+
+def load_checkpoint(filepath, chain):
+    """Returns (df, row_hashes) for a fresh checkpoint at the end of chain, or None."""
+    checkpoint_path = get_checkpoint_path(filepath, chain)
+    if not _is_feather_fresh(checkpoint_path, filepath):
+        return None
+    df = read_dataframe_sidecar(checkpoint_path)
+    if df is None: return None
+    row_hashes = load_row_hashes(checkpoint_path, expected_rows=len(df))
+    return df, (row_hashes if row_hashes is not None else compute_row_hashes(df))
+
+def get_branch_chains(cleaning_steps, root_step_id):
+    """Chains ending at root_step_id and at each of its descendants (a redo branch), for remove_checkpoints."""
+    branch_ids, chains = {root_step_id}, []
+    for step in sorted(cleaning_steps or [], key=lambda item: item.get('step_id') or 0): # Children have larger ids
+        if step.get('step_id') == root_step_id or step.get('parent_id') in branch_ids:
+            branch_ids.add(step.get('step_id'))
+            chains.append(get_step_chain(cleaning_steps, step.get('step_id')))
+    return chains
+
+def remove_checkpoints(filepath, chains, keep_chain=None):
+    """
+    Deletes the checkpoints (with row hashes) and aggregation cubes of the given
+    chains, e.g. a redo branch that can no longer be reached, except those equal
+    in content to keep_chain or one of its prefixes (the versions still reachable).
+    They are named by content, so an upload of the same bytes with the same chain
+    just rebuilds them.
+    """
+    keep_keys = {get_chain_key((keep_chain or [])[:length]) for length in range(1, len(keep_chain or []) + 1)}
+    for chain in chains:
+        if not chain or get_chain_key(chain) in keep_keys: continue
+        discard_checkpoint(get_checkpoint_path(filepath, chain))
+        cube_path = get_cube_path(filepath, chain)
+        if os.path.exists(cube_path):
+            try: os.remove(cube_path)
+            except OSError as rm_err: logging.error(f"Failed to remove aggregation cube {cube_path}: {rm_err}")
+
+def replay_steps(df, row_hashes, steps):
+    """Applies logged cleaning steps in order. Returns (df, row_hashes)."""
+    for step in steps:
+        df, row_hashes, _ = apply_cleaning_operation(df, step.get('action'), column=step.get('column'),
+                                                     params=step.get('params'), row_hashes=row_hashes)
+    return df, row_hashes
+
+def materialize_dataset(filepath, chain):
+    """
+    Builds the dataset state at the end of chain (a get_step_chain result):
+    loads the latest checkpoint on the chain (or the raw file) and replays the
+    steps after it. Returns (df, row_hashes), or (None, None) if the file cannot be read.
+    """
+    for position in range(len(chain) - 1, -1, -1):
+        checkpoint = load_checkpoint(filepath, chain[:position + 1])
+        if checkpoint is not None:
+            logging.debug(f"Replaying {len(chain) - position - 1} steps from checkpoint {chain[position]['step_id']}")
+            return replay_steps(checkpoint[0], checkpoint[1], chain[position + 1:])
+    df = get_dataframe(filepath)
+    if df is None: return None, None
+    return replay_steps(df, get_row_hashes(df, filepath), chain)
+
+
+# --- Row Windows (Server-Side Preview Paging) ---
+# The cleaner's preview table requests small windows of rows. Sorting and
+# filtering produce an array of row positions (cached by the caller per dataset
+# version and query), so scrolling only slices that array and the frame.
+ROW_WINDOW_MAX_LIMIT = 1000
+ROW_FILTER_OPERATORS = ('=', '!=', '<', '<=', '>', '>=', 'like', 'starts', 'isnull', 'notnull')
+
+def _coerce_filter_value(series, value):
+    """Converts a filter value (usually a string from the browser) to the column's type."""
+    if pd.api.types.is_bool_dtype(series):
+        return str(value).strip().lower() in ('true', '1', 'yes')
+    if pd.api.types.is_numeric_dtype(series):
+        try: return float(value)
+        except (TypeError, ValueError): raise ValueError(f"Filter value '{value}' is not numeric.")
+    if pd.api.types.is_datetime64_any_dtype(series):
+        try: return pd.Timestamp(value)
+        except (TypeError, ValueError): raise ValueError(f"Filter value '{value}' is not a date.")
+    return value
+
+def build_filter_mask(df, filters):
+    """
+    Boolean NumPy mask of rows matching every filter ({"column", "op", "value"}).
+    'like'/'starts' are case-insensitive substring/prefix matches on the text form.
+    Raises ValueError for unknown columns/operators or uncomparable values.
+    """
+    mask = np.ones(len(df), dtype=bool)
+    for flt in filters or []:
+        column, op, value = flt.get('column'), flt.get('op', '='), flt.get('value')
+        if column not in df.columns: raise ValueError(f"Column '{column}' not found in dataset.")
+        if op not in ROW_FILTER_OPERATORS: raise ValueError(f"Unsupported filter operator '{op}'.")
+        series = df[column]
+        if op == 'isnull': matched = series.isna()
+        elif op == 'notnull': matched = series.notna()
+        elif op in ('like', 'starts'):
+            if value is None or value == '': continue
+            text = series.astype('string').str.lower()
+            needle = str(value).lower()
+            matched = text.str.startswith(needle) if op == 'starts' else text.str.contains(needle, regex=False)
+        else:
+            value = _coerce_filter_value(series, value)
+            matched = {'=': series.eq, '!=': series.ne, '<': series.lt, '<=': series.le,
+                       '>': series.gt, '>=': series.ge}[op](value)
+        mask &= matched.fillna(False).to_numpy(dtype=bool)
+    return mask
+
+def sorted_row_positions(df, sort_by, ascending=True):
+    """Row positions of df ordered by one column (stable, nulls last)."""
+    if sort_by not in df.columns: raise ValueError(f"Column '{sort_by}' not found in dataset.")
+    ordered = df[sort_by].reset_index(drop=True).sort_values(ascending=ascending, kind='mergesort', na_position='last')
+    return ordered.index.to_numpy(dtype=np.int64)
+
+def select_row_positions(df, sort_by=None, ascending=True, filters=None, sort_order=None):
+    """
+    Row positions matching filters, in sort order. sort_order may pass in a
+    precomputed sorted_row_positions result so a new filter does not re-sort.
+    """
+    if sort_by is not None and sort_order is None:
+        sort_order = sorted_row_positions(df, sort_by, ascending)
+    positions = sort_order if sort_order is not None else np.arange(len(df), dtype=np.int64)
+    if filters:
+        mask = build_filter_mask(df, filters)
+        positions = positions[mask[positions]]
+    return positions
+
+def _json_column_values(series):
+    """A column slice as a JSON-safe list (None for nulls, ISO strings for dates)."""
+    if pd.api.types.is_integer_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        # to_json would emit nullable integers as floats
+        return [None if pd.isna(value) else int(value) for value in series.tolist()]
+    return json.loads(series.to_json(orient='values', date_format='iso'))
+
+def row_window_payload(df, positions, offset=0, limit=100):
+    """Column-oriented JSON-safe window of rows: {"columns", "values": [one array per column], ...}."""
+    offset = max(0, int(offset)); limit = max(1, min(int(limit), ROW_WINDOW_MAX_LIMIT))
+    window_positions = positions[offset:offset + limit]
+    window = df.iloc[window_positions]
+    return {
+        "columns": [str(col) for col in df.columns],
+        "values": [_json_column_values(window[col]) for col in df.columns],
+        "row_positions": window_positions.tolist(),
+        "offset": offset,
+        "limit": limit,
+        "returned_rows": int(len(window_positions)),
+        "filtered_rows": int(len(positions)),
+        "total_rows": int(len(df))
+    }
+
+
+# --- Correlation Engine ---
+# Pairwise-complete Pearson/Spearman for all numeric columns at once. Sums over
+# rows where both columns are non-null come from masked matrix products, which
+# are accumulated over row blocks so memory stays at a few p x p matrices.
+CORRELATION_BLOCK_ROWS = 50_000
+CORRELATION_MATRIX_MAX_COLUMNS = 300 # Wider tables return only the strongest pairs
+CORRELATION_SAMPLE_ROWS = 250_000 # Row sample used in top-pairs mode on very long tables
+CORRELATION_DEFAULT_TOP_K = 100
+
+def _correlation_numeric_columns(df):
+    return [col for col in df.columns
+            if pd.api.types.is_numeric_dtype(df[col]) and not pd.api.types.is_bool_dtype(df[col])]
+
+def pairwise_correlation(values):
+    """
+    Pearson correlation of the columns of a 2D float array containing NaNs,
+    using for every pair only the rows where both are present (like
+    DataFrame.corr). Returns (r, pair_counts), both p x p; r is NaN where a
+    pair has fewer than two rows or zero variance.
+    """
+    n_rows, n_cols = values.shape
+    present = ~np.isnan(values)
+    # Centre each column on its own mean first for numerical stability
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning) # All-NaN columns
+        means = np.nanmean(values, axis=0)
+    means = np.where(np.isnan(means), 0.0, means)
+
+    counts = np.zeros((n_cols, n_cols)); sums = np.zeros((n_cols, n_cols))
+    squares = np.zeros((n_cols, n_cols)); products = np.zeros((n_cols, n_cols))
+    for start in range(0, n_rows, CORRELATION_BLOCK_ROWS):
+        mask = present[start:start + CORRELATION_BLOCK_ROWS].astype(np.float64)
+        block = np.where(mask > 0, values[start:start + CORRELATION_BLOCK_ROWS] - means, 0.0)
+        counts += mask.T @ mask # rows where both i and j are present
+        sums += block.T @ mask # sum of x_i over rows where j is present
+        squares += (block * block).T @ mask
+        products += block.T @ block
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = products - sums * sums.T / counts
+        variance_i = squares - sums * sums / counts
+        r = covariance / np.sqrt(variance_i * variance_i.T)
+    r[(counts < 2) | ~np.isfinite(r)] = np.nan
+    np.clip(r, -1.0, 1.0, out=r)
+    return r, counts.astype(np.int64)
+
+def correlation_analysis(df, method='pearson', mode='auto', top_k=CORRELATION_DEFAULT_TOP_K, seed=0):
+    """
+    Correlation of all numeric columns. 'matrix' mode returns the full matrix;
+    'top_pairs' mode (automatic above CORRELATION_MATRIX_MAX_COLUMNS columns)
+    returns the top_k pairs by |r| and works on a row sample of long tables.
+    Spearman ranks each column over its non-null values, then applies Pearson.
+    """
+    columns = _correlation_numeric_columns(df)
+    if len(columns) < 2: raise ValueError("Correlation needs at least two numeric columns.")
+    if mode == 'auto':
+        mode = 'top_pairs' if len(columns) > CORRELATION_MATRIX_MAX_COLUMNS else 'matrix'
+
+    numeric = df[columns]
+    sampled_rows = None
+    if mode == 'top_pairs' and len(numeric) > CORRELATION_SAMPLE_ROWS:
+        numeric = numeric.sample(n=CORRELATION_SAMPLE_ROWS, random_state=seed)
+        sampled_rows = CORRELATION_SAMPLE_ROWS
+    if method == 'spearman':
+        numeric = numeric.rank(method='average', na_option='keep')
+    values = numeric.to_numpy(dtype=np.float64, na_value=np.nan)
+    r, counts = pairwise_correlation(values)
+
+    result = {"method": method, "mode": mode, "column_count": len(columns), "row_count": int(len(df)),
+              "sampled_rows": sampled_rows}
+    if mode == 'matrix':
+        rounded = np.round(r, 6)
+        result["columns"] = [str(col) for col in columns]
+        result["matrix"] = [[None if np.isnan(value) else float(value) for value in row] for row in rounded]
+        return result
+
+    upper_i, upper_j = np.triu_indices(len(columns), k=1)
+    strengths = np.abs(r[upper_i, upper_j])
+    valid = np.flatnonzero(~np.isnan(strengths))
+    k = min(top_k, len(valid))
+    if k:
+        best = valid[np.argpartition(-strengths[valid], k - 1)[:k]]
+        best = best[np.argsort(-strengths[best], kind='stable')]
     else:
-        prompt += "  (Column details not available)\n"
+        best = valid
+    result["pair_count"] = int(len(valid))
+    result["top_pairs"] = [{"column_a": str(columns[upper_i[pos]]), "column_b": str(columns[upper_j[pos]]),
+                            "r": round(float(r[upper_i[pos], upper_j[pos]]), 6),
+                            "rows": int(counts[upper_i[pos], upper_j[pos]])} for pos in best]
+    return result
 
-    # Add duplicate info if available
-    if "duplicate_row_count" in profile:
-         prompt += f"- Duplicate Rows Found: {profile['duplicate_row_count']}\n"
-
-
-    if cleaning_steps:
-        prompt += "\n**Cleaning Steps Applied:**\n"
-        for i, step in enumerate(cleaning_steps):
-             action = step.get('action', 'N/A')
-             column = step.get('column', 'N/A')
-             # Try to get meaningful detail from params
-             params_detail = ""
-             if 'method' in step.get('params', {}): params_detail = f"Method: {step['params']['method']}"
-             elif 'new_type' in step.get('params', {}): params_detail = f"New Type: {step['params']['new_type']}"
-             elif 'new_name' in step.get('params', {}): params_detail = f"New Name: {step['params']['new_name']}"
-             elif 'subset' in step.get('params', {}): params_detail = f"Subset: {step['params']['subset']}"
-
-             prompt += f"- Step {i+1}: Action='{action}', Column='{column}'"
-             if params_detail: prompt += f", Details='{params_detail}'"
-             # Optionally add timestamp: step.get('timestamp')
-             prompt += "\n"
+
+# --- Analyses ---
+# compute_analysis results are memoized in the upload's analysis_results, keyed by
+# get_analysis_key(type, dataset version, normalized params). A cleaning step
+# changes the dataset version; the routes then unset the results of every other
+# version, so only the active version's results are stored.
+ANALYSIS_TYPES = ('descriptive_stats', 'correlation', 'value_counts', 'group_summary')
+GROUP_SUMMARY_AGGREGATIONS = ('count', 'mean', 'sum', 'min', 'max', 'median')
+ANALYSIS_MAX_GROUPS = 100
+
+def normalize_analysis_params(analysis_type, params, columns):
+    """
+    Validates analysis parameters against the dataset's columns and fills in
+    defaults, so equivalent requests share one memo key. Raises ValueError.
+    """
+    params = params or {}
+    if analysis_type == 'descriptive_stats':
+        selected = params.get('columns') or []
+        missing = [col for col in selected if col not in columns]
+        if missing: raise ValueError(f"Columns not found in dataset: {', '.join(map(str, missing))}")
+        return {"columns": sorted(selected)}
+    if analysis_type == 'correlation':
+        method = params.get('method', 'pearson')
+        if method not in ('pearson', 'spearman'): raise ValueError(f"Unsupported correlation method '{method}'.")
+        mode = params.get('mode', 'auto')
+        if mode not in ('auto', 'matrix', 'top_pairs'): raise ValueError(f"Unsupported correlation mode '{mode}'.")
+        return {"method": method, "mode": mode,
+                "top_k": max(1, min(int(params.get('top_k', CORRELATION_DEFAULT_TOP_K)), 1000))}
+    if analysis_type == 'value_counts':
+        column = params.get('column')
+        if column not in columns: raise ValueError(f"Column '{column}' not found in dataset.")
+        return {"column": column, "top_n": max(1, min(int(params.get('top_n', 20)), 1000)),
+                "dropna": bool(params.get('dropna', False))}
+    if analysis_type == 'group_summary':
+        group_by = params.get('group_by'); value_column = params.get('value_column')
+        if group_by not in columns: raise ValueError(f"Group-by column '{group_by}' not found in dataset.")
+        if value_column is not None and value_column not in columns: raise ValueError(f"Value column '{value_column}' not found in dataset.")
+        aggregations = params.get('aggregations') or ['count', 'mean', 'min', 'max']
+        unsupported = [agg for agg in aggregations if agg not in GROUP_SUMMARY_AGGREGATIONS]
+        if unsupported: raise ValueError(f"Unsupported aggregations: {', '.join(map(str, unsupported))}")
+        return {"group_by": group_by, "value_column": value_column,
+                "aggregations": [agg for agg in GROUP_SUMMARY_AGGREGATIONS if agg in aggregations]}
+    raise ValueError(f"Unsupported analysis type '{analysis_type}'.")
+
+def get_analysis_key(analysis_type, version, params):
+    """Memo key for analysis_results (no '.' or '$', so it is a valid MongoDB field name)."""
+    params_hash = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:12]
+    return f"{analysis_type}:{version}:{params_hash}"
+
+def _json_safe(obj):
+    """Round-trips a pandas object through to_json (handles NA, NaT, numpy scalars)."""
+    return json.loads(obj.to_json(date_format='iso', default_handler=str))
+
+def compute_analysis(df, analysis_type, params):
+    """Runs one analysis with normalized params and returns a JSON-serializable result."""
+    if analysis_type == 'descriptive_stats':
+        subset = df[params['columns']] if params.get('columns') else df
+        if subset.shape[1] == 0: return {"statistics": {}}
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning) # All-null numeric columns
+            described = subset.describe(include='all')
+        return {"statistics": _json_safe(described)}
+
+    if analysis_type == 'correlation':
+        return correlation_analysis(df, method=params['method'], mode=params['mode'], top_k=params['top_k'])
+
+    if analysis_type == 'value_counts':
+        series = df[params['column']]
+        counts = series.value_counts(dropna=params['dropna'])
+        total = int(counts.sum())
+        top = counts.head(params['top_n'])
+        values = json.loads(pd.Series(top.index).to_json(orient='values', date_format='iso', default_handler=str))
+        return {
+            "column": params['column'],
+            "distinct_values": int(len(counts)),
+            "counts": [{"value": value, "count": int(count), "percent": round(100.0 * count / total, 2) if total else 0.0}
+                       for value, count in zip(values, top.tolist())]
+        }
+
+    if analysis_type == 'group_summary':
+        group_by, value_column = params['group_by'], params['value_column']
+        grouped = df.groupby(group_by, dropna=False, observed=True, sort=False)
+        if value_column is None:
+            summary = grouped.size().rename('count').to_frame()
+        else:
+            aggregations = params['aggregations']
+            if not (pd.api.types.is_numeric_dtype(df[value_column]) and not pd.api.types.is_bool_dtype(df[value_column])):
+                aggregations = [agg for agg in aggregations if agg == 'count'] or ['count'] # Only counts make sense for text
+            summary = grouped[value_column].agg(aggregations)
+            summary['rows'] = grouped.size()
+        sort_column = 'rows' if 'rows' in summary.columns else 'count'
+        summary = summary.sort_values(sort_column, ascending=False)
+        group_count = int(len(summary))
+        summary = summary.head(ANALYSIS_MAX_GROUPS).reset_index()
+        return {"group_by": group_by, "value_column": value_column, "group_count": group_count,
+                "truncated": group_count > ANALYSIS_MAX_GROUPS,
+                "groups": json.loads(summary.to_json(orient='records', date_format='iso', default_handler=str))}
+
+    raise ValueError(f"Unsupported analysis type '{analysis_type}'.")
+
+
+# --- Aggregation Cube ---
+# For the low-cardinality text columns of a dataset version (the "dimensions"),
+# row counts plus sum/count/min/max of every numeric column (the "measures") are
+# precomputed per value and per pair of values, in the background after upload
+# and after each cleaning step. Grouped bar/pie plots and group summaries over
+# those columns are then answered from a few hundred cells instead of a groupby
+# over the full frame. The cube is a long Feather table next to the dataset,
+# named by the cleaning chain like checkpoints. remove_checkpoints deletes it
+# with the checkpoint when a redo branch is abandoned; cubes of versions still
+# reachable by undo/redo are kept for reuse:
+#   __grouping (index into meta["groupings"]), d<i> (dimension labels, null when
+#   the dimension is not part of the grouping), __rows, m<j>__sum/__count/__min/__max
+# Its meta (dimension/measure names and groupings) is stored on the upload record.
+CUBE_MAX_CARDINALITY = 50
+CUBE_MAX_DIMENSIONS = 6
+CUBE_MAX_MEASURES = 30
+CUBE_MAX_CELLS = 2500 # Largest value pair grouping (product of cardinalities) that is precomputed
+CUBE_META_KEY = b'vision_ai_cube'
+CUBE_STATISTICS = ('sum', 'count', 'min', 'max')
+
+def get_cube_path(filepath, chain):
+    return f"{filepath}.step-{get_chain_key(chain)}.cube{SIDECAR_SUFFIX}"
+
+def _is_text_dimension(series):
+    """String-valued columns only, so cube labels match the values a groupby on the frame returns."""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return pd.api.types.infer_dtype(series.cat.categories, skipna=True) == 'string'
+    if not (pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)): return False
+    return pd.api.types.infer_dtype(series, skipna=True) in ('string', 'empty')
+
+def select_cube_columns(df, max_cardinality=CUBE_MAX_CARDINALITY, max_dimensions=CUBE_MAX_DIMENSIONS, max_measures=CUBE_MAX_MEASURES):
+    """Returns (dimensions as [(name, cardinality)], lowest cardinality first, measure names)."""
+    dimensions = []
+    for col in df.columns:
+        series = df[col]
+        if not _is_text_dimension(series): continue
+        cardinality = int(series.nunique(dropna=True))
+        if 1 <= cardinality <= max_cardinality: dimensions.append((col, cardinality))
+    dimensions = sorted(dimensions, key=lambda item: item[1])[:max_dimensions]
+    measures = [col for col in df.columns
+                if pd.api.types.is_numeric_dtype(df[col]) and not pd.api.types.is_bool_dtype(df[col])][:max_measures]
+    return dimensions, measures
+
+def _cube_cells(codes, sizes, values, measure_count):
+    """Aggregates measure values per combined dimension code. Returns (cell codes, rows, {stat: n_cells x m array})."""
+    combined = np.zeros(len(values), dtype=np.int64)
+    for code, size in zip(codes, sizes): combined = combined * size + code
+    grouped = pd.DataFrame(values).groupby(combined, sort=True)
+    rows = grouped.size()
+    stats = {stat: getattr(grouped, stat)().to_numpy(dtype='float64') for stat in CUBE_STATISTICS} if measure_count else \
+            {stat: np.empty((len(rows), 0)) for stat in CUBE_STATISTICS}
+    return rows.index.to_numpy(dtype=np.int64), rows.to_numpy(dtype=np.int64), stats
+
+def build_aggregate_cube(df, max_cardinality=CUBE_MAX_CARDINALITY, max_dimensions=CUBE_MAX_DIMENSIONS,
+                         max_cells=CUBE_MAX_CELLS, max_measures=CUBE_MAX_MEASURES):
+    """
+    Computes the aggregation cube of df (see module notes). Returns (cube DataFrame, meta),
+    or (None, None) if df has no suitable dimension column.
+    """
+    dimensions, measures = select_cube_columns(df, max_cardinality, max_dimensions, max_measures)
+    if not dimensions: return None, None
+    labels, codes = [], []
+    for name, _ in dimensions:
+        code, uniques = pd.factorize(df[name], use_na_sentinel=True)
+        codes.append(np.where(code < 0, len(uniques), code)) # Nulls get their own label (None)
+        labels.append(np.array([str(value) for value in uniques] + [None], dtype=object))
+    sizes = [len(label) for label in labels]
+    values = df[measures].to_numpy(dtype='float64', na_value=np.nan) if measures else np.empty((len(df), 0))
+
+    groupings = [[i] for i in range(len(dimensions))]
+    groupings += [[i, j] for i in range(len(dimensions)) for j in range(i + 1, len(dimensions)) if sizes[i] * sizes[j] <= max_cells]
+    parts = []
+    for grouping_id, grouping in enumerate(groupings):
+        cell_codes, rows, stats = _cube_cells([codes[i] for i in grouping], [sizes[i] for i in grouping], values, len(measures))
+        part = {"__grouping": np.full(len(rows), grouping_id, dtype=np.int16)}
+        remainder = cell_codes
+        for i in reversed(grouping): # Decode the combined code, innermost dimension first
+            part[f"d{i}"] = labels[i][remainder % sizes[i]]; remainder = remainder // sizes[i]
+        part["__rows"] = rows
+        for j in range(len(measures)):
+            for stat in CUBE_STATISTICS: part[f"m{j}__{stat}"] = stats[stat][:, j]
+        parts.append(pd.DataFrame(part))
+    cube = pd.concat(parts, ignore_index=True)
+    for i in range(len(dimensions)):
+        column = f"d{i}"
+        cube[column] = cube[column].astype('string') # Every dimension has its single-column grouping
+    cube = cube[["__grouping"] + [f"d{i}" for i in range(len(dimensions))] + [c for c in cube.columns if c == "__rows" or c.startswith('m')]]
+    meta = {"dimensions": [{"name": name, "cardinality": cardinality} for name, cardinality in dimensions],
+            "measures": [{"name": name, "integer": bool(pd.api.types.is_integer_dtype(df[name]))} for name in measures],
+            "groupings": groupings, "cells": int(len(cube)), "rows": int(len(df))}
+    return cube, meta
+
+def write_aggregate_cube(cube, meta, filepath, chain):
+    """Stores a cube (with its meta in the schema metadata) for the dataset state at the end of chain."""
+    return _write_feather_file(cube, get_cube_path(filepath, chain), filepath,
+                               extra_metadata={CUBE_META_KEY: json.dumps(meta).encode('utf-8')})
+
+def read_aggregate_cube_meta(filepath, chain):
+    """Meta of a fresh stored cube for the end of chain, or None."""
+    cube_path = get_cube_path(filepath, chain)
+    if not _is_feather_fresh(cube_path, filepath): return None
+    try:
+        with pa.memory_map(cube_path, 'r') as source:
+            metadata = pa.ipc.open_file(source).schema.metadata or {}
+        return json.loads(metadata[CUBE_META_KEY]) if CUBE_META_KEY in metadata else None
+    except Exception as meta_err:
+        logging.warning(f"Could not read cube metadata '{os.path.basename(cube_path)}': {meta_err}")
+        return None
+
+def cube_grouping(cube, meta, dimensions):
+    """
+    Cells of the cube grouping over exactly these dimension names, as a DataFrame
+    with one column per dimension (in the order given) plus the cube's __rows and
+    m<j>__* columns - or None if the cube does not cover that grouping.
+    """
+    names = [dim['name'] for dim in meta.get('dimensions', [])]
+    if not dimensions or any(name not in names for name in dimensions) or len(set(dimensions)) != len(dimensions): return None
+    indices = sorted(names.index(name) for name in dimensions)
+    if indices not in meta.get('groupings', []): return None
+    cells = cube[cube['__grouping'] == meta['groupings'].index(indices)]
+    grouped = pd.DataFrame({name: cells[f"d{names.index(name)}"].to_numpy(dtype=object) for name in dimensions})
+    for column in cells.columns:
+        if column == '__rows' or column.startswith('m'): grouped[column] = cells[column].to_numpy()
+    return grouped.reset_index(drop=True)
+
+def cube_measure(meta, column):
+    """Index and meta entry of a cube measure (numeric column), or (None, None)."""
+    for j, measure in enumerate(meta.get('measures', [])):
+        if measure['name'] == column: return j, measure
+    return None, None
+
+def cube_statistic(cells, measure_index, measure, statistic):
+    """One per-cell statistic of a measure ('count', 'sum', 'mean', 'min' or 'max') from cube_grouping cells."""
+    if statistic == 'mean':
+        counts = cells[f"m{measure_index}__count"].to_numpy(dtype='float64')
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return pd.Series(np.where(counts > 0, cells[f"m{measure_index}__sum"].to_numpy() / counts, np.nan))
+    values = pd.Series(cells[f"m{measure_index}__{statistic}"].to_numpy())
+    if statistic == 'count' or (measure['integer'] and statistic in ('sum', 'min', 'max')):
+        return values.round().astype('Int64') # Same integer output as a groupby on the frame
+    return values
+
+def group_summary_from_cube(cube, meta, params):
+    """
+    Answers a normalized group_summary analysis from the cube, or returns None
+    when the cube does not cover it (e.g. median, or a text value column).
+    """
+    group_by, value_column = params['group_by'], params['value_column']
+    cells = cube_grouping(cube, meta, [group_by])
+    if cells is None: return None
+    summary = pd.DataFrame({group_by: cells[group_by]})
+    if value_column is None:
+        summary['count'] = cells['__rows']
+    else:
+        measure_index, measure = cube_measure(meta, value_column)
+        if measure is None or any(agg not in ('count', 'mean', 'sum', 'min', 'max') for agg in params['aggregations']): return None
+        for agg in params['aggregations']: summary[agg] = cube_statistic(cells, measure_index, measure, agg)
+        summary['rows'] = cells['__rows']
+    sort_column = 'rows' if 'rows' in summary.columns else 'count'
+    summary = summary.sort_values(sort_column, ascending=False, kind='mergesort')
+    group_count = int(len(summary))
+    summary = summary.head(ANALYSIS_MAX_GROUPS).reset_index(drop=True)
+    return {"group_by": group_by, "value_column": value_column, "group_count": group_count,
+            "truncated": group_count > ANALYSIS_MAX_GROUPS,
+            "groups": json.loads(summary.to_json(orient='records', date_format='iso', default_handler=str))}
+
+
+# --- Process Pool Tasks ---
+# Module-level entry points for executor_utils.run_in_process. Each one reads
+# its input from disk (sidecar/row hashes when fresh) and leaves bulky output
+# on disk, returning only small picklable results to the web process.
+
+def prepare_sidecar_task(filepath):
+    """Makes sure a fresh columnar sidecar exists for filepath. Returns its path, or None if none could be written."""
+    if is_sidecar_fresh(filepath):
+        return get_sidecar_path(filepath)
+    df = get_dataframe(filepath)
+    return get_sidecar_path(filepath) if df is not None and is_sidecar_fresh(filepath) else None
+
+def aggregate_cube_task(filepath, chain, max_cardinality=CUBE_MAX_CARDINALITY, max_dimensions=CUBE_MAX_DIMENSIONS):
+    """
+    Builds (or reuses) the aggregation cube of the dataset state at the end of chain.
+    Returns the cube meta plus its "path", or None if the dataset has no dimension column.
+    """
+    meta = read_aggregate_cube_meta(filepath, chain)
+    if meta is None:
+        df, _ = materialize_dataset(filepath, chain)
+        if df is None: raise ValueError("Failed to load data file.")
+        cube, meta = build_aggregate_cube(df, max_cardinality=max_cardinality, max_dimensions=max_dimensions)
+        if cube is None: return None
+        if write_aggregate_cube(cube, meta, filepath, chain) is None: return None
+    return dict(meta, path=get_cube_path(filepath, chain))
+
+def profile_upload_task(filepath, stats_mode='exact', approximate_min_rows=1000000,
+                        streaming_threshold_bytes=None, chunk_rows=STREAMING_CHUNK_ROWS, progress_callback=None,
+                        progress_path=None):
+    """
+    Parses and profiles an uploaded file, writing its sidecar and row hashes.
+    Files at or above streaming_threshold_bytes are processed in chunks, reporting
+    the rows read so far to progress_callback(rows), or (in a pool worker) to
+    progress_path as {"rows_processed"} (see read_progress_file).
+    Returns the profile dict; raises ValueError for unreadable files.
+    """
+    if progress_path:
+        progress_callback = lambda rows: write_progress_file(progress_path, {"rows_processed": rows})
+    if (streaming_threshold_bytes is not None and not is_columnar_dataset(filepath)
+            and os.path.getsize(filepath) >= streaming_threshold_bytes):
+        profile = generate_data_profile_streaming(filepath, chunksize=chunk_rows, progress_callback=progress_callback)
+        _, row_hashes = write_dataframe_sidecar_streaming(filepath, profile.get('column_info', []), chunksize=chunk_rows)
+        profile["duplicate_row_count"] = count_duplicate_rows(row_hashes) if row_hashes is not None else "Error"
+        return profile
+    df = get_dataframe(filepath)
+    if df is None: raise ValueError("Failed to read or unsupported file format.")
+    row_hashes = get_row_hashes(df, filepath) # Persisted so duplicate checks never re-hash the file
+    mode = resolve_stats_mode(stats_mode, len(df), approximate_min_rows)
+    return generate_data_profile(df, stats=compute_column_stats(df, mode=mode, row_hashes=row_hashes))
+
+def materialize_task(filepath, chain):
+    """
+    Makes sure a Feather file holding the dataset version at the end of chain
+    exists (the sidecar for the raw version, else a checkpoint), replaying steps
+    here so the web process only memory-maps the result. Returns its path, or
+    None if the version cannot be stored as Feather.
+    """
+    if not chain: return prepare_sidecar_task(filepath)
+    checkpoint_path = get_checkpoint_path(filepath, chain)
+    if _is_feather_fresh(checkpoint_path, filepath): return checkpoint_path
+    df, row_hashes = materialize_dataset(filepath, chain)
+    if df is None: raise ValueError("Failed to load data file.")
+    return write_checkpoint(df, row_hashes, filepath, chain)
+
+def apply_cleaning_task(filepath, parent_chain, step):
+    """
+    Applies a logged step on top of the version at the end of parent_chain and
+    stages a checkpoint of the result (publish_checkpoint once the step is
+    recorded). Returns (message, staged_path); raises ValueError for invalid actions.
+    """
+    df, row_hashes = materialize_dataset(filepath, parent_chain)
+    if df is None: raise ValueError("Failed to load data file.")
+    df, row_hashes, message = apply_cleaning_operation(df, step.get('action'), column=step.get('column'),
+                                                       params=step.get('params'), row_hashes=row_hashes)
+    return message, write_checkpoint(df, row_hashes, filepath, parent_chain + [step], staged=True)
+
+def column_stats_task(filepath, chain=None, mode='exact'):
+    """compute_column_stats for the dataset version at the end of chain (the raw file if empty)."""
+    df, row_hashes = materialize_dataset(filepath, chain or [])
+    if df is None: raise ValueError("Failed to load data file.")
+    return compute_column_stats(df, mode=mode, row_hashes=row_hashes)
+
+def analysis_task(filepath, chain, analysis_type, params):
+    """compute_analysis on the dataset version at the end of chain."""
+    df, _ = materialize_dataset(filepath, chain or [])
+    if df is None: raise ValueError("Failed to load data file.")
+    return compute_analysis(df, analysis_type, params)
+
+def write_dataframe_file(df, target, fileformat):
+    """Writes df as 'csv' or 'xlsx' to target (a path or binary buffer)."""
+    if fileformat == 'csv':
+        # Use utf-8-sig for better Excel compatibility with CSVs
+        df.to_csv(target, index=False, encoding='utf-8-sig')
+    elif fileformat == 'xlsx':
+        write_xlsx_streaming(df, target)
     else:
-        prompt += "\n**Cleaning Steps Applied:** None\n"
+        raise ValueError(f"Unsupported download format '{fileformat}'.")
+
+# --- Write-Only XLSX Export ---
+# openpyxl's write_only mode streams each row to the output instead of building
+# the full workbook in memory. Excel caps a sheet at 1,048,576 rows (header
+# included), so larger frames continue on further sheets, each with the header.
+XLSX_MAX_SHEET_ROWS = 1048576
+XLSX_EXPORT_CHUNK_ROWS = 50000
+
+def _xlsx_cell_frame(chunk):
+    """Chunk converted to openpyxl-compatible object values (None for nulls, naive datetimes, no control characters)."""
+    from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+    chunk = chunk.copy()
+    for col in chunk.columns:
+        series = chunk[col]
+        if isinstance(series.dtype, pd.DatetimeTZDtype):
+            chunk[col] = series.dt.tz_localize(None) # Excel has no time zones
+        elif series.dtype == object or pd.api.types.is_string_dtype(series):
+            chunk[col] = series.map(lambda value: ILLEGAL_CHARACTERS_RE.sub('', value) if isinstance(value, str) else value)
+    values = chunk.astype(object)
+    return values.where(chunk.notna(), None)
+
+def write_xlsx_streaming(df, target, sheet_name='Cleaned_Data', chunk_rows=XLSX_EXPORT_CHUNK_ROWS,
+                         max_sheet_rows=XLSX_MAX_SHEET_ROWS, progress_callback=None):
+    """
+    Writes df to target (path or binary buffer) with a write-only openpyxl workbook,
+    starting a new sheet (sheet_name, sheet_name_2, ...) whenever a sheet is full.
+    progress_callback(rows_written, total_rows, sheets) is called after each chunk.
+    Returns the number of sheets written.
+    """
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        logging.error("XLSX export failed: 'openpyxl' library not found. Please install it (`pip install openpyxl`).")
+        raise
+    header = [str(col) for col in df.columns]
+    data_rows_per_sheet = max(1, max_sheet_rows - 1)
+    total_rows = len(df)
+    workbook = Workbook(write_only=True)
+    sheets = 0
+    for sheet_start in range(0, max(total_rows, 1), data_rows_per_sheet):
+        sheets += 1
+        worksheet = workbook.create_sheet(title=sheet_name if sheets == 1 else f"{sheet_name}_{sheets}"[:31])
+        worksheet.append(header)
+        sheet_end = min(sheet_start + data_rows_per_sheet, total_rows)
+        for start in range(sheet_start, sheet_end, chunk_rows):
+            chunk = _xlsx_cell_frame(df.iloc[start:min(start + chunk_rows, sheet_end)])
+            for row in chunk.itertuples(index=False, name=None):
+                worksheet.append(row)
+            if progress_callback: progress_callback(min(start + chunk_rows, sheet_end), total_rows, sheets)
+    workbook.save(target)
+    if sheets > 1: logging.info(f"XLSX export split {total_rows} rows across {sheets} sheets")
+    return sheets
+
+def write_progress_file(progress_path, payload):
+    """Atomically writes a small JSON progress record (used by pool tasks to report progress)."""
+    temp_path = f"{progress_path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as progress_file:
+        json.dump(payload, progress_file)
+    os.replace(temp_path, progress_path)
+
+def read_progress_file(progress_path):
+    """Returns the last record written by write_progress_file, or None."""
+    try:
+        with open(progress_path, 'r', encoding='utf-8') as progress_file:
+            return json.load(progress_file)
+    except (OSError, ValueError):
+        return None
+
+# --- Streaming CSV Export ---
+# CSV downloads are produced as a generator of byte chunks (optionally gzip or
+# zstd compressed), so only one batch of rows is ever encoded in memory. With a
+# process pool the chunks are written to a temp file by write_download_task and
+# sent from disk; inline, the generator yields to other green threads per batch.
+CSV_DOWNLOAD_FORMATS = {
+    'csv': {"mimetype": 'text/csv', "compression": None},
+    'csv.gz': {"mimetype": 'application/gzip', "compression": 'gzip'},
+    'csv.zst': {"mimetype": 'application/zstd', "compression": 'zstd'},
+}
+CSV_STREAM_CHUNK_ROWS = 50000
+
+def get_csv_compressor(compression):
+    """Incremental compressor with compress(data) / flush() for the given compression (None = passthrough)."""
+    if compression is None:
+        return None
+    if compression == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 31) # wbits=31 -> gzip container
+    if compression == 'zstd':
+        if zstandard is None: raise ValueError("zstd downloads require the 'zstandard' package.")
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    raise ValueError(f"Unsupported compression '{compression}'.")
+
+def iter_csv_chunks(df, compression=None, chunk_rows=CSV_STREAM_CHUNK_ROWS):
+    """
+    Yields df as CSV bytes in batches of chunk_rows rows. The first chunk starts
+    with a UTF-8 BOM (Excel compatibility, like write_dataframe_file).
+    """
+    compressor = get_csv_compressor(compression)
+    chunk_rows = max(1, int(chunk_rows))
+    for start in range(0, max(len(df), 1), chunk_rows):
+        if start: time.sleep(0) # Yields to the eventlet hub between batches when patched
+        text = df.iloc[start:start + chunk_rows].to_csv(index=False, header=(start == 0))
+        data = text.encode('utf-8-sig' if start == 0 else 'utf-8')
+        if compressor is not None: data = compressor.compress(data)
+        if data: yield data
+    if compressor is not None:
+        tail = compressor.flush()
+        if tail: yield tail
+
+def write_csv_file(df, out_path, compression=None, chunk_rows=CSV_STREAM_CHUNK_ROWS):
+    """Writes the iter_csv_chunks output for df to out_path. Returns out_path."""
+    with open(out_path, 'wb') as out_file:
+        for data in iter_csv_chunks(df, compression, chunk_rows): out_file.write(data)
+    return out_path
 
-    prompt += """
+def write_download_task(filepath, fileformat, out_path, chain=None, progress_path=None, chunk_rows=CSV_STREAM_CHUNK_ROWS):
+    """
+    Writes the dataset version at the end of chain to out_path as xlsx or one of
+    CSV_DOWNLOAD_FORMATS (compressed as that format says). Returns out_path.
+    XLSX progress is recorded in progress_path (see read_progress_file) when given.
+    """
+    df, _ = materialize_dataset(filepath, chain or [])
+    if df is None: raise ValueError("Failed to load data file.")
+    if fileformat == 'xlsx':
+        report = None
+        if progress_path:
+            report = lambda rows, total, sheets: write_progress_file(progress_path, {"rows_written": rows, "total_rows": total, "sheets": sheets})
+        write_xlsx_streaming(df, out_path, progress_callback=report)
+    elif fileformat in CSV_DOWNLOAD_FORMATS:
+        write_csv_file(df, out_path, CSV_DOWNLOAD_FORMATS[fileformat]['compression'], chunk_rows)
+    else:
+        write_dataframe_file(df, out_path, fileformat)
+    return out_path
+
+
+# --- Insight Prompt Builder ---
+# The insight prompt is built against an explicit token budget so its size (and
+# Gemini latency) stays bounded however wide the dataset is. Columns are grouped
+# by name pattern + dtype family, the most informative ones get a detail line and
+# the long tail is summarized; consecutive repeats of a cleaning step are
+# collapsed; a small stratified row sample is added as a pipe-separated table.
+# Tokens are estimated as ~4 characters each (no tokenizer round-trip needed).
+INSIGHT_PROMPT_TOKEN_BUDGET = 6000
+INSIGHT_CHARS_PER_TOKEN = 4
+INSIGHT_COLUMN_SHARE = 0.55 # Of the budget left after the fixed text; steps get 0.2, the sample the rest
+INSIGHT_STEP_SHARE = 0.2
+INSIGHT_GROUP_MIN_COLUMNS = 3 # Name-pattern groups this large get one summary line
+INSIGHT_SAMPLE_ROWS = 8
+INSIGHT_SAMPLE_MAX_COLUMNS = 12
+INSIGHT_SAMPLE_CELL_CHARS = 20
+INSIGHT_NAME_LIST_CHARS = 120
+
+INSIGHT_REQUEST_TEXT = """
 **Analysis Request:**
 
-Based ONLY on the summary and cleaning steps provided above, provide the following in Markdown format:
+Based ONLY on the summary, cleaning steps and sample above, provide the following in Markdown format:
 
-1.  **Key Observations & Data Quality:**
-    *   (e.g., Comment on data size, presence of duplicates. Highlight columns with high null percentages or potentially problematic types like 'object' if many exist. Note potential identifiers or categorical features based on names/types/cardinality hints if available. Mention any significant cleaning steps applied and their likely impact.)
-2.  **Potential Analysis Directions:**
-    *   (e.g., Based on column names/types, suggest possible target variables for prediction or key metrics for analysis. Identify potential relationships to explore between numeric or numeric/categorical columns. Suggest if the data seems suitable for time series analysis, classification, regression, etc.)
-3.  **Recommendations for Next Steps:**
-    *   (e.g., Suggest specific visualizations: histograms/boxplots for numeric distributions, bar charts for categoricals, scatter plots for relationships. Recommend statistical tests like correlation for numeric pairs, t-tests/ANOVA if comparing groups seems relevant. Suggest feature engineering ideas like date part extraction, binning numerics, or creating interaction terms based *only* on column names/types.)
+1.  **Key Observations & Data Quality:** size, duplicates, columns with high null percentages or problematic types, likely identifiers/categoricals, and the likely impact of the cleaning steps.
+2.  **Potential Analysis Directions:** candidate targets or key metrics, relationships worth exploring, and whether the data suits time series analysis, classification, regression, etc.
+3.  **Recommendations for Next Steps:** specific visualizations, statistical tests and feature engineering ideas.
 
-**Important:** Focus on actionable insights derived *strictly* from the provided profile and cleaning information. Do not invent data points or assume external knowledge about the dataset's domain. Keep the response concise and focused on data structure and potential.
+**Important:** Focus on actionable insights derived *strictly* from the provided information. Do not invent data points or assume external knowledge about the dataset's domain. Summarized column groups stand for all of their members. Keep the response concise, one point per bullet.
 """
+
+def estimate_tokens(text):
+    """Rough token count for budgeting prompts (about 4 characters per token)."""
+    return -(-len(text) // INSIGHT_CHARS_PER_TOKEN)
+
+def _dtype_family(dtype):
+    """Coarse dtype family used to group columns in the insight prompt."""
+    dtype = str(dtype).lower()
+    if 'datetime' in dtype: return 'datetime'
+    if 'bool' in dtype: return 'bool'
+    if 'int' in dtype: return 'integer'
+    if 'float' in dtype: return 'float'
+    if 'category' in dtype: return 'category'
+    return 'text'
+
+def _name_pattern(name):
+    """Column name with digit runs replaced by '#', so year_2019/year_2020 share a pattern."""
+    pattern, in_digits = [], False
+    for char in str(name):
+        if char.isdigit():
+            if not in_digits: pattern.append('#')
+            in_digits = True
+        else:
+            pattern.append(char); in_digits = False
+    return ''.join(pattern)
+
+def _join_names(names, max_chars=INSIGHT_NAME_LIST_CHARS):
+    """Comma-joined names cut to max_chars, noting how many were left out."""
+    shown, length = [], 0
+    for name in names:
+        length += len(str(name)) + 2
+        if shown and length > max_chars: break
+        shown.append(str(name))
+    text = ", ".join(shown)
+    if len(shown) < len(names): text += f", ... (+{len(names) - len(shown)})"
+    return text
+
+def _null_text(null_count, row_count):
+    if not isinstance(null_count, (int, np.integer)): return "nulls N/A"
+    if row_count <= 0: return f"nulls {null_count}"
+    return f"nulls {null_count} ({null_count / row_count * 100:.1f}%)"
+
+def _column_interest(col, row_count):
+    """Ranks columns for a detail line: null-heavy, low-cardinality and date columns first."""
+    score = 0.0
+    null_count = col.get('null_count')
+    if isinstance(null_count, (int, np.integer)) and row_count > 0: score += null_count / row_count * 2
+    nunique = col.get('nunique')
+    if isinstance(nunique, (int, np.integer)) and row_count > 0:
+        if nunique <= 1: score += 1.5 # Constant column
+        elif nunique <= 50: score += 1.0 # Likely categorical
+        elif nunique >= row_count: score += 0.5 # Likely identifier
+    if _dtype_family(col.get('dtype')) == 'datetime': score += 1.0
+    return score
+
+def _column_lines(column_info, row_count, budget_tokens):
+    """Column section lines: dtype counts, pattern groups, then per-column details until the budget runs out."""
+    if not column_info: return ["  (Column details not available)"]
+    families = {}
+    for col in column_info: families[_dtype_family(col.get('dtype'))] = families.get(_dtype_family(col.get('dtype')), 0) + 1
+    lines = ["- Column types: " + ", ".join(f"{family} {count}" for family, count in sorted(families.items(), key=lambda item: -item[1]))]
+
+    # Name-pattern groups (e.g. sales_2010 ... sales_2021) are summarized as one line each
+    groups = {}
+    for col in column_info:
+        groups.setdefault((_name_pattern(col.get('name')), _dtype_family(col.get('dtype'))), []).append(col)
+    grouped, singles = [], []
+    for (pattern, family), members in groups.items():
+        if len(members) >= INSIGHT_GROUP_MIN_COLUMNS: grouped.append((pattern, family, members))
+        else: singles.extend(members)
+
+    used = estimate_tokens(lines[0])
+    detail_lines, omitted = [], []
+    for pattern, family, members in sorted(grouped, key=lambda group: -len(group[2])):
+        null_counts = [m.get('null_count') for m in members if isinstance(m.get('null_count'), (int, np.integer))]
+        null_part = f", nulls {min(null_counts)}-{max(null_counts)}" if null_counts and max(null_counts) > 0 else ""
+        line = f"  - Group '{pattern}' ({family}) x{len(members)}: {_join_names([m.get('name') for m in members])}{null_part}"
+        if used + estimate_tokens(line) > budget_tokens: omitted.extend(members); continue
+        detail_lines.append(line); used += estimate_tokens(line) + 1
+
+    singles.sort(key=lambda col: -_column_interest(col, row_count))
+    for position, col in enumerate(singles):
+        nunique = col.get('nunique')
+        line = f"  - {col.get('name')}: {col.get('dtype')}, {_null_text(col.get('null_count'), row_count)}"
+        if isinstance(nunique, (int, np.integer)): line += f", {nunique} unique"
+        if used + estimate_tokens(line) > budget_tokens:
+            omitted.extend(singles[position:]); break
+        detail_lines.append(line); used += estimate_tokens(line) + 1
+
+    lines.append("- Column details:" if detail_lines else "- Column details: (omitted for size)")
+    lines.extend(detail_lines)
+    if omitted:
+        tail_families = {}
+        for col in omitted: tail_families[_dtype_family(col.get('dtype'))] = tail_families.get(_dtype_family(col.get('dtype')), 0) + 1
+        family_text = ", ".join(f"{family} {count}" for family, count in sorted(tail_families.items(), key=lambda item: -item[1]))
+        lines.append(f"  - ... {len(omitted)} more columns not listed ({family_text}): {_join_names([c.get('name') for c in omitted])}")
+    return lines
+
+def _step_signature(step):
+    """Action plus parameters (ignoring the column) - consecutive steps with equal signatures are collapsed."""
+    params = step.get('params') or {}
+    detail = ", ".join(f"{key}={params[key]}" for key in sorted(params) if not isinstance(params[key], (list, dict)))
+    return f"{step.get('action', 'N/A')}({detail})"
+
+def _step_lines(cleaning_steps, budget_tokens):
+    """Cleaning step lines with consecutive repeats collapsed; the oldest runs are dropped past the budget."""
+    if not cleaning_steps: return ["**Cleaning Steps Applied:** None"]
+    runs = []
+    for step in cleaning_steps:
+        signature = _step_signature(step)
+        if runs and runs[-1][0] == signature: runs[-1][1].append(step.get('column'))
+        else: runs.append((signature, [step.get('column')]))
+    run_lines = []
+    for signature, columns in runs:
+        named = [c for c in columns if c]
+        line = f"- {signature}"
+        if len(columns) > 1: line += f" x{len(columns)}"
+        if named: line += f" on {_join_names(named)}"
+        run_lines.append(line)
+    # Keep the most recent runs - they describe the dataset's current state
+    kept, used = [], 0
+    for line in reversed(run_lines):
+        if used + estimate_tokens(line) > budget_tokens: break
+        kept.append(line); used += estimate_tokens(line) + 1
+    kept.reverse()
+    header = f"**Cleaning Steps Applied ({len(cleaning_steps)} steps):**"
+    if len(kept) < len(run_lines):
+        return [header, f"- ... {len(run_lines) - len(kept)} earlier step groups omitted"] + kept
+    return [header] + kept
+
+def _sample_row_positions(df, column_info, sample_rows):
+    """
+    Stratified row positions: a few rows per value of the lowest-cardinality
+    text/category column (2..sample_rows values), else evenly spaced rows.
+    Returns (positions, strata column or None).
+    """
+    if len(df) <= sample_rows: return list(range(len(df))), None
+    strata_col = None
+    candidates = [c for c in column_info if _dtype_family(c.get('dtype')) in ('text', 'category', 'bool')
+                  and isinstance(c.get('nunique'), (int, np.integer)) and 2 <= c['nunique'] <= sample_rows and c.get('name') in df.columns]
+    if candidates:
+        strata_col = min(candidates, key=lambda c: c['nunique'])['name']
+    if strata_col is None:
+        return np.linspace(0, len(df) - 1, sample_rows).round().astype(int).tolist(), None
+    codes = pd.factorize(df[strata_col])[0]
+    per_stratum = max(1, sample_rows // max(1, codes.max() + 1))
+    positions = []
+    for code in np.unique(codes):
+        members = np.flatnonzero(codes == code)
+        positions.extend(members[np.linspace(0, len(members) - 1, min(per_stratum, len(members))).round().astype(int)].tolist())
+    return sorted(set(positions))[:sample_rows], strata_col
+
+def _sample_lines(df, column_info, budget_tokens, sample_rows=INSIGHT_SAMPLE_ROWS):
+    """Compact pipe-separated sample table, with rows dropped until it fits the budget."""
+    if df is None or df.empty or budget_tokens <= 0: return []
+    positions, strata_col = _sample_row_positions(df, column_info or [], sample_rows)
+    # The strata column and the most informative column of each dtype family first, then the next most informative ones
+    ranked = sorted((c for c in column_info or [] if c.get('name') in df.columns), key=lambda col: -_column_interest(col, len(df)))
+    seen_families, leaders, rest = set(), [strata_col] if strata_col is not None else [], []
+    for col in ranked:
+        if col.get('name') == strata_col: continue
+        family = _dtype_family(col.get('dtype'))
+        (rest if family in seen_families else leaders).append(col.get('name')); seen_families.add(family)
+    chosen = set((leaders + rest)[:INSIGHT_SAMPLE_MAX_COLUMNS]) if ranked else set(df.columns[:INSIGHT_SAMPLE_MAX_COLUMNS])
+    names = [name for name in df.columns if name in chosen] # Keep the dataset's column order
+    sample = df.iloc[positions][names]
+
+    def cell(value):
+        if isinstance(value, (float, np.floating)) and not pd.isna(value): return f"{value:.4g}"
+        text = "" if pd.isna(value) else str(value).replace('|', '/').replace('\n', ' ')
+        return text if len(text) <= INSIGHT_SAMPLE_CELL_CHARS else text[:INSIGHT_SAMPLE_CELL_CHARS - 1] + "~"
+
+    header = "|".join(cell(name) for name in names)
+    rows = ["|".join(cell(value) for value in row) for row in sample.itertuples(index=False, name=None)]
+    title = f"**Sample Rows ({len(rows)} of {len(df)}, {len(names)} of {len(df.columns)} columns, '|'-separated, '~' = truncated):**"
+    while rows and estimate_tokens("\n".join([title, header] + rows)) > budget_tokens:
+        rows = rows[::2] if len(rows) > 2 else rows[:-1] # Halving keeps the spread across strata
+        title = f"**Sample Rows ({len(rows)} of {len(df)}, {len(names)} of {len(df.columns)} columns, '|'-separated, '~' = truncated):**"
+    return [title, header] + rows if rows else []
+
+def generate_gemini_insight_prompt(profile, cleaning_steps, df=None, token_budget=INSIGHT_PROMPT_TOKEN_BUDGET):
+    """
+    Generates a prompt for Gemini based on data profile and cleaning steps, kept
+    within roughly token_budget tokens. profile['column_info'] entries may carry
+    'nunique' (as in compute_column_stats). If df is given, a stratified sample
+    of its rows is included.
+    """
+    row_count = profile.get('row_count', 0) or 0
+    col_count = profile.get('col_count', 0)
+
+    head = ("Analyze the following data profile and applied cleaning steps. Provide key insights, potential issues, "
+            "and recommendations for further analysis.\n\n**Data Profile Summary:**\n"
+            f"- Rows: {row_count}\n- Columns: {col_count}\n- Memory Usage: {profile.get('memory_usage', 'N/A')} bytes")
+    if "duplicate_row_count" in profile:
+        head += f"\n- Duplicate Rows Found: {profile['duplicate_row_count']}"
+
+    remaining = max(0, token_budget - estimate_tokens(head) - estimate_tokens(INSIGHT_REQUEST_TEXT))
+    column_section = "\n".join(_column_lines(profile.get('column_info', []), row_count, int(remaining * INSIGHT_COLUMN_SHARE)))
+    step_section = "\n".join(_step_lines(cleaning_steps or [], int(remaining * INSIGHT_STEP_SHARE)))
+    # The sample gets whatever the column and step sections left unused
+    sample_budget = remaining - estimate_tokens(column_section) - estimate_tokens(step_section) - 2
+    sample_section = "\n".join(_sample_lines(df, profile.get('column_info', []), sample_budget))
+
+    sections = [head, column_section, "", step_section]
+    if sample_section: sections += ["", sample_section]
+    prompt = "\n".join(sections) + "\n" + INSIGHT_REQUEST_TEXT
+    logging.debug(f"Insight prompt: ~{estimate_tokens(prompt)} tokens (budget {token_budget}) for {col_count} columns, {len(cleaning_steps or [])} steps")
     return prompt
 
+def parse_insight_response(text):
+    """Splits Gemini's Markdown answer into a list of insight strings (one per bullet/heading)."""
+    insights = []
+    for line in (text or "").splitlines():
+        line = line.strip().lstrip('-*•').strip()
+        unnumbered = line.lstrip('0123456789')
+        if unnumbered != line and unnumbered[:1] in ('.', ')'): line = unnumbered[1:].strip() # "1. ..." / "2) ..."
+        if line: insights.append(line)
+    return insights
+
 
 # --- PDF Report Generation Class ---
 # Uses fpdf2 (pip install fpdf2)
@@ -83,19 +83,25 @@ def ensure_indexes(db):
         "construction_agent_interactions": [("user_id", {})],
         "pdf_analysis": [
             ("user_id", {}), # Find analyses by user
-            ("upload_timestamp", {}) # Sort by upload time
+            ("upload_timestamp", {}), # Sort by upload time
+            ("content_sha256", {"sparse": True}) # Reuse extracted text of identical uploads
             ],
         "pdf_chats": [
             ("pdf_analysis_id", {}), # Find chats related to a specific PDF analysis
             ("user_id", {}) # Optionally index by user too if needed for direct query
             ],
+        "pdf_text_chunks": [
+            ([("pdf_analysis_id", 1), ("chunk_index", 1)], {"unique": True}), # Chunks of one PDF, in order (also serves pdf_analysis_id alone)
+            ([("pdf_analysis_id", 1), ("page_start", 1)], {}) # Fetch the chunks of a page range
+            ],
         "voice_conversations": [
             ("user_id", {"unique": True}), # Assuming one voice convo history per user
             ],
         "analysis_uploads": [
             ("user_id", {}), # Find uploads by user
             ("upload_timestamp", {}), # Sort by upload time
-            ("last_modified", {}) # Sort by last modified time
+            ("last_modified", {}), # Sort by last modified time
+            ("content_sha256", {"sparse": True}) # Reuse the profile of identical uploads
             ],
         "news_articles": [ # If storing articles
             ("url", {"unique": True, "sparse": True}), # Ensure unique URLs, allow docs without URL
@@ -143,7 +149,9 @@ def ensure_indexes(db):
             for field, options in indexes_to_create:
                 # Generate a predictable index name (e.g., 'user_id_1', 'email_1_sparse_unique')
                 # This helps check if an equivalent index already exists, even if MongoDB assigned a different name.
-                index_key_tuple = tuple(sorted([(field, 1)])) # PyMongo uses 1 for ASCENDING direction
+                # A field may also be a list of (field, direction) pairs for a compound index (key order matters)
+                index_keys = list(field) if isinstance(field, (list, tuple)) else [(field, 1)] # PyMongo uses 1 for ASCENDING direction
+                index_key_tuple = tuple(index_keys)
                 index_name_parts = [f"{k}_{v}" for k, v in index_key_tuple]
 
                 # Check if options make it unique or sparse etc. to add to name
@@ -157,7 +165,7 @@ def ensure_indexes(db):
                 index_exists = False
                 for name, info in existing_index_info.items():
                     # Compare the 'key' part of the index info
-                    if tuple(sorted(info.get('key', []))) == index_key_tuple:
+                    if tuple(info.get('key', [])) == index_key_tuple:
                         # Basic check passed, could compare options more rigorously if needed
                         index_exists = True
                         logging.debug(f"Index on field '{field}' (Key: {index_key_tuple}) already exists as '{name}' in '{coll_name}'. Skipping creation.")
@@ -168,7 +176,7 @@ def ensure_indexes(db):
                         # Add the generated name to options if you want consistent naming
                         create_options = options.copy()
                         create_options['name'] = proposed_index_name
-                        collection.create_index([(field, 1)], **create_options) # Pass options dict
+                        collection.create_index(index_keys, **create_options) # Pass options dict
                         logging.info(f"Successfully created index '{proposed_index_name}' on {coll_name}.{field} with options {create_options}")
                     except Exception as idx_err:
                         # Log specific error but continue trying other indexes/collections
@@ -0,0 +1,239 @@
+# src/utils/embedding_utils.py
+
+import functools
+import hashlib
+import logging
+import math
+import os
+import time
+import uuid
+import numpy as np
+
+from .pdf_utils import iter_pdf_chunks, PDF_CHUNK_TARGET_CHARS
+from .retrieval_utils import tokenize, select_hits
+
+# Optional: Gemini embeddings (pip install google-generativeai)
+try:
+    import google.generativeai as genai
+except ImportError:
+    genai = None
+
+# --- Chunk Embedding Index ---
+# Companion to the BM25 index: each PDF's chunks are embedded once at upload and
+# saved as a float32 .npy matrix (rows L2-normalised) next to the pages file,
+# with a small .npz of metadata (chunk ids/sizes and, for large documents, IVF
+# lists). Matrices are opened memory-mapped, so a question only pages in the rows
+# it scores, and every index belongs to one document - question latency does not
+# depend on how many documents a user has. Search is one matrix product for a
+# batch of queries. With IVF, rows are stored grouped by k-means cluster, so each
+# probed list is a contiguous slice of the matrix.
+# Embedders are pluggable: any object with .key (names the vectors, part of the
+# file name and stored in the metadata; a query is only searched against an
+# index of the same key, see embedding_index_matches), .dim and .embed(texts, task) -> float32 array works. "hashing" is a
+# deterministic local embedder (no network), usable offline and for benchmarks.
+EMBEDDING_BATCH_SIZE = 64
+EMBEDDING_TOP_K = 8
+EMBEDDING_IVF_MIN_ROWS = 4096 # Smaller documents are searched exhaustively
+EMBEDDING_IVF_NPROBE = 8
+EMBEDDING_KMEANS_ITERATIONS = 10
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return (matrix / np.where(norms == 0, 1, norms)).astype(np.float32, copy=False)
+
+class HashingEmbedder:
+    """
+    Feature-hashing embedder: unigrams and bigrams of tokenize() are hashed
+    (blake2b, stable across processes) into dim signed buckets weighted 1 + log(tf).
+    """
+    def __init__(self, dim=512):
+        self.dim = int(dim)
+        self.key = f"hashing{self.dim}"
+
+    @staticmethod
+    @functools.lru_cache(maxsize=200000)
+    def _bucket(feature, dim):
+        value = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+        return value % dim, (1.0 if (value >> 63) & 1 else -1.0)
+
+    def embed(self, texts, task="document"):
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            counts = {}
+            for feature in tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]:
+                counts[feature] = counts.get(feature, 0) + 1
+            for feature, count in counts.items():
+                bucket, sign = self._bucket(feature, self.dim)
+                matrix[row, bucket] += sign * (1 + math.log(count))
+        return _normalize_rows(matrix)
+
+class GeminiEmbedder:
+    """Gemini embedding model (needs google-generativeai and an API key)."""
+    def __init__(self, model="models/text-embedding-004", api_key=None, dim=768):
+        if genai is None: raise ImportError("google-generativeai is required for Gemini embeddings.")
+        if api_key: genai.configure(api_key=api_key) # Needed in pool workers, which start unconfigured
+        self.model, self.dim = model, int(dim)
+        self.key = f"gemini-{model.rsplit('/', 1)[-1]}"
+
+    def embed(self, texts, task="document"):
+        task_type = "retrieval_query" if task == "query" else "retrieval_document"
+        result = genai.embed_content(model=self.model, content=list(texts), task_type=task_type)
+        return _normalize_rows(np.asarray(result["embedding"], dtype=np.float32).reshape(len(texts), -1))
+
+EMBEDDERS = {"hashing": HashingEmbedder, "gemini": GeminiEmbedder}
+
+def get_embedder(name="hashing", **options):
+    """Embedder registered under name, constructed with options."""
+    if name not in EMBEDDERS: raise ValueError(f"Unknown embedder '{name}'. Available: {', '.join(EMBEDDERS)}")
+    return EMBEDDERS[name](**options)
+
+def embedder_settings(config):
+    """(name, options) of the embedder configured in a Flask config mapping (PDF_EMBEDDER)."""
+    name = config.get('PDF_EMBEDDER', 'hashing')
+    if name == "gemini":
+        return name, {"model": config.get('PDF_EMBEDDING_MODEL', "models/text-embedding-004"), "api_key": config.get('GEMINI_API_KEY')}
+    return name, {"dim": config.get('PDF_EMBEDDING_DIM', 512)} if name == "hashing" else {}
+
+def get_embedding_index_path(pages_path, embedder_key, target_chars=PDF_CHUNK_TARGET_CHARS):
+    """Matrix path; the metadata is stored beside it (see _meta_path)."""
+    return f"{pages_path}.emb-{embedder_key}-{int(target_chars)}.npy"
+
+def _meta_path(index_path):
+    return f"{index_path[:-len('.npy')]}.meta.npz"
+
+def get_embedding_index_files(index_path):
+    """Every file of the index at index_path (matrix and metadata)."""
+    return [index_path, _meta_path(index_path)]
+
+def embed_in_batches(embedder, texts, batch_size=EMBEDDING_BATCH_SIZE):
+    parts = [embedder.embed(texts[start:start + batch_size]) for start in range(0, len(texts), batch_size)]
+    return np.vstack(parts) if parts else np.zeros((0, embedder.dim), dtype=np.float32)
+
+def _spherical_kmeans(matrix, n_lists, iterations=EMBEDDING_KMEANS_ITERATIONS, seed=0):
+    """Cluster assignment of each row and the (normalised) centroids, by cosine similarity."""
+    rng = np.random.default_rng(seed) # Deterministic, so rebuilding gives the same lists
+    centroids = matrix[rng.choice(len(matrix), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(matrix @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, matrix)
+        empty = ~sums.any(axis=1)
+        sums[empty] = centroids[empty] # Keep the old centroid of an empty list
+        centroids = _normalize_rows(sums)
+    return np.argmax(matrix @ centroids.T, axis=1), centroids
+
+def build_embedding_index_task(pages_path, target_chars=PDF_CHUNK_TARGET_CHARS, embedder_name="hashing",
+                               embedder_options=None, ivf_min_rows=EMBEDDING_IVF_MIN_ROWS, out_path=None):
+    """
+    Process pool task: embeds the chunks of a pages file and writes the matrix
+    and its metadata atomically (an existing index is reused). Documents with at
+    least ivf_min_rows chunks (0 disables IVF) get ~sqrt(n) k-means lists.
+    Returns the matrix path.
+    """
+    embedder = get_embedder(embedder_name, **(embedder_options or {}))
+    out_path = out_path or get_embedding_index_path(pages_path, embedder.key, target_chars)
+    meta_path = _meta_path(out_path)
+    if os.path.exists(out_path) and os.path.exists(meta_path): return out_path
+    chunks = list(iter_pdf_chunks(pages_path, target_chars))
+    matrix = embed_in_batches(embedder, [chunk["text"] for chunk in chunks])
+    chunk_ids = np.array([chunk["chunk_index"] for chunk in chunks], dtype=np.int32)
+    chunk_chars = np.array([len(chunk["text"]) for chunk in chunks], dtype=np.int32)
+    meta = {"dim": np.int32(matrix.shape[1]), "embedder_key": np.array(embedder.key)}
+    if ivf_min_rows and len(matrix) >= ivf_min_rows:
+        assignment, centroids = _spherical_kmeans(matrix, int(math.sqrt(len(matrix))))
+        order = np.argsort(assignment, kind='stable') # Rows grouped by list, chunk order within a list
+        matrix, chunk_ids, chunk_chars = matrix[order], chunk_ids[order], chunk_chars[order]
+        meta["centroids"] = centroids
+        meta["list_offsets"] = np.searchsorted(assignment[order], np.arange(len(centroids) + 1)).astype(np.int64)
+    run_id = uuid.uuid4().hex[:8]
+    tmp_matrix, tmp_meta = f"{out_path}.{run_id}.tmp", f"{meta_path}.{run_id}.tmp"
+    try:
+        with open(tmp_matrix, 'wb') as matrix_file: np.save(matrix_file, np.ascontiguousarray(matrix, dtype=np.float32))
+        with open(tmp_meta, 'wb') as meta_file: np.savez(meta_file, chunk_ids=chunk_ids, chunk_chars=chunk_chars, **meta)
+        os.replace(tmp_meta, meta_path); os.replace(tmp_matrix, out_path) # Matrix last: it marks the index complete
+    finally:
+        for leftover in (tmp_matrix, tmp_meta):
+            if os.path.exists(leftover): os.remove(leftover)
+    logging.info(f"Embedding index built: {len(chunk_ids)} chunks x {matrix.shape[1]} ({embedder.key}"
+                 f"{', %d IVF lists' % len(meta['centroids']) if 'centroids' in meta else ''}) -> {os.path.basename(out_path)}")
+    return out_path
+
+@functools.lru_cache(maxsize=64)
+def _load_embedding_index(path, mtime):
+    with np.load(_meta_path(path)) as npz:
+        index = {name: npz[name] for name in npz.files}
+    index["matrix"] = np.load(path, mmap_mode='r') # Rows are paged in on demand
+    return index
+
+def load_embedding_index(path):
+    """Memory-mapped matrix plus metadata of path; cached per file."""
+    return _load_embedding_index(path, os.path.getmtime(path))
+
+def embedding_index_matches(index_path, embedder):
+    """True if the index at index_path was built by an embedder with the same .key (same vector space)."""
+    try: stored_key = load_embedding_index(index_path).get("embedder_key")
+    except Exception as load_err:
+        logging.warning(f"Could not read embedding index {os.path.basename(index_path)}: {load_err}")
+        return False
+    if stored_key is not None: return str(stored_key) == embedder.key
+    return f".emb-{embedder.key}-" in os.path.basename(index_path) # Indexes written before the key was stored
+
+def search_embedding_index(index, query_vectors, nprobe=EMBEDDING_IVF_NPROBE):
+    """
+    Scores a batch of normalised query vectors (q x dim) with one matrix product.
+    Returns (scores, positions): scores[i] aligns with positions, the matrix rows
+    that were scored (all rows, or those of the nprobe closest IVF lists, which
+    are the same for the whole batch). Ranking and top-k are left to the caller
+    (select_hits applies them together with the character budget).
+    """
+    matrix = index["matrix"]
+    query_vectors = np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))
+    if "centroids" not in index or nprobe >= len(index["centroids"]):
+        return query_vectors @ matrix.T, np.arange(len(matrix))
+    # Lists whose centroids best match any query in the batch
+    centroid_scores = (query_vectors @ index["centroids"].T).max(axis=0)
+    probed = np.sort(np.argpartition(-centroid_scores, nprobe - 1)[:nprobe])
+    offsets = index["list_offsets"]
+    positions = np.concatenate([np.arange(offsets[i], offsets[i + 1]) for i in probed])
+    rows = np.vstack([matrix[offsets[i]:offsets[i + 1]] for i in probed]) # Contiguous slices of the memmap
+    return query_vectors @ rows.T, positions
+
+def embedding_search_fn(index_path, embedder, nprobe=EMBEDDING_IVF_NPROBE):
+    """search_fn for retrieval_utils.build_chat_context using an embedding index."""
+    def search(question, top_k, max_chars):
+        index = load_embedding_index(index_path)
+        scores, positions = search_embedding_index(index, embedder.embed([question], task="query"), nprobe=nprobe)
+        return select_hits(scores[0], index["chunk_ids"][positions], index["chunk_chars"][positions], top_k, max_chars)
+    return search
+
+def benchmark_embedding_search(dim=512, rows=(1000, 10000, 100000), queries=32, top_k=EMBEDDING_TOP_K,
+                               nprobe=EMBEDDING_IVF_NPROBE, seed=0):
+    """
+    Times exhaustive and IVF search over synthetic clustered matrices of several
+    sizes (no network, no files). Returns one dict per size with per-query
+    milliseconds and the IVF recall of the exhaustive top_k.
+    """
+    rng = np.random.default_rng(seed)
+    results = []
+    for row_count in rows:
+        # Clustered rows (topics + noise), closer to real chunk embeddings than uniform noise
+        topics = rng.standard_normal((max(1, row_count // 50), dim), dtype=np.float32)
+        matrix = _normalize_rows(topics[rng.integers(0, len(topics), row_count)] + 0.5 * rng.standard_normal((row_count, dim), dtype=np.float32))
+        query_vectors = _normalize_rows(matrix[rng.choice(row_count, queries)] + 0.1 * rng.standard_normal((queries, dim), dtype=np.float32))
+        started = time.perf_counter()
+        exact = np.argpartition(-(query_vectors @ matrix.T), top_k - 1, axis=1)[:, :top_k]
+        exact_ms = (time.perf_counter() - started) * 1000 / queries
+        assignment, centroids = _spherical_kmeans(matrix, int(math.sqrt(row_count)), iterations=5)
+        order = np.argsort(assignment, kind='stable')
+        index = {"matrix": matrix[order], "centroids": centroids,
+                 "list_offsets": np.searchsorted(assignment[order], np.arange(len(centroids) + 1))}
+        started, found = time.perf_counter(), 0
+        for q, query_vector in enumerate(query_vectors): # One query per product, as in chat
+            scores, positions = search_embedding_index(index, query_vector, nprobe=nprobe)
+            best = order[positions[np.argsort(-scores[0])[:top_k]]]
+            found += len(set(best) & set(exact[q]))
+        ivf_ms = (time.perf_counter() - started) * 1000 / queries
+        results.append({"rows": row_count, "exact_ms_per_query": round(exact_ms, 3),
+                        "ivf_ms_per_query": round(ivf_ms, 3), "ivf_recall": round(found / (queries * top_k), 3)})
+    return results
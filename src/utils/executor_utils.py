@@ -0,0 +1,78 @@
+# src/utils/executor_utils.py
+
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# --- Process Pool for CPU-Bound Work ---
+# pandas parsing, profiling and file writing hold the CPU (and the GIL) for long
+# stretches, which blocks the eventlet hub and stalls every Socket.IO client.
+# These helpers run such work in a separate process instead. Tasks exchange
+# data through files (sidecars, row hashes, output files) and only return small,
+# picklable results, so whole DataFrames are never pickled between processes.
+
+PROCESS_POOL_POLL_SECONDS = 0.05
+
+def create_process_pool(max_workers):
+    """
+    Creates a ProcessPoolExecutor using the 'spawn' start method (forking an
+    eventlet-patched process is unsafe). Returns None when max_workers < 1,
+    in which case run_in_process executes tasks inline.
+    """
+    if not max_workers or max_workers < 1:
+        return None
+    try:
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+    except Exception as pool_err:
+        logging.error(f"Failed to create process pool ({max_workers} workers): {pool_err}. Running tasks inline.", exc_info=True)
+        return None
+
+def run_in_process(pool, fn, *args, timeout=None, on_poll=None, poll_interval=1.0, **kwargs):
+    """
+    Runs fn(*args, **kwargs) in the process pool and returns its result,
+    re-raising any exception from the worker. fn must be a module-level function.
+    Waits by polling with time.sleep, which yields to other green threads when
+    eventlet has patched the process. Runs inline when pool is None.
+    on_poll() is called about every poll_interval seconds while waiting (e.g. to
+    relay progress the task writes to a file).
+    """
+    if pool is None:
+        return fn(*args, **kwargs)
+    started = time.monotonic()
+    last_poll = started
+    future = pool.submit(fn, *args, **kwargs)
+    while not future.done():
+        if timeout is not None and time.monotonic() - started > timeout:
+            future.cancel()
+            raise TimeoutError(f"Process pool task {fn.__name__} exceeded {timeout}s")
+        time.sleep(PROCESS_POOL_POLL_SECONDS)
+        if on_poll is not None and time.monotonic() - last_poll >= poll_interval:
+            last_poll = time.monotonic()
+            try: on_poll()
+            except Exception as poll_err: logging.warning(f"on_poll callback for {fn.__name__} failed: {poll_err}")
+    logging.debug(f"Process pool task {fn.__name__} finished in {time.monotonic() - started:.2f}s")
+    return future.result()
+
+def map_in_process(pool, fn, arg_tuples, timeout=None):
+    """
+    Runs fn(*args) for every tuple in arg_tuples concurrently in the pool and
+    returns the results in the same order. Waits by polling like run_in_process;
+    if any task fails the rest are cancelled and its exception is re-raised.
+    Runs the calls one after another inline when pool is None.
+    """
+    if pool is None:
+        return [fn(*args) for args in arg_tuples]
+    started = time.monotonic()
+    futures = [pool.submit(fn, *args) for args in arg_tuples]
+    try:
+        while not all(future.done() for future in futures):
+            if timeout is not None and time.monotonic() - started > timeout:
+                raise TimeoutError(f"Process pool tasks {fn.__name__} exceeded {timeout}s")
+            failed = next((future for future in futures if future.done() and future.exception() is not None), None)
+            if failed is not None: failed.result() # Re-raises; no point waiting for the others
+            time.sleep(PROCESS_POOL_POLL_SECONDS)
+        logging.debug(f"{len(futures)} process pool tasks {fn.__name__} finished in {time.monotonic() - started:.2f}s")
+        return [future.result() for future in futures]
+    finally:
+        for future in futures: future.cancel() # No-op for finished tasks
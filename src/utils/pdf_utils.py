@@ -1,11 +1,19 @@
 import logging
 import traceback
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
 import fitz  # PyMuPDF library
+from .executor_utils import run_in_process, map_in_process, create_process_pool
 
 def extract_text_from_pdf(filepath):
     """
     Extracts all text from a PDF file using PyMuPDF.
     Returns tuple (full_text, num_pages) or (None, 0) on error.
+    NOTE: Serial, in-process path; uploads use extract_pdf_pages.
     """
     full_text = None
     num_pages = 0
@@ -17,11 +25,11 @@ def extract_text_from_pdf(filepath):
         for page_num in range(num_pages):
             page = doc.load_page(page_num)
             extracted_parts.append(page.get_text("text")) # Use "text" for better text extraction
-        full_text = "\n\n".join(extracted_parts) # Join pages with separator
+        full_text = PDF_PAGE_SEPARATOR.join(extracted_parts) # Join pages with separator
         logging.info(f"Successfully extracted text from '{filepath}' (Pages: {num_pages}, Text Length: {len(full_text)})")
     except FileNotFoundError:
         logging.error(f"Error opening PDF: File not found at {filepath}")
-    except fitz.fitz.FileDataError as e: # Catch specific PyMuPDF errors
+    except fitz.FileDataError as e: # Catch specific PyMuPDF errors
          logging.error(f"Error opening PDF {filepath}: Invalid PDF data or format. {e}")
          logging.error(traceback.format_exc())
     except Exception as e:
@@ -34,4 +42,220 @@ def extract_text_from_pdf(filepath):
                 doc.close()
             except Exception as close_err:
                  logging.error(f"Error closing PDF document {filepath}: {close_err}")
-    return full_text, num_pages
\ No newline at end of file
+    return full_text, num_pages
+
+
+# --- Page-Range Extraction ---
+# Pages are split into ranges that are extracted in parallel by process pool
+# workers, each opening its own fitz document (documents cannot be shared across
+# processes). Every worker writes its pages as JSON lines ({"page", "text"}) to a
+# part file; the parts are then concatenated in page order into one pages file
+# next to the PDF, so the text is written out page by page and never held in
+# memory as a whole. The request thread only polls, which yields to eventlet.
+PDF_PAGE_RANGE_SIZE = 50
+PDF_PAGES_SUFFIX = '.pages.jsonl'
+PDF_PAGE_SEPARATOR = "\n\n"
+
+def get_pages_path(filepath):
+    return f"{filepath}{PDF_PAGES_SUFFIX}"
+
+def pdf_page_count(filepath):
+    """Number of pages of a PDF (only the document structure is read)."""
+    with fitz.open(filepath) as doc:
+        return len(doc)
+
+def extract_page_range_task(filepath, start, stop, out_path):
+    """Writes pages [start, stop) of filepath as JSON lines to out_path. Returns the number of characters extracted."""
+    chars = 0
+    with fitz.open(filepath) as doc, open(out_path, 'w', encoding='utf-8') as out:
+        for page_num in range(start, stop):
+            text = doc.load_page(page_num).get_text("text")
+            out.write(json.dumps({"page": page_num + 1, "text": text}) + "\n")
+            chars += len(text)
+    return chars
+
+def extract_pdf_pages(filepath, pool=None, range_size=PDF_PAGE_RANGE_SIZE, pages_path=None):
+    """
+    Extracts the text of every page of filepath into pages_path (default
+    get_pages_path(filepath)) as JSON lines in page order, running page ranges
+    in the process pool (inline when pool is None). An existing pages file is
+    reused (stored PDFs are content-addressed, so it belongs to the same bytes).
+    Returns (pages_path, page_count); raises ValueError for unreadable PDFs.
+    """
+    pages_path = pages_path or get_pages_path(filepath)
+    if os.path.exists(pages_path):
+        with open(pages_path, 'rb') as pages_file:
+            return pages_path, sum(1 for _ in pages_file)
+    try:
+        page_count = run_in_process(pool, pdf_page_count, filepath)
+    except Exception as open_err:
+        raise ValueError(f"Could not open PDF: {open_err}")
+    range_size = max(1, int(range_size))
+    ranges = [(start, min(start + range_size, page_count)) for start in range(0, page_count, range_size)]
+    # Unique part names, so concurrent uploads of the same bytes do not interfere
+    run_id = uuid.uuid4().hex[:8]
+    part_paths = [f"{pages_path}.{run_id}.{start}.part" for start, _ in ranges]
+    tmp_path = f"{pages_path}.{run_id}.tmp"
+    started = time.monotonic()
+    try:
+        chars = map_in_process(pool, extract_page_range_task,
+                               [(filepath, start, stop, part_path) for (start, stop), part_path in zip(ranges, part_paths)])
+        with open(tmp_path, 'wb') as merged:
+            for part_path in part_paths:
+                with open(part_path, 'rb') as part: shutil.copyfileobj(part, merged)
+        os.replace(tmp_path, pages_path) # Atomic; readers never see a partial pages file
+    except ValueError:
+        raise
+    except Exception as extract_err:
+        logging.error(f"Error extracting PDF pages from {filepath}: {extract_err}", exc_info=True)
+        raise ValueError("Failed to extract text from the uploaded PDF.")
+    finally:
+        for leftover in part_paths + [tmp_path]:
+            if os.path.exists(leftover):
+                try: os.remove(leftover)
+                except OSError as rm_err: logging.error(f"Failed to remove {leftover}: {rm_err}")
+    logging.info(f"Extracted {page_count} pages ({sum(chars)} chars) from '{os.path.basename(filepath)}' in "
+                 f"{len(ranges)} ranges in {time.monotonic() - started:.2f}s")
+    return pages_path, page_count
+
+def iter_pdf_pages(pages_path):
+    """Yields (page_number, text) from a pages file, in page order."""
+    with open(pages_path, 'r', encoding='utf-8') as pages_file:
+        for line in pages_file:
+            page = json.loads(line)
+            yield page['page'], page['text']
+
+def read_pdf_text(pages_path, max_chars=None):
+    """Page texts joined like extract_text_from_pdf, reading only as many pages as max_chars needs."""
+    parts, length = [], 0
+    for _, text in iter_pdf_pages(pages_path):
+        parts.append(text); length += len(text) + len(PDF_PAGE_SEPARATOR)
+        if max_chars is not None and length >= max_chars: break
+    full_text = PDF_PAGE_SEPARATOR.join(parts)
+    return full_text[:max_chars] if max_chars is not None else full_text
+
+def benchmark_pdf_extraction(filepath, workers=4, range_size=PDF_PAGE_RANGE_SIZE):
+    """
+    Times the serial extractor against extract_pdf_pages on a fresh pool of
+    workers (pool start-up excluded) and checks both produce the same text.
+    Returns a dict of timings and pages/second, e.g. for tuning range_size.
+    """
+    pool = create_process_pool(workers)
+    try:
+        if pool is not None: run_in_process(pool, pdf_page_count, filepath) # Start the workers
+        started = time.perf_counter()
+        serial_text, page_count = extract_text_from_pdf(filepath)
+        serial_seconds = time.perf_counter() - started
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pages_path = os.path.join(tmp_dir, 'bench' + PDF_PAGES_SUFFIX)
+            started = time.perf_counter()
+            extract_pdf_pages(filepath, pool=pool, range_size=range_size, pages_path=pages_path)
+            parallel_seconds = time.perf_counter() - started
+            identical = read_pdf_text(pages_path) == serial_text
+    finally:
+        if pool is not None: pool.shutdown()
+    return {"pages": page_count, "workers": workers, "range_size": range_size, "identical_text": identical,
+            "serial_seconds": round(serial_seconds, 3), "parallel_seconds": round(parallel_seconds, 3),
+            "serial_pages_per_second": round(page_count / serial_seconds, 1) if serial_seconds else None,
+            "parallel_pages_per_second": round(page_count / parallel_seconds, 1) if parallel_seconds else None,
+            "speedup": round(serial_seconds / parallel_seconds, 2) if parallel_seconds else None}
+
+
+# --- Page-Aligned Text Chunks ---
+# The full text of a PDF is stored as chunks (one document each, in the
+# pdf_text_chunks collection) instead of a single preview string. Chunks hold
+# whole pages while they fit in target_chars; a longer page is cut on paragraph,
+# line or word breaks, so a chunk never straddles a partial page. Each chunk
+# records its pages and its [char_start, char_end) offsets in the full text
+# (pages joined with PDF_PAGE_SEPARATOR), so readers fetch only what they need.
+PDF_CHUNK_TARGET_CHARS = 4000
+PDF_CHUNK_INSERT_BATCH = 200
+
+def _split_long_page(text, target_chars):
+    """[start, end) pieces of one page's text, each at most target_chars, cut at the latest natural break."""
+    pieces, start = [], 0
+    while len(text) - start > target_chars:
+        window_end, cut = start + target_chars, -1
+        for separator in ("\n\n", "\n", " "):
+            cut = text.rfind(separator, start + target_chars // 2, window_end)
+            if cut != -1:
+                cut += len(separator); break
+        if cut == -1: cut = window_end # No break in the second half of the window; hard cut
+        pieces.append((start, cut)); start = cut
+    pieces.append((start, len(text)))
+    return pieces
+
+def _pdf_chunk(chunk_index, page_start, page_end, char_start, text):
+    return {"chunk_index": chunk_index, "page_start": page_start, "page_end": page_end,
+            "char_start": char_start, "char_end": char_start + len(text), "text": text}
+
+def iter_pdf_chunks(pages_path, target_chars=PDF_CHUNK_TARGET_CHARS):
+    """Yields page-aligned chunk dicts (see _pdf_chunk) from a pages file; blank chunks are skipped."""
+    target_chars = max(1, int(target_chars))
+    chunk_index, page_offset = 0, 0
+    pending, pending_start = [], 0 # Whole pages (number, text) waiting to be emitted as one chunk
+    for page_number, text in iter_pdf_pages(pages_path):
+        joined_len = sum(len(t) for _, t in pending) + len(PDF_PAGE_SEPARATOR) * len(pending)
+        if pending and (len(text) > target_chars or joined_len + len(text) > target_chars):
+            chunk_text = PDF_PAGE_SEPARATOR.join(t for _, t in pending)
+            if chunk_text.strip():
+                yield _pdf_chunk(chunk_index, pending[0][0], pending[-1][0], pending_start, chunk_text); chunk_index += 1
+            pending = []
+        if len(text) > target_chars:
+            for start, end in _split_long_page(text, target_chars):
+                if text[start:end].strip():
+                    yield _pdf_chunk(chunk_index, page_number, page_number, page_offset + start, text[start:end]); chunk_index += 1
+        else:
+            if not pending: pending_start = page_offset
+            pending.append((page_number, text))
+        page_offset += len(text) + len(PDF_PAGE_SEPARATOR)
+    if pending:
+        chunk_text = PDF_PAGE_SEPARATOR.join(t for _, t in pending)
+        if chunk_text.strip():
+            yield _pdf_chunk(chunk_index, pending[0][0], pending[-1][0], pending_start, chunk_text)
+
+def store_pdf_chunks(collection, pdf_analysis_id, pages_path, target_chars=PDF_CHUNK_TARGET_CHARS,
+                     batch_size=PDF_CHUNK_INSERT_BATCH):
+    """
+    Inserts the chunks of a pages file into collection for pdf_analysis_id, in
+    batches. Returns (chunk_count, text_length); text_length is the length of
+    the full text the chunk offsets refer to.
+    """
+    chunk_count, text_length, batch = 0, 0, []
+    for chunk in iter_pdf_chunks(pages_path, target_chars):
+        chunk["pdf_analysis_id"] = pdf_analysis_id
+        batch.append(chunk)
+        chunk_count += 1; text_length = chunk["char_end"]
+        if len(batch) >= batch_size:
+            collection.insert_many(batch); batch = []
+    if batch: collection.insert_many(batch)
+    return chunk_count, text_length
+
+def get_pdf_chunks(collection, pdf_analysis_id, chunk_indexes=None, pages=None, include_text=True):
+    """
+    Chunks of one PDF in chunk order, optionally only the given chunk_indexes or
+    those overlapping the inclusive page range pages=(first, last).
+    """
+    query = {"pdf_analysis_id": pdf_analysis_id}
+    if chunk_indexes is not None: query["chunk_index"] = {"$in": [int(i) for i in chunk_indexes]}
+    if pages is not None:
+        first_page, last_page = pages
+        query["page_start"] = {"$lte": int(last_page)}; query["page_end"] = {"$gte": int(first_page)}
+    projection = {"_id": 0, "pdf_analysis_id": 0}
+    if not include_text: projection["text"] = 0
+    return list(collection.find(query, projection).sort("chunk_index", 1))
+
+def read_pdf_chunk_text(collection, pdf_analysis_id, max_chars=None):
+    """Text from the start of the document, fetching chunks only until max_chars is reached."""
+    parts, length, previous_end = [], 0, None
+    for chunk in collection.find({"pdf_analysis_id": pdf_analysis_id}, {"_id": 0, "text": 1, "char_start": 1, "char_end": 1}).sort("chunk_index", 1):
+        if previous_end is not None and chunk["char_start"] > previous_end: # Page boundary (or skipped blank pages)
+            parts.append(PDF_PAGE_SEPARATOR); length += len(PDF_PAGE_SEPARATOR)
+        parts.append(chunk["text"]); length += len(chunk["text"]); previous_end = chunk["char_end"]
+        if max_chars is not None and length >= max_chars: break
+    full_text = "".join(parts)
+    return full_text[:max_chars] if max_chars is not None else full_text
+
+def delete_pdf_chunks(collection, pdf_analysis_id):
+    """Removes every chunk of one PDF; returns the number deleted."""
+    return collection.delete_many({"pdf_analysis_id": pdf_analysis_id}).deleted_count
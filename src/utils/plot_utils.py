@@ -0,0 +1,292 @@
+# src/utils/plot_utils.py
+
+import hashlib
+import json
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+import plotly.io as pio
+
+from .data_analyzer_utils import correlation_analysis, materialize_dataset, cube_grouping, cube_measure, cube_statistic
+
+# --- Server-Side Plot Reduction ---
+# Figures are built from reduced data so the JSON sent to the browser stays
+# roughly constant in size no matter how many rows the dataset has:
+#   line      -> LTTB downsampling (per colour group)
+#   scatter   -> raw points up to a threshold, 2D binned heatmap above it
+#   bar / pie -> categorical groupby before plotting
+#   histogram / density heatmap -> NumPy binning
+#   box       -> precomputed quartiles/fences per group
+#   violin    -> random row sample
+PLOT_LINE_MAX_POINTS = 2000
+PLOT_SCATTER_MAX_POINTS = 10000
+PLOT_SCATTER_BINS = 100
+PLOT_HISTOGRAM_BINS = 50
+PLOT_MAX_CATEGORIES = 50
+PLOT_PIE_MAX_SLICES = 20
+PLOT_VIOLIN_SAMPLE_ROWS = 5000
+PLOT_HEATMAP_MAX_COLUMNS = 50
+PLOT_TYPES = ('histogram', 'scatter', 'bar', 'line', 'box', 'violin', 'pie', 'heatmap', 'density_heatmap')
+CUBE_CHART_TYPES = ('bar', 'pie') # Answered from the aggregation cube when it covers the columns
+# Bump when figure construction changes so cached figures from older code are not served
+PLOT_CACHE_FORMAT = 1
+
+def normalize_plot_config(chart_type, x=None, y=None, color=None):
+    """Canonical plot config: empty selections become None and a colour equal to an axis is dropped."""
+    x = x or None; y = y or None; color = color or None
+    if color == x or color == y: color = None
+    return {"chart_type": chart_type, "x": x, "y": y, "color": color}
+
+def get_plot_cache_key(upload_id, version, config):
+    """File-name-safe cache key for a figure: upload, dataset version and a hash of the canonical config."""
+    canonical = json.dumps(dict(config, format=PLOT_CACHE_FORMAT), sort_keys=True, separators=(',', ':'), default=str)
+    return f"{upload_id}_{version}_{hashlib.sha1(canonical.encode('utf-8')).hexdigest()[:16]}"
+
+def lttb_indices(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling. x must be sorted ascending and
+    both arrays float without NaN. Returns the indices of the points to keep
+    (always including the first and last point).
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    # Bucket edges over the interior points (first and last are always kept)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0; selected[-1] = n - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], max(edges[bucket + 1], edges[bucket] + 1)
+        # Average of the next bucket (or the last point) is the third triangle vertex
+        next_start, next_end = edges[bucket + 1], (edges[bucket + 2] if bucket + 2 < len(edges) else n)
+        next_x = x[next_start:max(next_end, next_start + 1)].mean()
+        next_y = y[next_start:max(next_end, next_start + 1)].mean()
+        bucket_x, bucket_y = x[start:end], y[start:end]
+        areas = np.abs((x[previous] - next_x) * (bucket_y - y[previous]) - (x[previous] - bucket_x) * (next_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+    return selected
+
+def _as_float(series):
+    """Numeric or datetime column as float64 (datetimes as epoch nanoseconds), NaN for nulls."""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        values = series.to_numpy(dtype='datetime64[ns]').astype(np.int64).astype(np.float64)
+        values[series.isna().to_numpy()] = np.nan
+        return values
+    return pd.to_numeric(series, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+
+def _plot_values(series):
+    """
+    Trace values as NumPy arrays so plotly.io encodes them as base64 typed arrays
+    ('bdata') rather than JSON number lists. Datetimes become epoch milliseconds
+    (plot them on a 'date' axis); non-numeric values stay as strings.
+    """
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return _as_float(series) / 1e6
+    if _is_numeric(series):
+        return series.to_numpy(dtype=np.float64, na_value=np.nan)
+    return series.astype(str).to_numpy()
+
+def _is_numeric(series):
+    return pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series)
+
+def _require_columns(df, *columns):
+    for column in columns:
+        if column and column not in df.columns:
+            raise ValueError(f"Column '{column}' not found in dataset.")
+
+def _top_categories(series, limit):
+    """The limit most frequent values of a column (nulls excluded)."""
+    return series.value_counts(dropna=True).head(limit).index
+
+def _grouped_chart_figure(aggregated, chart_type, x, color, value_column, value_label):
+    """Bar/pie figure from per-group values (one row per x, or per x and colour for bars)."""
+    aggregated[x] = aggregated[x].astype(str)
+    if color and chart_type == 'bar': aggregated[color] = aggregated[color].astype(str)
+    if chart_type == 'pie':
+        return px.pie(aggregated, names=x, values=value_column, title=f"{value_label} by {x}")
+    figure = px.bar(aggregated, x=x, y=value_column, color=color if chart_type == 'bar' else None,
+                    barmode='group', title=f"{value_label} by {x}")
+    figure.update_layout(yaxis_title=value_label)
+    return figure
+
+def _binned_heatmap(df, x, y, bins, title):
+    """2D histogram of two numeric columns as a Heatmap trace (counts per cell)."""
+    x_values, y_values = _as_float(df[x]), _as_float(df[y])
+    keep = ~(np.isnan(x_values) | np.isnan(y_values))
+    counts, x_edges, y_edges = np.histogram2d(x_values[keep], y_values[keep], bins=bins)
+    counts = counts.astype(np.float32) # Counts are exact in float32 up to 2**24 per cell, at half the payload
+    counts[counts == 0] = np.nan # Empty cells stay transparent
+    figure = go.Figure(go.Heatmap(x=(x_edges[:-1] + x_edges[1:]) / 2, y=(y_edges[:-1] + y_edges[1:]) / 2,
+                                  z=counts.T, colorscale='Viridis', colorbar={"title": "Rows"},
+                                  hovertemplate=f"{x}=%{{x}}<br>{y}=%{{y}}<br>rows=%{{z}}<extra></extra>"))
+    figure.update_layout(title=title, xaxis_title=x, yaxis_title=y)
+    return figure, int(keep.sum())
+
+def build_plot_figure(df, chart_type, x, y=None, color=None):
+    """
+    Builds a Plotly figure for the cleaner's chart controls from reduced data.
+    Returns (figure, meta) where meta describes the reduction that was applied.
+    Raises ValueError for invalid chart types or columns.
+    """
+    if chart_type not in PLOT_TYPES: raise ValueError(f"Unsupported chart type '{chart_type}'.")
+    config = normalize_plot_config(chart_type, x, y, color)
+    x, y, color = config['x'], config['y'], config['color']
+    _require_columns(df, x, y, color)
+    if chart_type not in ('heatmap',) and not x: raise ValueError("An X-axis column is required.")
+    if chart_type in ('scatter', 'line', 'bar') and not y: raise ValueError(f"A Y-axis column is required for {chart_type} charts.")
+    rows = int(len(df))
+    meta = {"chart_type": chart_type, "rows": rows, "reduction": "none"}
+
+    if chart_type == 'histogram':
+        series = df[x]
+        if _is_numeric(series) or pd.api.types.is_datetime64_any_dtype(series):
+            values = _as_float(series); values = values[~np.isnan(values)]
+            counts, edges = np.histogram(values, bins=PLOT_HISTOGRAM_BINS)
+            is_date = pd.api.types.is_datetime64_any_dtype(series)
+            if is_date: edges = edges / 1e6 # Epoch ns -> ms for a 'date' axis
+            figure = go.Figure(go.Bar(x=(edges[:-1] + edges[1:]) / 2, y=counts, width=np.diff(edges),
+                                      marker_line_width=0, name=str(x)))
+            figure.update_layout(bargap=0, title=f"Distribution of {x}", xaxis_title=x, yaxis_title="Rows")
+            if is_date: figure.update_xaxes(type='date')
+            meta.update(reduction="binned", bins=PLOT_HISTOGRAM_BINS)
+        else:
+            counts = series.value_counts(dropna=True).head(PLOT_MAX_CATEGORIES)
+            figure = go.Figure(go.Bar(x=counts.index.astype(str), y=counts.to_numpy(), name=str(x)))
+            figure.update_layout(title=f"Counts of {x}", xaxis_title=x, yaxis_title="Rows")
+            meta.update(reduction="value_counts", categories=int(len(counts)))
+        return figure, meta
+
+    if chart_type == 'scatter':
+        if rows > PLOT_SCATTER_MAX_POINTS and _is_numeric(df[x]) and _is_numeric(df[y]):
+            figure, plotted = _binned_heatmap(df, x, y, PLOT_SCATTER_BINS, f"{y} vs {x} (binned, {rows:,} rows)")
+            meta.update(reduction="binned_2d", bins=PLOT_SCATTER_BINS, plotted_rows=plotted)
+            return figure, meta
+        subset = df[[c for c in (x, y, color) if c]]
+        if rows > PLOT_SCATTER_MAX_POINTS:
+            subset = subset.sample(n=PLOT_SCATTER_MAX_POINTS, random_state=0) # Non-numeric axes cannot be binned
+            meta.update(reduction="sampled", plotted_rows=PLOT_SCATTER_MAX_POINTS)
+        return px.scatter(subset, x=x, y=y, color=color, title=f"{y} vs {x}"), meta
+
+    if chart_type == 'line':
+        if not (_is_numeric(df[x]) or pd.api.types.is_datetime64_any_dtype(df[x])) or not _is_numeric(df[y]):
+            raise ValueError("Line charts need a numeric or date X-axis and a numeric Y-axis.")
+        subset = df[[c for c in (x, y, color) if c]].dropna(subset=[x, y]).sort_values(x, kind='mergesort')
+        groups = [(None, subset)] if color is None else [(name, group) for name, group in subset.groupby(color, sort=False, observed=True)][:PLOT_MAX_CATEGORIES]
+        budget = max(3, PLOT_LINE_MAX_POINTS // max(1, len(groups)))
+        figure = go.Figure()
+        plotted = 0
+        for name, group in groups:
+            keep = lttb_indices(_as_float(group[x]), _as_float(group[y]), budget)
+            reduced = group.iloc[keep]
+            plotted += len(reduced)
+            figure.add_trace(go.Scatter(x=_plot_values(reduced[x]), y=_plot_values(reduced[y]),
+                                        mode='lines', name=str(name) if name is not None else str(y)))
+        figure.update_layout(title=f"{y} over {x}", xaxis_title=x, yaxis_title=y, showlegend=color is not None)
+        if pd.api.types.is_datetime64_any_dtype(df[x]): figure.update_xaxes(type='date')
+        if plotted < len(subset): meta.update(reduction="lttb", plotted_rows=plotted)
+        return figure, meta
+
+    if chart_type in ('bar', 'pie'):
+        group_columns = [x] + ([color] if color and chart_type == 'bar' else [])
+        categories = _top_categories(df[x], PLOT_PIE_MAX_SLICES if chart_type == 'pie' else PLOT_MAX_CATEGORIES)
+        subset = df[df[x].isin(categories)]
+        if y and _is_numeric(df[y]):
+            # Pie slices are shares of a total, so they sum; bars compare group means
+            statistic = 'sum' if chart_type == 'pie' else 'mean'
+            aggregated = subset.groupby(group_columns, observed=True, dropna=True)[y].agg(statistic).reset_index()
+            value_column, value_label = y, f"{statistic} of {y}"
+        else:
+            aggregated = subset.groupby(group_columns, observed=True, dropna=True).size().rename('rows').reset_index()
+            value_column, value_label = 'rows', "rows"
+        meta.update(reduction="grouped", categories=int(len(categories)))
+        return _grouped_chart_figure(aggregated, chart_type, x, color, value_column, value_label), meta
+
+    if chart_type == 'box':
+        value_column, group_column = (y, x) if y else (x, None)
+        if not _is_numeric(df[value_column]): raise ValueError("Box plots need a numeric value column.")
+        groups = [(str(value_column), df[value_column])] if group_column is None else \
+                 [(str(name), df.loc[df[group_column] == name, value_column]) for name in _top_categories(df[group_column], PLOT_MAX_CATEGORIES)]
+        figure = go.Figure()
+        for name, values in groups:
+            values = _as_float(values); values = values[~np.isnan(values)]
+            if not len(values): continue
+            q1, median, q3 = np.quantile(values, [0.25, 0.5, 0.75])
+            iqr = q3 - q1
+            # Whiskers end at the most extreme values within 1.5 IQR (Tukey), like Plotly's own boxes
+            lower = values[values >= q1 - 1.5 * iqr].min(); upper = values[values <= q3 + 1.5 * iqr].max()
+            figure.add_trace(go.Box(name=name, q1=[q1], median=[median], q3=[q3], lowerfence=[lower], upperfence=[upper],
+                                    mean=[values.mean()], x=[name]))
+        figure.update_layout(title=f"Distribution of {value_column}" + (f" by {group_column}" if group_column else ""),
+                             yaxis_title=value_column, showlegend=False)
+        meta.update(reduction="quartiles")
+        return figure, meta
+
+    if chart_type == 'violin':
+        subset = df[[c for c in (x, y, color) if c]]
+        if rows > PLOT_VIOLIN_SAMPLE_ROWS:
+            subset = subset.sample(n=PLOT_VIOLIN_SAMPLE_ROWS, random_state=0)
+            meta.update(reduction="sampled", plotted_rows=PLOT_VIOLIN_SAMPLE_ROWS)
+        if y: return px.violin(subset, x=x, y=y, color=color, box=True, title=f"Distribution of {y} by {x}"), meta
+        return px.violin(subset, y=x, color=color, box=True, title=f"Distribution of {x}"), meta
+
+    if chart_type == 'heatmap':
+        numeric = [col for col in df.columns if _is_numeric(df[col])][:PLOT_HEATMAP_MAX_COLUMNS]
+        if len(numeric) < 2: raise ValueError("Correlation heatmap needs at least two numeric columns.")
+        correlation = correlation_analysis(df[numeric], mode='matrix')
+        figure = go.Figure(go.Heatmap(z=np.round(np.array(correlation['matrix'], dtype=np.float64), 4),
+                                      x=correlation['columns'], y=correlation['columns'],
+                                      zmin=-1, zmax=1, colorscale='RdBu', reversescale=True))
+        figure.update_layout(title="Correlation Matrix")
+        meta.update(reduction="correlation", columns=len(numeric))
+        return figure, meta
+
+    # density_heatmap
+    if not y: raise ValueError("A Y-axis column is required for density heatmaps.")
+    if not (_is_numeric(df[x]) and _is_numeric(df[y])): raise ValueError("Density heatmaps need numeric X and Y columns.")
+    figure, plotted = _binned_heatmap(df, x, y, PLOT_SCATTER_BINS // 2, f"Density of {y} vs {x}")
+    meta.update(reduction="binned_2d", bins=PLOT_SCATTER_BINS // 2, plotted_rows=plotted)
+    return figure, meta
+
+def build_plot_from_cube(cube, cube_meta, chart_type, x, y=None, color=None):
+    """
+    Grouped bar/pie figure answered from a precomputed aggregation cube (see
+    data_analyzer_utils), matching build_plot_figure's output. Returns (figure, meta),
+    or None if the cube does not cover the request (the caller then groups the frame).
+    """
+    config = normalize_plot_config(chart_type, x, y, color)
+    x, y, color = config['x'], config['y'], config['color']
+    if chart_type not in CUBE_CHART_TYPES or not x: return None
+    if chart_type == 'bar' and not y: return None # build_plot_figure reports the missing Y-axis
+    group_columns = [x] + ([color] if color and chart_type == 'bar' else [])
+    x_cells = cube_grouping(cube, cube_meta, [x])
+    cells = cube_grouping(cube, cube_meta, group_columns)
+    if x_cells is None or cells is None: return None
+    measure_index, measure = cube_measure(cube_meta, y) if y else (None, None)
+    if y and measure is None: return None # Not a precomputed numeric column
+
+    limit = PLOT_PIE_MAX_SLICES if chart_type == 'pie' else PLOT_MAX_CATEGORIES
+    x_cells = x_cells[x_cells[x].notna()]
+    categories = x_cells.sort_values('__rows', ascending=False, kind='mergesort')[x].head(limit)
+    cells = cells[cells[group_columns].notna().all(axis=1) & cells[x].isin(categories)]
+    cells = cells.sort_values(group_columns, kind='mergesort').reset_index(drop=True)
+    aggregated = cells[group_columns].copy()
+    if measure is not None:
+        statistic = 'sum' if chart_type == 'pie' else 'mean'
+        aggregated[y] = cube_statistic(cells, measure_index, measure, statistic).astype('float64')
+        value_column, value_label = y, f"{statistic} of {y}"
+    else:
+        aggregated['rows'] = cells['__rows']
+        value_column, value_label = 'rows', "rows"
+    meta = {"chart_type": chart_type, "rows": int(cube_meta.get('rows', 0)), "reduction": "grouped",
+            "categories": int(len(categories)), "source": "cube"}
+    return _grouped_chart_figure(aggregated, chart_type, x, color, value_column, value_label), meta
+
+def plot_task(filepath, chain, chart_type, x, y=None, color=None):
+    """build_plot_figure on the dataset version at the end of chain. Returns (plot_json, meta)."""
+    df, _ = materialize_dataset(filepath, chain or [])
+    if df is None: raise ValueError("Failed to load data file.")
+    figure, meta = build_plot_figure(df, chart_type, x, y, color)
+    return pio.to_json(figure), meta
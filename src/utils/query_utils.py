@@ -0,0 +1,390 @@
+# src/utils/query_utils.py
+
+import ast
+import hashlib
+import json
+import logging
+import math
+import time
+import numpy as np
+import pandas as pd
+
+# Optional: numexpr evaluates purely numeric predicates in one multithreaded pass (pip install numexpr)
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+# --- Dataset Query Engine ---
+# A query is a JSON spec:
+#   {"where": "price > 100 and region in ['N', 'S']",   # filter expression (optional)
+#    "select": ["region", "price"],                       # projection (optional, default all)
+#    "group_by": ["region"], "aggregates": ["sum(price)", "count()"],
+#    "order_by": ["-sum_price"]}                          # '-' prefix sorts descending
+# The filter uses Python expression syntax but is parsed with ast and only a
+# whitelist of nodes is accepted (column names, literals, boolean/comparison/
+# arithmetic operators and the functions in QUERY_FUNCTIONS) - nothing is ever
+# passed to eval(). Names with spaces are referenced as col('Unit Price').
+# Each node is compiled into a vectorized pandas operation; a predicate that only
+# does arithmetic/comparisons on numeric columns is handed to numexpr as a whole.
+# Execution plan: predicate on just the referenced columns -> row positions ->
+# gather only the projected columns for those rows -> group/aggregate -> sort.
+QUERY_MAX_EXPRESSION_CHARS = 2000
+QUERY_MAX_NODES = 200
+QUERY_MAX_IN_VALUES = 1000
+QUERY_MAX_GROUP_COLUMNS = 5
+QUERY_AGGREGATE_FUNCTIONS = ('count', 'sum', 'mean', 'min', 'max', 'median', 'std', 'nunique')
+
+# Function name -> (argument kinds, result kind); 'str' arguments must be string literals
+QUERY_FUNCTIONS = {
+    'isnull': (('any',), 'bool'), 'notnull': (('any',), 'bool'),
+    'contains': (('text', 'str'), 'bool'), 'startswith': (('text', 'str'), 'bool'), 'endswith': (('text', 'str'), 'bool'),
+    'lower': (('text',), 'text'), 'upper': (('text',), 'text'), 'len': (('text',), 'num'),
+    'abs': (('num',), 'num'), 'round': (('num',), 'num'),
+    'year': (('date',), 'num'), 'month': (('date',), 'num'), 'day': (('date',), 'num'), 'weekday': (('date',), 'num'),
+}
+_COMPARE_OPS = {ast.Eq: 'eq', ast.NotEq: 'ne', ast.Lt: 'lt', ast.LtE: 'le', ast.Gt: 'gt', ast.GtE: 'ge'}
+_NUMEXPR_COMPARE = {ast.Eq: '==', ast.NotEq: '!=', ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>='}
+_ARITH_OPS = {ast.Add: ('add', '+'), ast.Sub: ('sub', '-'), ast.Mult: ('mul', '*'), ast.Div: ('truediv', '/'),
+              ast.Mod: ('mod', '%'), ast.FloorDiv: ('floordiv', None)} # numexpr has no floor division
+
+# Kind pairs that may be compared ('str' is a string literal: it matches text, and dates as ISO strings)
+_COMPARABLE_KINDS = {frozenset(pair) for pair in (('num',), ('bool',), ('num', 'bool'), ('text',), ('str',),
+                                                  ('text', 'str'), ('date',), ('date', 'str'))}
+
+def column_kind(dtype):
+    """Type class of a column for query type checks: 'num', 'bool', 'date' or 'text'."""
+    if pd.api.types.is_bool_dtype(dtype): return 'bool'
+    if pd.api.types.is_numeric_dtype(dtype): return 'num'
+    if pd.api.types.is_datetime64_any_dtype(dtype): return 'date'
+    return 'text'
+
+def _literal_kind(value):
+    if isinstance(value, bool): return 'bool'
+    if isinstance(value, (int, float)):
+        # 1e400 parses as inf (and huge ints overflow float64), which has no numexpr literal form
+        try: finite = math.isfinite(float(value))
+        except OverflowError: finite = False
+        if not finite: raise ValueError(f"Number {str(value)[:40]} is out of range in query.")
+        return 'num'
+    if isinstance(value, str): return 'str'
+    if value is None: return 'null'
+    raise ValueError(f"Unsupported literal {value!r} in query.")
+
+def _as_mask(value, length):
+    """Boolean NumPy mask from a compiled node's result (nulls count as False)."""
+    if isinstance(value, (pd.Series, pd.Index)):
+        return value.fillna(False).to_numpy(dtype=bool) if value.dtype != bool else value.to_numpy()
+    if isinstance(value, np.ndarray): return value.astype(bool)
+    return np.full(length, bool(value))
+
+
+# --- Expression Compiler ---
+
+class _Compiled:
+    """A compiled expression node: fn(frame) -> Series/scalar, its kind, and its numexpr source (None if not numexpr-safe)."""
+    __slots__ = ('fn', 'kind', 'numexpr_src', 'constant')
+    def __init__(self, fn, kind, numexpr_src=None, constant=False):
+        self.fn, self.kind, self.numexpr_src, self.constant = fn, kind, numexpr_src, constant
+
+def _compile_node(node, kinds, used_columns):
+    """Compiles one whitelisted AST node (see module notes); raises ValueError for anything else."""
+    if isinstance(node, ast.Constant):
+        value = node.value; kind = _literal_kind(value)
+        numexpr_src = repr(value) if kind in ('num', 'bool') else None
+        return _Compiled(lambda frame: value, kind, numexpr_src, constant=True)
+
+    if isinstance(node, ast.Name) or (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'col'):
+        if isinstance(node, ast.Name):
+            name = node.id
+            if name not in kinds:
+                if name in ('true', 'false'): return _compile_node(ast.Constant(name == 'true'), kinds, used_columns)
+                if name == 'null': return _compile_node(ast.Constant(None), kinds, used_columns)
+                raise ValueError(f"Column '{name}' not found in dataset.")
+        else:
+            if len(node.args) != 1 or node.keywords or not isinstance(node.args[0], ast.Constant) or not isinstance(node.args[0].value, str):
+                raise ValueError("col() takes one column name string.")
+            name = node.args[0].value
+            if name not in kinds: raise ValueError(f"Column '{name}' not found in dataset.")
+        if name not in used_columns: used_columns.append(name)
+        variable = f"c{used_columns.index(name)}"
+        return _Compiled(lambda frame: frame[name], kinds[name], variable if kinds[name] in ('num', 'bool') else None)
+
+    if isinstance(node, ast.BoolOp):
+        parts = [_compile_node(value, kinds, used_columns) for value in node.values]
+        is_and = isinstance(node.op, ast.And)
+        def bool_op(frame, parts=parts):
+            mask = _as_mask(parts[0].fn(frame), len(frame))
+            for part in parts[1:]:
+                other = _as_mask(part.fn(frame), len(frame))
+                mask = (mask & other) if is_and else (mask | other)
+            return mask
+        sources = [p.numexpr_src for p in parts]
+        numexpr_src = f" {'&' if is_and else '|'} ".join(f"({s})" for s in sources) if all(s and p.kind == 'bool' for s, p in zip(sources, parts)) else None
+        return _Compiled(bool_op, 'bool', numexpr_src)
+
+    if isinstance(node, ast.UnaryOp):
+        operand = _compile_node(node.operand, kinds, used_columns)
+        if isinstance(node.op, ast.Not):
+            return _Compiled(lambda frame: ~_as_mask(operand.fn(frame), len(frame)), 'bool',
+                             f"~({operand.numexpr_src})" if operand.numexpr_src and operand.kind == 'bool' else None)
+        if isinstance(node.op, ast.USub) and operand.kind == 'num':
+            return _Compiled(lambda frame: -operand.fn(frame), 'num',
+                             f"-({operand.numexpr_src})" if operand.numexpr_src else None, operand.constant)
+        raise ValueError("Unsupported unary operator in query.")
+
+    if isinstance(node, ast.BinOp):
+        if type(node.op) not in _ARITH_OPS: raise ValueError("Unsupported arithmetic operator in query (allowed: + - * / // %).")
+        left, right = _compile_node(node.left, kinds, used_columns), _compile_node(node.right, kinds, used_columns)
+        # Arithmetic is numeric only (so e.g. text * 10**9 cannot blow up memory)
+        if left.kind != 'num' or right.kind != 'num': raise ValueError("Arithmetic is only allowed on numeric values.")
+        method, symbol = _ARITH_OPS[type(node.op)]
+        def arith(frame):
+            a, b = left.fn(frame), right.fn(frame)
+            if isinstance(a, pd.Series): return getattr(a, method)(b)
+            if isinstance(b, pd.Series): return getattr(b, 'r' + method)(a)
+            return getattr(pd.Series([a], dtype='float64'), method)(b).iloc[0] # Constant folding without Python big-int math
+        numexpr_src = f"({left.numexpr_src}) {symbol} ({right.numexpr_src})" if symbol and left.numexpr_src and right.numexpr_src else None
+        return _Compiled(arith, 'num', numexpr_src, left.constant and right.constant)
+
+    if isinstance(node, ast.Compare):
+        return _compile_compare(node, kinds, used_columns)
+
+    if isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Name) or node.func.id not in QUERY_FUNCTIONS:
+            raise ValueError(f"Unsupported function in query. Allowed: col, {', '.join(QUERY_FUNCTIONS)}.")
+        name = node.func.id
+        arg_kinds, result_kind = QUERY_FUNCTIONS[name]
+        if node.keywords: raise ValueError(f"{name}() does not take keyword arguments.")
+        if name == 'round' and len(node.args) == 2: arg_kinds = ('num', 'int')
+        if len(node.args) != len(arg_kinds): raise ValueError(f"{name}() takes {len(arg_kinds)} argument(s).")
+        args = []
+        for arg_node, expected in zip(node.args, arg_kinds):
+            if expected in ('str', 'int'):
+                literal_type = str if expected == 'str' else int
+                if not isinstance(arg_node, ast.Constant) or type(arg_node.value) is not literal_type:
+                    raise ValueError(f"{name}() expects a {'string' if expected == 'str' else 'whole number'} literal argument.")
+                args.append(arg_node.value); continue
+            arg = _compile_node(arg_node, kinds, used_columns)
+            if expected != 'any' and arg.kind != expected: raise ValueError(f"{name}() expects a {expected} column.")
+            args.append(arg)
+        return _Compiled(_function_fn(name, args), result_kind)
+
+    raise ValueError(f"Unsupported syntax in query: {type(node).__name__}.")
+
+def _function_fn(name, args):
+    """Vectorized implementation of a QUERY_FUNCTIONS call."""
+    source = args[0]
+    def text(frame): return source.fn(frame).astype('string')
+    if name == 'isnull': return lambda frame: pd.Series(source.fn(frame)).isna()
+    if name == 'notnull': return lambda frame: pd.Series(source.fn(frame)).notna()
+    if name == 'contains': return lambda frame: text(frame).str.contains(args[1], regex=False)
+    if name == 'startswith': return lambda frame: text(frame).str.startswith(args[1])
+    if name == 'endswith': return lambda frame: text(frame).str.endswith(args[1])
+    if name == 'lower': return lambda frame: text(frame).str.lower()
+    if name == 'upper': return lambda frame: text(frame).str.upper()
+    if name == 'len': return lambda frame: text(frame).str.len()
+    if name == 'abs': return lambda frame: source.fn(frame).abs()
+    if name == 'round': return lambda frame: source.fn(frame).round(args[1] if len(args) > 1 else 0)
+    return lambda frame: getattr(source.fn(frame).dt, name) # year/month/day/weekday
+
+def _comparison_value(operand_kind, value):
+    """Converts a literal compared against a column of operand_kind (dates accept ISO strings)."""
+    if operand_kind == 'date' and isinstance(value, str):
+        try: return pd.Timestamp(value)
+        except (TypeError, ValueError): raise ValueError(f"'{value}' is not a date.")
+    return value
+
+def _compile_compare(node, kinds, used_columns):
+    """Compiles (possibly chained) comparisons, including 'in'/'not in' against literal lists."""
+    operands = [_compile_node(node.left, kinds, used_columns)]
+    parts, sources = [], []
+    for op, comparator in zip(node.ops, node.comparators):
+        left = operands[-1]
+        if isinstance(op, (ast.In, ast.NotIn)):
+            if not isinstance(comparator, (ast.List, ast.Tuple, ast.Set)) or not all(isinstance(e, ast.Constant) for e in comparator.elts):
+                raise ValueError("'in' needs a list of literal values, e.g. region in ['N', 'S'].")
+            if len(comparator.elts) > QUERY_MAX_IN_VALUES: raise ValueError(f"'in' lists are limited to {QUERY_MAX_IN_VALUES} values.")
+            values = [_comparison_value(left.kind, e.value) for e in comparator.elts]
+            negate = isinstance(op, ast.NotIn)
+            def membership(frame, left=left, values=values, negate=negate):
+                matched = pd.Series(left.fn(frame)).isin(values).to_numpy()
+                return ~matched if negate else matched
+            parts.append(membership); sources.append(None)
+            operands.append(None); continue
+        if type(op) not in _COMPARE_OPS: raise ValueError("Unsupported comparison operator in query.")
+        right = _compile_node(comparator, kinds, used_columns)
+        if left is None: raise ValueError("'in' cannot be chained with other comparisons.")
+        method = _COMPARE_OPS[type(op)]
+        if 'null' in (left.kind, right.kind):
+            # x == null / x != null are null checks
+            if method not in ('eq', 'ne') or left.kind == right.kind: raise ValueError("null can only be compared with == or !=.")
+            operand = right if left.kind == 'null' else left
+            parts.append(lambda frame, operand=operand, method=method: pd.Series(operand.fn(frame)).isna() if method == 'eq'
+                         else pd.Series(operand.fn(frame)).notna())
+            sources.append(None); operands.append(right); continue
+        if frozenset((left.kind, right.kind)) not in _COMPARABLE_KINDS:
+            raise ValueError(f"Cannot compare {left.kind} with {right.kind} values.")
+        def compare(frame, left=left, right=right, method=method):
+            a, b = left.fn(frame), right.fn(frame)
+            if right.constant: b = _comparison_value(left.kind, b)
+            if left.constant: a = _comparison_value(right.kind, a)
+            if isinstance(a, pd.Series): return getattr(a, method)(b)
+            if isinstance(b, pd.Series): return getattr(b, {'lt': 'gt', 'le': 'ge', 'gt': 'lt', 'ge': 'le'}.get(method, method))(a)
+            return getattr(pd.Series([a]), method)(b).iloc[0]
+        parts.append(compare)
+        numeric = left.kind in ('num', 'bool') and right.kind in ('num', 'bool')
+        sources.append(f"({left.numexpr_src}) {_NUMEXPR_COMPARE[type(op)]} ({right.numexpr_src})"
+                       if numeric and left.numexpr_src and right.numexpr_src else None)
+        operands.append(right)
+
+    def compare_chain(frame):
+        mask = _as_mask(parts[0](frame), len(frame))
+        for part in parts[1:]: mask &= _as_mask(part(frame), len(frame))
+        return mask
+    numexpr_src = " & ".join(f"({s})" for s in sources) if all(sources) else None
+    return _Compiled(compare_chain, 'bool', numexpr_src)
+
+def compile_filter(expression, kinds):
+    """
+    Compiles a filter expression against {column: kind} (see column_kind).
+    Returns (predicate(frame) -> bool mask, referenced columns, numexpr source or None).
+    Raises ValueError for invalid or disallowed expressions.
+    """
+    if len(expression) > QUERY_MAX_EXPRESSION_CHARS: raise ValueError(f"Filter expression is limited to {QUERY_MAX_EXPRESSION_CHARS} characters.")
+    try: tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as syntax_err: raise ValueError(f"Invalid filter expression: {syntax_err.msg}.")
+    if sum(1 for _ in ast.walk(tree)) > QUERY_MAX_NODES: raise ValueError("Filter expression is too complex.")
+    used_columns = []
+    compiled = _compile_node(tree.body, kinds, used_columns)
+    if compiled.kind != 'bool': raise ValueError("Filter expression must evaluate to true/false (e.g. price > 100).")
+    return (lambda frame: _as_mask(compiled.fn(frame), len(frame))), used_columns, compiled.numexpr_src
+
+
+# --- Query Specs & Execution ---
+
+def _parse_aggregate(entry, columns):
+    """Normalizes "sum(price)" / {"func", "column", "as"} into {"func", "column", "as"}."""
+    if isinstance(entry, str):
+        try: call = ast.parse(entry.strip(), mode='eval').body
+        except SyntaxError: raise ValueError(f"Invalid aggregate '{entry}' (expected e.g. sum(price)).")
+        if isinstance(call, ast.Name): func, column = call.id, None
+        elif isinstance(call, ast.Call) and isinstance(call.func, ast.Name) and len(call.args) <= 1 and not call.keywords:
+            func = call.func.id
+            arg = call.args[0] if call.args else None
+            if arg is None: column = None
+            elif isinstance(arg, ast.Name): column = arg.id
+            elif isinstance(arg, ast.Constant) and isinstance(arg.value, str): column = arg.value
+            elif isinstance(arg, ast.Call) and isinstance(arg.func, ast.Name) and arg.func.id == 'col' and len(arg.args) == 1 and isinstance(arg.args[0], ast.Constant): column = arg.args[0].value
+            else: raise ValueError(f"Invalid aggregate '{entry}'.")
+        else: raise ValueError(f"Invalid aggregate '{entry}' (expected e.g. sum(price)).")
+        entry = {"func": func, "column": column}
+    if not isinstance(entry, dict): raise ValueError("Aggregates must be strings like 'sum(price)' or objects.")
+    func, column = entry.get('func'), entry.get('column')
+    if func not in QUERY_AGGREGATE_FUNCTIONS: raise ValueError(f"Unsupported aggregate '{func}'. Allowed: {', '.join(QUERY_AGGREGATE_FUNCTIONS)}.")
+    if column is not None and column not in columns: raise ValueError(f"Column '{column}' not found in dataset.")
+    if column is None and func != 'count': raise ValueError(f"{func}() needs a column.")
+    return {"func": func, "column": column, "as": str(entry.get('as') or (f"{func}_{column}" if column is not None else func))}
+
+def normalize_query_spec(data, columns):
+    """Validates a query request body against the dataset's columns and returns the canonical spec."""
+    data = data or {}
+    columns = list(columns)
+    where = data.get('where')
+    if where is not None and not isinstance(where, str): raise ValueError("'where' must be an expression string.")
+    where = where.strip() if where and where.strip() else None
+
+    def column_list(key):
+        value = data.get(key) or []
+        if isinstance(value, str): value = [value]
+        if not isinstance(value, list): raise ValueError(f"'{key}' must be a list of column names.")
+        missing = [c for c in value if c not in columns]
+        if missing: raise ValueError(f"Column(s) not found in dataset: {', '.join(map(str, missing))}.")
+        return list(dict.fromkeys(value))
+
+    select, group_by = column_list('select'), column_list('group_by')
+    if len(group_by) > QUERY_MAX_GROUP_COLUMNS: raise ValueError(f"Grouping is limited to {QUERY_MAX_GROUP_COLUMNS} columns.")
+    aggregates = [_parse_aggregate(entry, columns) for entry in (data.get('aggregates') or [])]
+    if group_by and not aggregates: aggregates = [{"func": "count", "column": None, "as": "count"}]
+    output_columns = (group_by + [agg['as'] for agg in aggregates]) if aggregates else (select or columns)
+    if len(set(output_columns)) != len(output_columns): raise ValueError("Query output column names must be unique (use 'as').")
+
+    order_by = []
+    for entry in (data.get('order_by') or []):
+        if isinstance(entry, str):
+            entry = {"column": entry[1:], "descending": True} if entry.startswith('-') else {"column": entry, "descending": False}
+        column = entry.get('column') if isinstance(entry, dict) else None
+        if column not in output_columns: raise ValueError(f"Cannot order by '{column}': not a result column.")
+        order_by.append({"column": column, "descending": bool(entry.get('descending'))})
+    return {"where": where, "select": select, "group_by": group_by, "aggregates": aggregates, "order_by": order_by}
+
+def get_query_key(version, spec):
+    """Cache key for a query result: dataset version plus a hash of the canonical spec."""
+    digest = hashlib.sha1(json.dumps(spec, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+    return f"{version}_{digest}"
+
+def _filter_positions(df, spec, plan):
+    """Evaluates the filter on just its columns (numexpr when possible) and returns matching row positions."""
+    if not spec['where']: return np.arange(len(df), dtype=np.int64)
+    kinds = {name: column_kind(dtype) for name, dtype in df.dtypes.items()}
+    predicate, used_columns, numexpr_src = compile_filter(spec['where'], kinds)
+    plan["filter_columns"] = used_columns
+    mask = None
+    if numexpr_src and numexpr is not None:
+        # One fused, multithreaded pass over the referenced numeric columns (NaN compares as False)
+        local_dict = {}
+        for position, name in enumerate(used_columns):
+            series = df[name]
+            local_dict[f"c{position}"] = (series.fillna(False).to_numpy(dtype=bool) if kinds[name] == 'bool'
+                                          else series.to_numpy(dtype='float64', na_value=np.nan))
+        try:
+            mask = numexpr.evaluate(numexpr_src, local_dict=local_dict)
+            plan["engine"] = "numexpr"
+            if np.ndim(mask) == 0: mask = np.full(len(df), bool(mask))
+        except Exception as numexpr_err:
+            logging.warning(f"numexpr failed on '{numexpr_src}': {numexpr_err}. Falling back to pandas.")
+            mask = None
+    if mask is None:
+        mask = predicate(df[used_columns] if used_columns else df.iloc[:, :0])
+        plan["engine"] = "pandas"
+    return np.flatnonzero(mask)
+
+def execute_query(df, spec):
+    """
+    Runs a normalized query spec (see normalize_query_spec) against df.
+    Returns (result DataFrame, plan) where plan is a JSON-safe description of what ran.
+    """
+    started = time.perf_counter()
+    plan = {"filter_columns": [], "engine": None, "input_rows": int(len(df))}
+    positions = _filter_positions(df, spec, plan)
+    plan["matched_rows"] = int(len(positions))
+
+    # Projection after the filter: only the needed columns are gathered, only for matching rows
+    if spec['aggregates']:
+        needed = list(dict.fromkeys(spec['group_by'] + [a['column'] for a in spec['aggregates'] if a['column'] is not None]))
+    else:
+        needed = spec['select'] or list(df.columns)
+    plan["project_columns"] = needed
+    frame = df[needed] if len(positions) == len(df) else df[needed].iloc[positions]
+
+    if spec['aggregates']:
+        named = {}
+        for agg in spec['aggregates']:
+            if agg['column'] is None: named[agg['as']] = pd.NamedAgg(column=needed[0] if needed else None, aggfunc='size')
+            else: named[agg['as']] = pd.NamedAgg(column=agg['column'], aggfunc=agg['func'])
+        if spec['group_by']:
+            result = frame.groupby(spec['group_by'], dropna=False, sort=True, observed=True).agg(**named).reset_index()
+        else:
+            result = pd.DataFrame({name: [len(frame) if agg.aggfunc == 'size' else frame[agg.column].agg(agg.aggfunc)]
+                                   for name, agg in named.items()})
+    else:
+        result = frame.reset_index(drop=True)
+
+    if spec['order_by']:
+        result = result.sort_values([o['column'] for o in spec['order_by']],
+                                    ascending=[not o['descending'] for o in spec['order_by']],
+                                    kind='mergesort', na_position='last').reset_index(drop=True)
+    plan["result_rows"] = int(len(result))
+    plan["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    logging.debug(f"Query plan: {plan}")
+    return result, plan
@@ -0,0 +1,167 @@
+# src/utils/retrieval_utils.py
+
+import functools
+import logging
+import math
+import os
+import re
+import uuid
+import numpy as np
+
+from .pdf_utils import iter_pdf_chunks, get_pdf_chunks, read_pdf_chunk_text, PDF_CHUNK_TARGET_CHARS
+
+# --- BM25 Chunk Index ---
+# PDF chat selects the chunks relevant to each question instead of sending the
+# same leading text every time. At upload an inverted index is built over the
+# page-aligned chunks (the same chunks stored in pdf_text_chunks, regenerated
+# from the pages file) and saved as one .npz next to the pages file:
+#   vocab        sorted terms (looked up with searchsorted, no dict to rebuild)
+#   offsets      postings of term t are postings[offsets[t]:offsets[t + 1]]
+#   postings     int32 chunk positions, ascending within a term
+#   term_freqs   uint16 term counts aligned with postings (saturated; BM25 flattens them anyway)
+#   doc_lengths  int32 tokens per chunk (precomputed for length normalisation)
+#   chunk_ids    chunk_index of each position;  chunk_chars  characters per chunk
+# A question is scored with numpy over the postings of its terms only, and the
+# best chunks are taken greedily until the prompt's character budget is used.
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_TOP_K = 8
+BM25_SUFFIX = '.npz'
+CHARS_PER_TOKEN = 4
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_STOP_WORDS = frozenset((
+    "a an and are as at be but by for from has have he her his i if in into is it its of on or "
+    "our she so than that the their them then there these they this to was we were what when "
+    "where which who why will with you your do does did not no can could would should about"
+).split())
+
+def tokenize(text):
+    """Lowercased word tokens without stop words and single letters (digits are kept)."""
+    return [token for token in _TOKEN_RE.findall(text.lower())
+            if token not in _STOP_WORDS and (len(token) > 1 or token.isdigit())]
+
+def get_bm25_index_path(pages_path, target_chars=PDF_CHUNK_TARGET_CHARS):
+    # Chunk boundaries depend on target_chars, so it is part of the name
+    return f"{pages_path}.bm25-{int(target_chars)}{BM25_SUFFIX}"
+
+def build_bm25_arrays(chunks):
+    """Index arrays (see above) for an iterable of chunk dicts with chunk_index and text."""
+    term_docs, term_counts = {}, {}
+    doc_lengths, chunk_ids, chunk_chars = [], [], []
+    for position, chunk in enumerate(chunks):
+        tokens = tokenize(chunk["text"])
+        counts = {}
+        for token in tokens: counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            term_docs.setdefault(token, []).append(position)
+            term_counts.setdefault(token, []).append(count)
+        doc_lengths.append(len(tokens)); chunk_ids.append(chunk["chunk_index"]); chunk_chars.append(len(chunk["text"]))
+    vocab = sorted(term_docs)
+    offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(term_docs[term]) for term in vocab])
+    postings = np.fromiter((doc for term in vocab for doc in term_docs[term]), dtype=np.int32, count=int(offsets[-1]))
+    term_freqs = np.fromiter((min(count, 65535) for term in vocab for count in term_counts[term]),
+                             dtype=np.uint16, count=int(offsets[-1]))
+    return {"vocab": np.array(vocab, dtype=str), "offsets": offsets, "postings": postings, "term_freqs": term_freqs,
+            "doc_lengths": np.array(doc_lengths, dtype=np.int32), "chunk_ids": np.array(chunk_ids, dtype=np.int32),
+            "chunk_chars": np.array(chunk_chars, dtype=np.int32)}
+
+def build_bm25_index_task(pages_path, target_chars=PDF_CHUNK_TARGET_CHARS, out_path=None):
+    """
+    Process pool task: builds the BM25 index for the chunks of a pages file and
+    writes it atomically to out_path (default get_bm25_index_path). An existing
+    index is reused. Returns the index path.
+    """
+    out_path = out_path or get_bm25_index_path(pages_path, target_chars)
+    if os.path.exists(out_path): return out_path
+    arrays = build_bm25_arrays(iter_pdf_chunks(pages_path, target_chars))
+    tmp_path = f"{out_path}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        with open(tmp_path, 'wb') as index_file: np.savez(index_file, **arrays)
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+    logging.info(f"BM25 index built: {len(arrays['chunk_ids'])} chunks, {len(arrays['vocab'])} terms, "
+                 f"{len(arrays['postings'])} postings -> {os.path.basename(out_path)}")
+    return out_path
+
+@functools.lru_cache(maxsize=32)
+def _load_bm25_index(path, mtime):
+    with np.load(path) as npz:
+        index = {name: npz[name] for name in npz.files}
+    lengths = index["doc_lengths"]
+    index["avg_doc_length"] = float(lengths.mean()) if len(lengths) else 0.0
+    return index
+
+def load_bm25_index(path):
+    """Index arrays of path; cached per file (index files are written once, atomically)."""
+    return _load_bm25_index(path, os.path.getmtime(path))
+
+def bm25_scores(index, query, k1=BM25_K1, b=BM25_B):
+    """BM25 score of every chunk position for query (zeros for chunks sharing no term)."""
+    doc_lengths = index["doc_lengths"]
+    scores = np.zeros(len(doc_lengths), dtype=np.float64)
+    vocab = index["vocab"]
+    if not len(vocab): return scores
+    chunk_count = len(doc_lengths)
+    length_norm = k1 * (1 - b + b * doc_lengths / (index["avg_doc_length"] or 1.0))
+    for term in set(tokenize(query)):
+        term_id = int(np.searchsorted(vocab, term))
+        if term_id >= len(vocab) or vocab[term_id] != term: continue
+        start, stop = index["offsets"][term_id], index["offsets"][term_id + 1]
+        docs = index["postings"][start:stop]
+        tf = index["term_freqs"][start:stop].astype(np.float64)
+        idf = math.log(1 + (chunk_count - len(docs) + 0.5) / (len(docs) + 0.5))
+        scores[docs] += idf * tf * (k1 + 1) / (tf + length_norm[docs]) # Positions are unique within a term
+    return scores
+
+def search_bm25(index, query, top_k=BM25_TOP_K, max_chars=None):
+    """
+    Best chunks for query as [{"chunk_index", "score", "chars"}], highest score
+    first: at most top_k, only chunks that match, and (when max_chars is given)
+    only as many as fit in max_chars together; a chunk that would overflow the
+    budget is skipped in favour of smaller, lower-ranked ones.
+    """
+    return select_hits(bm25_scores(index, query), index["chunk_ids"], index["chunk_chars"], top_k, max_chars)
+
+def select_hits(scores, chunk_ids, chunk_chars, top_k=BM25_TOP_K, max_chars=None):
+    """Budgeted top_k selection shared by the retrieval modes (scores, chunk_ids, chunk_chars are aligned arrays)."""
+    matching = np.flatnonzero(scores > 0)
+    if not len(matching): return []
+    ranked = matching[np.argsort(-scores[matching], kind='stable')]
+    hits, used_chars = [], 0
+    for position in ranked:
+        chars = int(chunk_chars[position])
+        if max_chars is not None and used_chars + chars > max_chars: continue
+        hits.append({"chunk_index": int(chunk_ids[position]), "score": round(float(scores[position]), 4), "chars": chars})
+        used_chars += chars
+        if len(hits) >= top_k: break
+    return hits
+
+def build_chat_context(chunks_collection, pdf_analysis_id, question, index_path=None,
+                       top_k=BM25_TOP_K, max_tokens=3000, search_fn=None):
+    """
+    Document text for a PDF chat prompt: the BM25 top-k chunks for question
+    within max_tokens (~CHARS_PER_TOKEN chars each), in document order and
+    labelled with their pages. search_fn(question, top_k, max_chars) -> hits
+    runs first (e.g. embedding retrieval), with BM25 as its fallback. Falls back
+    to the start of the document when there is no index or nothing matches.
+    Returns (context_text, hits).
+    """
+    max_chars = max(1, int(max_tokens)) * CHARS_PER_TOKEN
+    hits = []
+    if search_fn is not None:
+        try: hits = search_fn(question, top_k, max_chars)
+        except Exception as search_err: logging.error(f"Chunk search failed for {pdf_analysis_id}: {search_err}", exc_info=True)
+    if not hits and index_path and os.path.exists(index_path):
+        try: hits = search_bm25(load_bm25_index(index_path), question, top_k=top_k, max_chars=max_chars)
+        except Exception as search_err: logging.error(f"BM25 search failed for {pdf_analysis_id}: {search_err}", exc_info=True)
+    if not hits:
+        return read_pdf_chunk_text(chunks_collection, pdf_analysis_id, max_chars=max_chars), []
+    chunks = get_pdf_chunks(chunks_collection, pdf_analysis_id, chunk_indexes=[hit["chunk_index"] for hit in hits])
+    sections = []
+    for chunk in chunks: # Already in document order
+        pages = (f"Page {chunk['page_start']}" if chunk["page_start"] == chunk["page_end"]
+                 else f"Pages {chunk['page_start']}-{chunk['page_end']}")
+        sections.append(f"[{pages}]\n{chunk['text'].strip()}")
+    return "\n\n...\n\n".join(sections), hits
@@ -0,0 +1,175 @@
+# src/utils/sketch_utils.py
+
+import math
+import numpy as np
+import pandas as pd
+
+# --- Streaming Sketches for Approximate Statistics ---
+# Small, mergeable summaries used by the "approximate" profiling mode in
+# data_analyzer_utils. Each sketch is updated with NumPy arrays (one chunk of a
+# column at a time) and reports the error bound of the values it returns.
+
+def hash_values(values):
+    """64-bit hashes of a column's values (any dtype), as a uint64 NumPy array."""
+    return pd.util.hash_pandas_object(pd.Series(values), index=False).to_numpy(dtype=np.uint64)
+
+def _leading_zeros64(x):
+    """Vectorized count of leading zero bits for a uint64 array (64 for zero)."""
+    x = x.astype(np.uint64, copy=True)
+    zeros = np.zeros(len(x), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        top_clear = (x >> np.uint64(64 - shift)) == 0
+        zeros += top_clear * shift
+        x = np.where(top_clear, x << np.uint64(shift), x)
+    return zeros + (x == 0)
+
+
+class HyperLogLog:
+    """HyperLogLog distinct counter with 2**precision one-byte registers."""
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.num_registers = 1 << precision
+        self.registers = np.zeros(self.num_registers, dtype=np.uint8)
+
+    @property
+    def relative_error(self):
+        """Relative standard error of estimate() (one standard deviation)."""
+        return 1.04 / math.sqrt(self.num_registers)
+
+    def update_hashes(self, hashes):
+        """Adds pre-hashed uint64 values."""
+        if len(hashes) == 0: return
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        remainder = hashes << np.uint64(self.precision)
+        # Rank = position of the first set bit in the remaining bits (capped when all are zero)
+        rank = np.minimum(_leading_zeros64(remainder) + 1, 64 - self.precision + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def update(self, values):
+        self.update_hashes(hash_values(values))
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self):
+        m = self.num_registers
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.sum(np.exp2(-self.registers.astype(np.float64)))
+        empty_registers = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and empty_registers:
+            return m * math.log(m / empty_registers) # Linear counting for small cardinalities
+        return raw
+
+
+class KLLSketch:
+    """KLL quantile sketch (Karnin, Lang, Liberty) over float values."""
+
+    def __init__(self, k=200, seed=None):
+        self.k = k
+        self.count = 0
+        self.levels = [np.empty(0, dtype=np.float64)]
+        self._rng = np.random.default_rng(seed)
+
+    @property
+    def rank_error(self):
+        """Normalized rank error of quantile() (empirical KLL bound, 99% confidence)."""
+        return 2.296 / self.k ** 0.9723
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(2, int(math.ceil(self.k * (2.0 / 3.0) ** depth)))
+
+    def update(self, values, block_size=65536):
+        """Adds a float array; NaN values are ignored."""
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        for start in range(0, len(values), block_size):
+            block = values[start:start + block_size]
+            self.levels[0] = np.concatenate([self.levels[0], block])
+            self.count += len(block)
+            self._compress()
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0, dtype=np.float64))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.count += other.count
+        self._compress()
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) >= self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0, dtype=np.float64))
+                items = np.sort(items)
+                # An odd item out stays on this level so no weight is lost
+                keep = items[:1] if len(items) % 2 else items[:0]
+                pairs = items[len(keep):]
+                offset = int(self._rng.integers(0, 2))
+                self.levels[level] = keep
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], pairs[offset::2]])
+            level += 1
+
+    def quantile(self, qs):
+        """Returns the approximate quantiles for the fractions in qs (NaN if empty)."""
+        qs = np.atleast_1d(np.asarray(qs, dtype=np.float64))
+        if self.count == 0:
+            return np.full(len(qs), np.nan)
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items_at), 2 ** level, dtype=np.float64)
+                                  for level, items_at in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        items, cumulative = items[order], np.cumsum(weights[order])
+        positions = np.searchsorted(cumulative, qs * cumulative[-1], side='left')
+        return items[np.minimum(positions, len(items) - 1)]
+
+    def rank(self, value):
+        """Approximate fraction of values strictly below value."""
+        if self.count == 0:
+            return np.nan
+        below = sum(float(np.count_nonzero(items < value)) * 2 ** level for level, items in enumerate(self.levels))
+        total = sum(len(items) * 2 ** level for level, items in enumerate(self.levels))
+        return below / total
+
+    def fraction_outside(self, lower, upper):
+        """Approximate fraction of values < lower or > upper."""
+        if self.count == 0:
+            return 0.0
+        above = sum(float(np.count_nonzero(items > upper)) * 2 ** level for level, items in enumerate(self.levels))
+        total = sum(len(items) * 2 ** level for level, items in enumerate(self.levels))
+        return self.rank(lower) + above / total
+
+
+class ReservoirSample:
+    """Uniform fixed-size random sample of a stream (Algorithm R, batched)."""
+
+    def __init__(self, size=1000, seed=None):
+        self.size = size
+        self.seen = 0
+        self.items = []
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, values):
+        """Adds a 1D array of values to the stream."""
+        values = np.asarray(values, dtype=object)
+        fill = min(len(values), self.size - len(self.items))
+        self.items.extend(values[:fill].tolist())
+        rest = values[fill:]
+        self.seen += fill
+        if not len(rest): return
+        # Item number t (1-based) replaces a random slot with probability size / t
+        stream_positions = np.arange(self.seen + 1, self.seen + len(rest) + 1)
+        slots = (self._rng.random(len(rest)) * stream_positions).astype(np.int64)
+        for position in np.flatnonzero(slots < self.size): # In stream order, so later items win
+            self.items[slots[position]] = rest[position]
+        self.seen += len(rest)
+
+    @property
+    def missed_share_95(self):
+        """'Rule of three': a property absent from the sample affects < this share of values (95% confidence)."""
+        return min(1.0, 3.0 / len(self.items)) if self.items else 1.0
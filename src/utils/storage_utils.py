@@ -0,0 +1,55 @@
+# src/utils/storage_utils.py
+
+import hashlib
+import logging
+import os
+import tempfile
+
+# --- Content-Addressed Upload Storage ---
+# Uploaded bytes are hashed (SHA-256) while they are streamed to disk and stored
+# once under <root>/<ab>/<cd>/<sha256><ext>, where ab/cd are the first two byte
+# pairs of the digest. Two levels of 256 shards keep every directory small, and
+# an identical re-upload resolves to the existing file, so everything derived
+# from it (sidecars, row hashes, extracted text, profiles) can be reused.
+# NOTE: A stored file may back several records; never delete it for one of them.
+STORAGE_CHUNK_BYTES = 1024 * 1024
+STORAGE_TEMP_DIR = '.incoming'
+
+def get_content_path(root, digest, ext=''):
+    """Sharded path for a SHA-256 hex digest (the extension is kept so readers can dispatch on it)."""
+    return os.path.join(root, digest[:2], digest[2:4], f"{digest}{ext.lower()}")
+
+def store_upload_stream(stream, root, ext='', chunk_bytes=STORAGE_CHUNK_BYTES):
+    """
+    Copies a binary stream (e.g. a werkzeug FileStorage.stream) into content-addressed
+    storage under root, hashing it on the way. Returns a dict with
+    "path", "sha256", "size" and "reused" (True if identical bytes were already stored).
+    """
+    temp_dir = os.path.join(root, STORAGE_TEMP_DIR)
+    os.makedirs(temp_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=temp_dir)
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            while True:
+                chunk = stream.read(chunk_bytes)
+                if not chunk: break
+                digest.update(chunk)
+                temp_file.write(chunk)
+                size += len(chunk)
+        sha256 = digest.hexdigest()
+        content_path = get_content_path(root, sha256, ext)
+        if os.path.exists(content_path):
+            os.remove(temp_path) # Same bytes already stored; keep the original file (and its mtime)
+            logging.info(f"Upload deduplicated: {sha256[:12]}... ({size} bytes) already stored")
+            return {"path": content_path, "sha256": sha256, "size": size, "reused": True}
+        os.makedirs(os.path.dirname(content_path), exist_ok=True)
+        os.replace(temp_path, content_path) # Atomic; a concurrent identical upload just overwrites equal bytes
+        logging.info(f"Stored upload {sha256[:12]}... ({size} bytes) at {content_path}")
+        return {"path": content_path, "sha256": sha256, "size": size, "reused": False}
+    except Exception:
+        if os.path.exists(temp_path):
+            try: os.remove(temp_path)
+            except OSError as rm_err: logging.error(f"Failed to remove temp upload {temp_path}: {rm_err}")
+        raise